@@ -0,0 +1,321 @@
+# Бенчмарк синхронизации без настоящего магазина и FTP Торгсофт.
+#
+#   python bench.py                          # 1k строк, задержка и лимиты как у Shopify
+#   python bench.py --rows 1000 10000 100000 --latency 0.08 --concurrency 1 4 8
+#   python bench.py --rows 10000 --rest-rate 0 --graphql-rate 0   # только накладные расходы движка
+#
+# Каждый сценарий идёт в отдельном процессе (честный пик памяти):
+#   1) генерируем TSGoods.trs с реальными колонками и Articul-группами по несколько размеров
+#      и подходящий хорошоп.xlsx (кешируются в bench_data/);
+#   2) поднимаем локальный FTP (pyftpdlib) с /csv_folder/TSGoods.trs и mock_shopify.py
+#      с заданной задержкой и лимитами — в ещё одном процессе, чтобы товары стенда и буферы
+#      серверов не попадали в пик памяти синхронизации; счётчики запросов — через /_mock/stats;
+#   3) запускаем импорт так же, как кнопка на странице настроек (POST /settings), ждём job
+#      и печатаем время, запросы на товар, пик памяти и товаров в секунду.
+import argparse
+import csv
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_DATA = os.path.join(BENCH_DIR, "bench_data")
+
+# заголовок выгрузки Торгсофт (тот же список, что на странице настроек)
+TSGOODS_COLUMNS = [
+    'ModelGoodID', 'GoodID', 'Analogs', 'Articul', 'EqualCurrencyName', 'GoodTypeName', 'GoodTypeFull',
+    'PCName', 'ProducerCollectionFull', 'Height', 'Display', 'Age', 'ProductionDate', 'Length',
+    'EqualWholesalePrice', 'EqualSalePrice', 'PowerSupply', 'PriceDiscountPercent', 'Category',
+    'WarehouseQuantity', 'WarehouseQuantityForPartner', 'SuppLierCode', 'Color', 'ShortName',
+    'Country', 'CountUnitsPerBox', 'Material', 'MinQuantityForOrder', 'MinWarehouseQuantity',
+    'WholesaleCount', 'Measure', 'GoodName', 'FashionName', 'MesUnit', 'GuaranteeMesUnit',
+    'Description', 'WholesalePricePerUnit', 'SynchronizationSection', 'SynchronizationSectionFull',
+    'TheSize', 'PackSize', 'Season', 'Sex', 'GuaranteePeriod', 'Pack', 'Closeout', 'GoodPhotoList',
+    'GoodPhotoListWithLinks', 'RetailPriceWithDiscount', 'CurrencyPriceWholesale_4',
+    'CurrencyPriceRetail_4', 'RetailPricePerUnit', 'WholesalePrice', 'RetailPrice', 'Width', 'Barcode',
+    'CurrencyPriceWholesale_1', 'CurrencyPriceWholesale_3', 'CurrencyPriceRetail_1',
+    'CurrencyPriceRetail_3', 'hight_low_top', 'vyd_zastibky', 'toe', 'visibility_on_site',
+    'visota_kabluka', 'visota_platformi', 'visota_tanketki', 'visota_golenisha', 'dlina_stelki',
+    'material_verha', 'material_podkaldki', 'material_podoshvi', 'volume_in_bundles',
+    'objem_golenisha', 'pdgrupa', 'polnota', 'stil_obuvi', 'fason'
+]
+
+TYPES = ["Взуття/Жіноче/Туфлі", "Взуття/Жіноче/Чоботи", "Взуття/Чоловіче/Кросівки", "Взуття/Дитяче/Сандалі"]
+BRANDS = ["Lasocki", "Tamaris", "Rieker", "Ecco", "Geox", "Caprice"]
+COUNTRIES = ["Україна", "Польща", "Німеччина", "Італія", "Туреччина"]
+SEASONS = ["Весна-Осінь", "Літо", "Зима", "Демісезон"]
+COLORS = ["чорний", "бежевий", "білий", "коричневий", "червоний"]
+
+
+def feed_groups(rows, seed=1, change_ratio=0.0):
+    # Articul-группы по 1–8 размеров; change_ratio — доля групп с другими остатками/ценой
+    # (вторая выгрузка того же ассортимента для замера дельта-прохода)
+    rnd = random.Random(seed)
+    change = random.Random(seed * 7919 + 1)
+    made, model = 0, 0
+    while made < rows:
+        model += 1
+        n = min(rnd.randint(1, 8), rows - made)
+        first_size = rnd.randint(35, 45 - n)
+        price = rnd.randrange(900, 6000, 50)
+        discount = price - rnd.randrange(100, 600, 50) if rnd.random() < 0.3 else None
+        changed = change.random() < change_ratio
+        group = {
+            "model": model, "articul": f"{rnd.choice('ABCDEFKLMT')}{model:06d}",
+            "type": rnd.choice(TYPES), "brand": rnd.choice(BRANDS), "country": rnd.choice(COUNTRIES),
+            "season": rnd.choice(SEASONS), "color": rnd.choice(COLORS),
+            "visible": "1" if rnd.random() < 0.9 else "0",
+            "price": price + (100 if changed else 0), "discount": discount, "sizes": [],
+        }
+        for i in range(n):
+            qty = 0 if rnd.random() < 0.3 else rnd.randint(1, 6)
+            if changed:
+                qty = (qty + 1) % 7
+            group["sizes"].append({"good_id": model * 100 + i, "size": str(first_size + i), "qty": qty,
+                                   "barcode": f"48{model:08d}{i:02d}", "insole": f"{22.5 + (first_size + i - 35) * 0.5:.1f}"})
+        made += n
+        yield group
+
+
+def write_feed(path, rows, encoding="cp1251", seed=1, change_ratio=0.0):
+    col = {c: i for i, c in enumerate(TSGOODS_COLUMNS)}
+    with open(path, "w", encoding=encoding, newline="") as f:
+        w = csv.writer(f, delimiter=";", lineterminator="\r\n")
+        w.writerow(TSGOODS_COLUMNS)
+        for g in feed_groups(rows, seed, change_ratio):
+            for s in g["sizes"]:
+                r = [""] * len(TSGOODS_COLUMNS)
+                r[col["ModelGoodID"]] = str(g["model"])
+                r[col["GoodID"]] = str(s["good_id"])
+                r[col["Articul"]] = g["articul"]
+                r[col["GoodTypeName"]] = g["type"].rsplit("/", 1)[-1]
+                r[col["GoodTypeFull"]] = g["type"]
+                r[col["ProducerCollectionFull"]] = g["brand"]
+                r[col["Country"]] = g["country"]
+                r[col["Season"]] = g["season"]
+                r[col["Color"]] = g["color"]
+                r[col["Description"]] = f"{g['type'].rsplit('/', 1)[-1]} {g['brand']} {g['color']}"
+                r[col["GoodName"]] = r[col["Description"]]
+                r[col["TheSize"]] = s["size"]
+                r[col["WarehouseQuantity"]] = str(s["qty"])
+                r[col["Barcode"]] = s["barcode"]
+                r[col["RetailPrice"]] = str(g["price"])
+                r[col["RetailPriceWithDiscount"]] = str(g["discount"]) if g["discount"] else ""
+                r[col["visibility_on_site"]] = g["visible"]
+                r[col["dlina_stelki"]] = s["insole"]
+                r[col["Measure"]] = "пара"
+                w.writerow(r)
+
+
+def write_excel(path, rows, seed=1):
+    # хорошоп.xlsx: ключ «Articul-GoodID» в колонке 0, название в 6, картинки в 17
+    import openpyxl
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    rnd = random.Random(seed + 1)
+    for g in feed_groups(rows, seed):
+        if rnd.random() < 0.1:
+            continue   # часть товаров без карточки в Excel — как в жизни
+        row = [None] * 19
+        row[0] = f"{g['articul']}-{g['sizes'][0]['good_id']}"
+        row[6] = f"{g['brand']} {g['type'].rsplit('/', 1)[-1].lower()} {g['color']} {g['articul']}"
+        row[17] = ";".join(f"https://cdn.example.com/{g['articul']}/{i}.jpg" for i in range(rnd.randint(1, 4)))
+        ws.append(row)
+    wb.save(path)
+
+
+def ensure_inputs(rows, encoding):
+    os.makedirs(BENCH_DATA, exist_ok=True)
+    feed = os.path.join(BENCH_DATA, f"TSGoods-{rows}-{encoding}.trs")
+    feed2 = os.path.join(BENCH_DATA, f"TSGoods-{rows}-{encoding}-delta.trs")
+    excel = os.path.join(BENCH_DATA, f"horoshop-{rows}.xlsx")
+    if not os.path.exists(feed):
+        write_feed(feed, rows, encoding)
+    if not os.path.exists(feed2):
+        write_feed(feed2, rows, encoding, change_ratio=0.1)
+    if not os.path.exists(excel):
+        write_excel(excel, rows)
+    return feed, feed2, excel
+
+
+def start_ftp(root):
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    logging.getLogger("pyftpdlib").setLevel(logging.WARNING)
+    auth = DummyAuthorizer()
+    auth.add_user("bench", "bench", root, perm="elradfmw")
+    handler = type("BenchFTPHandler", (FTPHandler,), {"authorizer": auth})
+    server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, kwargs={"handle_exit": False}, daemon=True).start()
+    return server.socket.getsockname()[1]
+
+
+def start_mock_shopify(cfg):
+    from werkzeug.serving import make_server
+    import mock_shopify
+    store = mock_shopify.MockStore(latency=cfg["latency"], jitter=cfg["jitter"],
+                                   rest_rate=cfg["rest_rate"], graphql_rate=cfg["graphql_rate"])
+    server = make_server("127.0.0.1", 0, mock_shopify.create_app(store), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return store, server.server_port
+
+
+def run_stand(cfg):
+    # стенд сценария: печатает порты и работает, пока родитель не закроет stdin
+    sys.path.insert(0, BENCH_DIR)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    _, shop_port = start_mock_shopify(cfg)
+    ftp_port = start_ftp(cfg["ftp_root"])
+    print(json.dumps({"shop_port": shop_port, "ftp_port": ftp_port}), flush=True)
+    sys.stdin.read()
+
+
+def stand_stats(shop_port):
+    import httpx
+    return httpx.get(f"http://127.0.0.1:{shop_port}/_mock/stats", timeout=30).json()
+
+
+def run_child(cfg):
+    # один сценарий: окружение поднимается до импорта index, потому что конфиг читается при импорте
+    sys.path.insert(0, BENCH_DIR)
+    feed, feed2, excel = ensure_inputs(cfg["rows"], cfg["encoding"])
+    work = tempfile.mkdtemp(prefix="torgsoft-bench-")
+    ftp_root = os.path.join(work, "ftp")
+    os.makedirs(os.path.join(ftp_root, "csv_folder"))
+    data_dir = os.path.join(work, "data")
+    os.makedirs(data_dir)
+
+    stand = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--stand",
+                              json.dumps(dict(cfg, ftp_root=ftp_root))],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        ports = json.loads(stand.stdout.readline())
+        return run_scenario(cfg, feed, feed2, excel, ftp_root, data_dir, ports["shop_port"], ports["ftp_port"])
+    finally:
+        stand.stdin.close()
+        stand.wait(timeout=30)
+
+
+def run_scenario(cfg, feed, feed2, excel, ftp_root, data_dir, shop_port, ftp_port):
+    os.environ.update({
+        "SHOPIFY_API_BASE": f"http://127.0.0.1:{shop_port}", "SHOPIFY_STORE_URL": "bench",
+        "SHOPIFY_ACCESS_TOKEN": "bench", "LOCATION_ID": "1",
+        "FTP_HOST": "127.0.0.1", "FTP_PORT": str(ftp_port), "FTP_USER": "bench", "FTP_PASS": "bench",
+        "TORGSOFT_DATA_DIR": data_dir, "EXCEL_PATH": excel,
+        "SYNC_CONCURRENCY": str(cfg["concurrency"]), "FEED_STREAMING": "1" if cfg["streaming"] else "0",
+        "LOG_LEVEL": cfg["log_level"], "BULK_POLL_INTERVAL": "0.2",
+        # лимитер знает скорость восстановления ведра стенда, как знал бы тариф магазина
+        "SHOPIFY_REST_RATE": str(cfg["rest_rate"] or 1e6),
+    })
+    import index
+    index.log_stdout.flush()
+    index.log.removeHandler(index.log_stdout)   # лог остаётся в файле запуска, stdout — только результат
+    if index.get_excel_map() is None:
+        raise SystemExit("Excel-мапінг не завантажився")
+
+    client = index.app.test_client()
+    passes = []
+    for n, source in enumerate([feed, feed2][:cfg["passes"]]):
+        shutil.copy(source, os.path.join(ftp_root, "csv_folder", "TSGoods.trs"))
+        calls0 = stand_stats(shop_port)["total_calls"]
+        t0 = time.perf_counter()
+        # быстрый режим обновляет только уже созданные товары — каталог сначала наполняет обычный импорт
+        kind = "import" if cfg["kind"] == "import_stock" and n == 0 else cfg["kind"]
+        resp = client.post("/settings", data={"action": kind})
+        job_id = resp.headers["Location"].rsplit("job=", 1)[-1]
+        while True:
+            job = index.get_sync_job(job_id)
+            if job["status"] not in ("queued", "running"):
+                break
+            time.sleep(0.05)
+        wall = time.perf_counter() - t0
+        summary = job["summary"] or {}
+        groups = sum(summary.get(k, 0) for k in ("created", "updated", "unchanged", "unknown", "failed"))
+        written = summary.get("created", 0) + summary.get("updated", 0)
+        stats = stand_stats(shop_port)
+        calls = stats["total_calls"] - calls0
+        passes.append({
+            "pass": ("initial" if n == 0 else "delta") + ("*" if kind != cfg["kind"] else ""), "status": job["status"], "wall_s": round(wall, 2),
+            "groups": groups, "written": written, "failed": summary.get("failed", 0), "calls": calls,
+            "calls_per_product": round(calls / groups, 2) if groups else None,
+            "products_per_s": round(written / wall, 2) if wall else None,
+            "throttled": stats["throttled"],
+            "connects": (summary.get("connections") or {}).get("connects"),
+        })
+    return {"config": cfg, "passes": passes,
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+def print_table(results):
+    head = (f"{'rows':>7} {'kind':<12} {'conc':>4} {'pass':<8} {'status':<9} {'wall, s':>9} {'groups':>7} "
+            f"{'failed':>6} {'calls':>7} {'calls/prod':>10} {'prod/s':>8} {'429':>5} {'conns':>5} {'peak MB':>8}")
+    print(head)
+    print("-" * len(head))
+    for res in results:
+        cfg = res["config"]
+        for p in res["passes"]:
+            print(f"{cfg['rows']:>7} {cfg['kind']:<12} {cfg['concurrency']:>4} {p['pass']:<8} {p['status']:<9} "
+                  f"{p['wall_s']:>9} {p['groups']:>7} {p['failed']:>6} {p['calls']:>7} {str(p['calls_per_product']):>10} "
+                  f"{str(p['products_per_s']):>8} {p['throttled'].get('rest', 0):>5} {str(p['connects']):>5} {res['peak_rss_mb']:>8}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Бенчмарк синхронізації Торгсофт → Shopify на локальному стенді")
+    ap.add_argument("--rows", type=int, nargs="+", default=[1000], help="рядків у TSGoods.trs (1000 10000 100000)")
+    ap.add_argument("--kind", nargs="+", default=["import"], help="import / import_full / import_bulk / import_stock (початковий прохід — import, позначено *)")
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[4])
+    ap.add_argument("--passes", type=int, default=2, choices=(1, 2), help="2 — ще й дельта-прохід (10%% змін)")
+    ap.add_argument("--latency", type=float, default=0.08, help="затримка відповіді стенду, с")
+    ap.add_argument("--jitter", type=float, default=0.04)
+    ap.add_argument("--rest-rate", type=float, default=2.0, help="REST-запитів/с (0 — без ліміту)")
+    ap.add_argument("--graphql-rate", type=float, default=50.0, help="очок GraphQL/с (0 — без ліміту)")
+    ap.add_argument("--streaming", action="store_true", help="FEED_STREAMING=1")
+    ap.add_argument("--encoding", default="cp1251")
+    ap.add_argument("--log-level", default="INFO")
+    ap.add_argument("--json", help="зберегти результати у файл")
+    ap.add_argument("--child", help=argparse.SUPPRESS)
+    ap.add_argument("--stand", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.stand:
+        run_stand(json.loads(args.stand))
+        return
+    if args.child:
+        print(json.dumps(run_child(json.loads(args.child)), ensure_ascii=False))
+        return
+
+    results = []
+    for rows in args.rows:
+        ensure_inputs(rows, args.encoding)   # генерация не входит в замер
+        for kind in args.kind:
+            for conc in args.concurrency:
+                cfg = {"rows": rows, "kind": kind, "concurrency": conc, "passes": args.passes,
+                       "latency": args.latency, "jitter": args.jitter, "rest_rate": args.rest_rate,
+                       "graphql_rate": args.graphql_rate,
+                       "streaming": args.streaming, "encoding": args.encoding, "log_level": args.log_level}
+                print(f"▶ rows={rows} kind={kind} concurrency={conc} …", flush=True)
+                out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", json.dumps(cfg)],
+                                     capture_output=True, text=True)
+                if out.returncode != 0:
+                    print(out.stderr[-2000:], file=sys.stderr)
+                    continue
+                last = [l for l in out.stdout.splitlines() if l.startswith("{")][-1]
+                results.append(json.loads(last))
+    print()
+    print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
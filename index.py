@@ -1,30 +1,261 @@
 import json, os
+import time
+_import_t0 = time.time()
 import io
+import asyncio
+import threading
 import sys
-import time
 import csv
-import builtins
-from ftplib import FTP
-from flask import Flask, request, redirect, url_for, render_template_string, flash, Response
+import codecs
+import queue
+import hashlib
+import gzip
+import random
+import uuid
+import sqlite3
+import logging
+import logging.handlers
+from collections import deque
+import pickle
+from ftplib import FTP, error_perm
+from flask import Flask, request, redirect, url_for, render_template_string, flash, Response, jsonify
 import httpx
+import openpyxl
+import numpy as np
 import pandas as pd
+try:
+    import h2   # для HTTP/2 в httpx
+except ImportError:
+    h2 = None
+try:
+    # встроенный FTP-сервер, на который Торгсофт может выгружать файл напрямую
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    FTPHandler = None
 from httpx import Timeout
+from contextlib import contextmanager
 import re
 from zoneinfo import ZoneInfo
-from datetime import datetime
-
-
-# ——— Настраиваем “двойной” print — вывод в терминал и в буфер ———
-buf_stdout = io.StringIO()
-_original_print = builtins.print
-def print(*args, **kwargs):
-    # 1) в настоящий терминал
-    _original_print(*args, file=sys.__stdout__, **{k:v for k,v in kwargs.items() if k not in ("file",)})
-    # 2) в наш буфер
-    sep = kwargs.get("sep", " ")
-    end = kwargs.get("end", "\n")
-    buf_stdout.write(sep.join(str(a) for a in args) + end)
-builtins.print = print
+from datetime import datetime, timedelta, timezone
+
+
+# каталог для рабочих файлов (состояние, индекс, spool, логи) — можно вынести, например для бенчмарка
+DATA_DIR = os.getenv('TORGSOFT_DATA_DIR') or os.path.dirname(os.path.abspath(__file__))
+
+# ——— Логирование: уровни, кольцевой буфер для /report, буферизованный stdout и файл на каждый запуск ———
+LOG_LEVEL          = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_RING_SIZE      = int(os.getenv('LOG_RING_SIZE', '20000'))       # строк в памяти для /report
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', '2'))    # stdout сбрасываем пачкой не чаще
+LOG_DIR            = os.path.join(DATA_DIR, 'logs')
+LOG_KEEP_RUNS      = int(os.getenv('LOG_KEEP_RUNS', '20'))
+
+
+class RingBufferHandler(logging.Handler):
+    # последние LOG_RING_SIZE записей с порядковым номером — /report листает их без копии всего лога
+    def __init__(self, capacity):
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+        self.seq = 0
+
+    def emit(self, record):
+        self.seq += 1
+        self.records.append({"seq": self.seq, "ts": record.created, "level": record.levelname,
+                             "msg": self.format(record)})
+
+    def since(self, seq, min_level=logging.NOTSET):
+        with self.lock:
+            return [r for r in self.records
+                    if r["seq"] > seq and logging.getLevelName(r["level"]) >= min_level]
+
+
+class BufferedHandler(logging.handlers.MemoryHandler):
+    # копит записи и отдаёт их целевому handler пачкой: при заполнении, на ERROR или раз в интервал
+    def __init__(self, target, capacity=500):
+        super().__init__(capacity, flushLevel=logging.ERROR, target=target)
+        self.last_flush = time.time()
+
+    def shouldFlush(self, record):
+        return super().shouldFlush(record) or record.created - self.last_flush >= LOG_FLUSH_INTERVAL
+
+    def flush(self):
+        super().flush()
+        self.last_flush = time.time()
+
+
+log = logging.getLogger("torgsoft")
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+log_ring = RingBufferHandler(LOG_RING_SIZE)
+log_ring.setFormatter(logging.Formatter("%(message)s"))
+log.addHandler(log_ring)
+_stdout_handler = logging.StreamHandler(sys.stdout)
+_stdout_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(message)s"))
+log_stdout = BufferedHandler(_stdout_handler)
+log.addHandler(log_stdout)
+
+
+def begin_run_log(job):
+    # отдельный файл на каждый запуск + отметка начала запуска в кольцевом буфере
+    os.makedirs(LOG_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(LOG_DIR, f"sync-{stamp}-{job['kind']}-{job['id']}.log")
+    file_handler = logging.FileHandler(path, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(message)s"))
+    handler = BufferedHandler(file_handler)
+    log.addHandler(handler)
+    app.config["LAST_RUN"] = {"job_id": job["id"], "kind": job["kind"], "first_seq": log_ring.seq + 1,
+                              "log_file": path, "started_at": time.time(), "finished_at": None}
+    prune_run_logs()
+    return handler
+
+
+def end_run_log(handler):
+    log.removeHandler(handler)
+    target = handler.target
+    handler.close()
+    target.close()
+    log_stdout.flush()
+    app.config["LAST_RUN"]["finished_at"] = time.time()
+
+
+def prune_run_logs():
+    files = sorted(f for f in os.listdir(LOG_DIR) if f.startswith("sync-") and f.endswith(".log"))
+    for f in files[:-LOG_KEEP_RUNS]:
+        try:
+            os.remove(os.path.join(LOG_DIR, f))
+        except OSError:
+            pass
+# —————————————————————————————————————————————————————————————
+
+# ——— Метрики в текстовом формате Prometheus (/metrics) ———
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        METRICS.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(l, "")) for l in self.labels)
+
+    def fmt(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                out.extend(self.samples(key, value))
+        return out
+
+    def samples(self, key, value):
+        return [f"{self.name}{self.fmt(key)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            h = self.values.get(key)
+            if h is None:
+                h = self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, le in enumerate(self.buckets):
+                if value <= le:
+                    h["counts"][i] += 1
+            h["sum"] += value
+            h["count"] += 1
+
+    def samples(self, key, h):
+        out = [f"{self.name}_bucket{self.fmt(key, [('le', le)])} {c}" for le, c in zip(self.buckets, h["counts"])]
+        out.append(f"{self.name}_bucket{self.fmt(key, [('le', '+Inf')])} {h['count']}")
+        out.append(f"{self.name}_sum{self.fmt(key)} {h['sum']:.6f}")
+        out.append(f"{self.name}_count{self.fmt(key)} {h['count']}")
+        return out
+
+
+METRICS = []
+SHOPIFY_REQUESTS = Counter("torgsoft_shopify_requests_total", "Запити до Shopify Admin API",
+                           ("endpoint", "method", "status"))
+SHOPIFY_LATENCY = Histogram("torgsoft_shopify_request_seconds", "Тривалість запиту до Shopify",
+                            ("endpoint", "method"), buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32))
+SHOPIFY_RETRIES = Counter("torgsoft_shopify_retries_total", "Повтори запитів через 429/5xx/409/THROTTLED",
+                          ("reason",))
+SHOPIFY_CONNECTIONS = Counter("torgsoft_shopify_connections_total",
+                              "Нові з'єднання з Shopify (connect — TCP, tls — рукостискання)", ("event",))
+SHOPIFY_HTTP_VERSIONS = Counter("torgsoft_shopify_http_responses_total", "Відповіді Shopify за версією HTTP",
+                                ("version",))
+SHOPIFY_BUDGET = Gauge("torgsoft_shopify_budget_available",
+                       "Вільне місце у відрі лімітів Shopify (REST — запити, GraphQL — очки вартості)", ("api",))
+SHOPIFY_THROTTLE_SLEEP = Counter("torgsoft_shopify_throttle_sleep_seconds_total",
+                                 "Час очікування в лімітері та паузах перед повтором", ("reason",))
+SYNC_PHASE_SECONDS = Histogram("torgsoft_sync_phase_seconds", "Тривалість етапів синхронізації", ("phase",),
+                               buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900, 1800, 3600, 7200))
+SYNC_PRODUCT_SECONDS = Histogram("torgsoft_sync_product_seconds", "Запис однієї Articul-групи в Shopify",
+                                 buckets=(0.25, 0.5, 1, 2, 4, 8, 16, 32, 64))
+SYNC_PRODUCTS = Counter("torgsoft_sync_products_total", "Оброблені Articul-групи за результатом", ("result",))
+SYNC_PRODUCTS_PER_MINUTE = Gauge("torgsoft_sync_products_per_minute", "Швидкість останнього запуску", ("engine",))
+SYNC_RUNS = Counter("torgsoft_sync_runs_total", "Завершені запуски синхронізації", ("kind", "status"))
+FTP_BYTES = Counter("torgsoft_ftp_bytes_downloaded_total", "Байти, завантажені з FTP")
+
+
+def render_metrics():
+    lines = []
+    for m in METRICS:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+def endpoint_label(url):
+    # /admin/api/2024-01/products/123.json → products/:id.json — без взрыва кардинальности
+    path = httpx.URL(url).path
+    path = re.sub(r"^/admin/api/[^/]+/", "", path)
+    return re.sub(r"\d+", ":id", path)
+
+
+def observe_shopify_call(method, url, resp, seconds):
+    endpoint = endpoint_label(url)
+    SHOPIFY_REQUESTS.inc(endpoint=endpoint, method=method, status=resp.status_code)
+    SHOPIFY_HTTP_VERSIONS.inc(version=resp.http_version)
+    SHOPIFY_LATENCY.observe(seconds, endpoint=endpoint, method=method)
+
+
+@contextmanager
+def timed_phase(phase):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        SYNC_PHASE_SECONDS.observe(time.perf_counter() - t0, phase=phase)
 # —————————————————————————————————————————————————————————————
 
 app = Flask(__name__)
@@ -35,17 +266,94 @@ SHOP_NAME     = os.getenv('SHOPIFY_STORE_URL')
 API_TOKEN     = os.getenv('SHOPIFY_ACCESS_TOKEN')
 API_VERSION   = "2024-01"
 LOCATION_ID   = os.getenv('LOCATION_ID')
+# SHOPIFY_API_BASE позволяет направить все запросы на локальный стенд (mock_shopify.py)
+SHOP_URL      = os.getenv('SHOPIFY_API_BASE') or f"https://{SHOP_NAME}.myshopify.com"
+API_URL       = f"{SHOP_URL}/admin/api/{API_VERSION}"
+# productSet и bulk-мутации доступны только в новых версиях GraphQL API
+GRAPHQL_API_VERSION = "2024-10"
+GRAPHQL_URL   = f"{SHOP_URL}/admin/api/{GRAPHQL_API_VERSION}/graphql.json"
+BULK_POLL_INTERVAL  = float(os.getenv('BULK_POLL_INTERVAL', '5'))
+# сколько ждём bulk-операцию целиком и сколько неудачных опросов подряд терпим; дальше — отмена операции,
+# а результат по товарам считается неизвестным (не ошибкой): следующий запуск отправит их заново
+BULK_POLL_TIMEOUT   = float(os.getenv('BULK_POLL_TIMEOUT', '3600'))
+BULK_POLL_RETRIES   = int(os.getenv('BULK_POLL_RETRIES', '3'))
+BULK_JSONL_FILE     = os.path.join(DATA_DIR, 'bulk_op_vars.jsonl')
 
 FTP_HOST      = os.getenv('FTP_HOST')
+FTP_PORT      = int(os.getenv('FTP_PORT', '21'))
 FTP_USER      = os.getenv('FTP_USER')
 FTP_PASS      = os.getenv('FTP_PASS')
 FTP_FILE_PATH = "/csv_folder/TSGoods.trs"
+# потоковый режим: группы Articul уходят в Shopify, пока файл ещё качается
+FEED_STREAMING  = os.getenv('FEED_STREAMING', '0') == '1'
+FEED_SPOOL_FILE = os.path.join(DATA_DIR, 'TSGoods.spool')
+FTP_TIMEOUT     = float(os.getenv('FTP_TIMEOUT', '60'))
+# встроенный FTP-приёмник (0 — выключен): Торгсофт выгружает файл прямо сюда, синхронизация стартует по
+# окончании загрузки и читает файл с локального диска вместо внешнего FTP
+FTP_RECEIVER_PORT  = int(os.getenv('FTP_RECEIVER_PORT', '0'))
+FTP_RECEIVER_HOST  = os.getenv('FTP_RECEIVER_HOST', '0.0.0.0')
+FTP_RECEIVER_USER  = os.getenv('FTP_RECEIVER_USER') or FTP_USER
+FTP_RECEIVER_PASS  = os.getenv('FTP_RECEIVER_PASS') or FTP_PASS
+FTP_RECEIVER_DIR   = os.getenv('FTP_RECEIVER_DIR') or os.path.join(DATA_DIR, 'ftp_inbox')
+FTP_RECEIVER_KIND  = os.getenv('FTP_RECEIVER_KIND', 'import')
+# пассивный режим за NAT/в контейнере: диапазон портов «60000-60010» и внешний адрес
+FTP_RECEIVER_PASSIVE_PORTS = os.getenv('FTP_RECEIVER_PASSIVE_PORTS', '')
+FTP_RECEIVER_MASQUERADE    = os.getenv('FTP_RECEIVER_MASQUERADE') or None
 
 POSSIBLE_OPTIONS = ["TheSize", "dlina_stelki", "objem_golenisha"]
-MIN_INTERVAL     = 0.5
-_last_call       = 0.0
-
-EXCEL_PATH = os.path.join(os.path.dirname(__file__), "хорошоп.xlsx")
+# лимитер запросов к Shopify: модель leaky bucket, которую каждый ответ подправляет по
+# X-Shopify-Shop-Api-Call-Limit (REST) и throttleStatus (GraphQL); размер ведра приходит в ответах,
+# скорость восстановления REST зависит от тарифа (Shopify Plus — 20/с)
+SHOPIFY_REST_BUCKET  = int(os.getenv('SHOPIFY_REST_BUCKET', '40'))
+SHOPIFY_REST_RATE    = float(os.getenv('SHOPIFY_REST_RATE', '2'))
+SHOPIFY_MAX_RETRIES  = int(os.getenv('SHOPIFY_MAX_RETRIES', '5'))
+SHOPIFY_BACKOFF_BASE = float(os.getenv('SHOPIFY_BACKOFF_BASE', '0.5'))
+SHOPIFY_BACKOFF_MAX  = float(os.getenv('SHOPIFY_BACKOFF_MAX', '30'))
+GRAPHQL_DEFAULT_COST = 10
+# общий на процесс пул соединений с Shopify
+SHOPIFY_HTTP2            = os.getenv('SHOPIFY_HTTP2', '1') == '1'
+SHOPIFY_MAX_CONNECTIONS  = int(os.getenv('SHOPIFY_MAX_CONNECTIONS', '8'))
+SHOPIFY_KEEPALIVE_EXPIRY = float(os.getenv('SHOPIFY_KEEPALIVE_EXPIRY', '300'))
+_clients      = {"sync": None, "async": None, "loop": None}
+# запись трафика Shopify для профилирования: каждый запуск — gzip-JSONL в SHOPIFY_RECORD_DIR (токены и подписи
+# вырезаны); SHOPIFY_REPLAY — такая лента вместо сети, задержки — записанные × SHOPIFY_REPLAY_LATENCY (0 — без них)
+SHOPIFY_RECORD_DIR     = os.getenv('SHOPIFY_RECORD_DIR') or None
+SHOPIFY_REPLAY         = os.getenv('SHOPIFY_REPLAY') or None
+SHOPIFY_REPLAY_LATENCY = float(os.getenv('SHOPIFY_REPLAY_LATENCY', '1'))
+_clients_lock = threading.Lock()
+# сколько Articul-групп обрабатывать параллельно (1 — прежний последовательный режим)
+SYNC_CONCURRENCY = int(os.getenv('SYNC_CONCURRENCY', '4'))
+# сколько позиций остатков отправлять одним inventorySetQuantities (Shopify принимает до 250)
+INVENTORY_BATCH_SIZE = max(1, min(250, int(os.getenv('INVENTORY_BATCH_SIZE', '250'))))
+# быстрый режим «залишки і ціни»: из фида нужны только эти колонки; цены уходят productVariantsBulkUpdate,
+# по PRICE_BATCH_SIZE товаров одним запросом
+STOCK_COLUMNS    = ("Articul", "TheSize", "Barcode", "WarehouseQuantity", "RetailPrice", "RetailPriceWithDiscount")
+STOCK_IDX        = {c: i for i, c in enumerate(STOCK_COLUMNS)}
+PRICE_BATCH_SIZE = max(1, int(os.getenv('PRICE_BATCH_SIZE', '25')))
+# остатки в индексе — то, что записало это приложение; заказы и правки в админке их не меняют. Перед сравнением
+# быстрый режим перечитывает текущие остатки из Shopify — по STOCK_REFRESH_BATCH позиций одним запросом
+# (STOCK_REFRESH=0 — доверять индексу)
+STOCK_REFRESH       = os.getenv('STOCK_REFRESH', '1') == '1'
+STOCK_REFRESH_BATCH = max(1, min(250, int(os.getenv('STOCK_REFRESH_BATCH', '100'))))
+# автозапуск: опрос FTP (SIZE/MDTM) раз в SYNC_WATCH_INTERVAL секунд (0 — выключен); новый файл считается
+# дописанным, когда SIZE и MDTM не менялись SYNC_WATCH_DEBOUNCE секунд
+SYNC_WATCH_INTERVAL = float(os.getenv('SYNC_WATCH_INTERVAL', '0'))
+SYNC_WATCH_DEBOUNCE = float(os.getenv('SYNC_WATCH_DEBOUNCE', '60'))
+SYNC_WATCH_KIND     = os.getenv('SYNC_WATCH_KIND', 'import')
+# расписание через запятую: «03:00=import_full» — каждый день в HH:MM, «*/15=import_stock» — каждые N минут
+SYNC_SCHEDULE  = os.getenv('SYNC_SCHEDULE', '')
+SCHEDULER_TZ   = ZoneInfo("Europe/Kyiv")
+SCHEDULER_TICK = 5
+# сколько групп максимум разбирать одной пачкой pandas (цены, скидки, остатки, опции)
+PREPROCESS_CHUNK_GROUPS = int(os.getenv('PREPROCESS_CHUNK_GROUPS', '2048'))
+
+EXCEL_PATH = os.getenv('EXCEL_PATH') or os.path.join(os.path.dirname(__file__), "хорошоп.xlsx")
+# скомпилированный мапинг: {"mtime_ns", "size", "sha1", "mapping"}; пересобирается при смене файла
+EXCEL_CACHE_FILE = os.path.join(DATA_DIR, "excel_map.pickle")
+EXCEL_CACHE_VERSION = 1
+# как часто фоновый поток проверяет mtime книги и сколько синхронизация ждёт первой загрузки
+EXCEL_WATCH_INTERVAL = float(os.getenv('EXCEL_WATCH_INTERVAL', '30'))
+EXCEL_WAIT_TIMEOUT   = float(os.getenv('EXCEL_WAIT_TIMEOUT', '300'))
 
 # дефолтные настройки
 DEFAULT_SYNC_SETTINGS = {
@@ -54,7 +362,12 @@ DEFAULT_SYNC_SETTINGS = {
     "update_description": True,
 }
 
-SETTINGS_FILE = os.path.join(os.path.dirname(__file__), 'sync_settings.json')
+SETTINGS_FILE = os.path.join(DATA_DIR, 'sync_settings.json')
+# отпечатки последних успешно синхронизированных групп (Articul → sha1)
+SYNC_STATE_FILE = os.path.join(DATA_DIR, 'sync_state.json')
+# локальный индекс handle/Articul → ID товара, вариантов и inventory_item
+SHOPIFY_INDEX_DB = os.path.join(DATA_DIR, 'shopify_index.sqlite3')
+SHOPIFY_INDEX_MAX_AGE_HOURS = float(os.getenv('SHOPIFY_INDEX_MAX_AGE_HOURS', '24'))
 
 
 # Попытка загрузить сохранённые настройки из файла
@@ -65,64 +378,960 @@ except FileNotFoundError:
     with open(SETTINGS_FILE, 'w') as f:
         json.dump(DEFAULT_SYNC_SETTINGS, f, indent=2)
 except Exception as e:
-    print("⚠️ Не удалось прочитать sync_settings.json:", e, flush=True)
+    log.warning("⚠️ Не удалось прочитать sync_settings.json: %s", e)
 
 app.config["SYNC_SETTINGS"] = DEFAULT_SYNC_SETTINGS.copy()
 
 
+def file_sha1(path):
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cell_str(v):
+    # как pd.read_excel(dtype=str).fillna("")
+    return "" if v is None else str(v)
+
+
+def compile_excel_mapping(path):
+    # read-only openpyxl: лист читается построчно, берём только колонки 0, 6, 17 и 18
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        mapping = {}
+        for row in wb.worksheets[0].iter_rows(max_col=19, values_only=True):
+            row = tuple(row) + (None,) * (19 - len(row))
+            key = cell_str(row[0]).strip()
+            if not key:
+                continue
+            title    = cell_str(row[6]).strip()
+            img_cell = cell_str(row[17]).strip() or cell_str(row[18]).strip()
+            urls     = [u.strip() for u in img_cell.replace("\n", ";").split(";") if u.strip()]
+            mapping[key] = {"title": title, "images": urls}
+        return mapping
+    finally:
+        wb.close()
+
+
 def load_excel_mapping():
-    print(f"📥 Завантажуємо Excel-мапінг з {EXCEL_PATH}", flush=True)
-    df = pd.read_excel(EXCEL_PATH, header=None, dtype=str, engine="openpyxl").fillna("")
-    mapping = {}
-    for _, row in df.iterrows():
-        key = row[0].strip()
-        if not key:
-            continue
-        title    = row[6].strip()
-        img_cell = row[17].strip() or row[18].strip()
-        urls     = [u.strip() for u in img_cell.replace("\n", ";").split(";") if u.strip()]
-        mapping[key] = {"title": title, "images": urls}
-    print(f"✅ Excel-мапінг завантажено: {len(mapping)} записей", flush=True)
+    log.info(f"📥 Завантажуємо Excel-мапінг з {EXCEL_PATH}")
+    t0 = time.time()
+    st = os.stat(EXCEL_PATH)
+    try:
+        with open(EXCEL_CACHE_FILE, "rb") as f:
+            cache = pickle.load(f)
+        if cache.get("version") != EXCEL_CACHE_VERSION:
+            cache = {}
+    except FileNotFoundError:
+        cache = {}
+    except Exception as e:
+        log.warning("⚠️ Кеш Excel-мапінгу пошкоджений, перебудовуємо: %s", e)
+        cache = {}
+
+    # mtime+size совпали — хеш не считаем; иначе сверяем sha1 (файл могли просто перезаписать)
+    sha1 = None
+    if cache and (cache["mtime_ns"], cache["size"]) != (st.st_mtime_ns, st.st_size):
+        sha1 = file_sha1(EXCEL_PATH)
+        if sha1 != cache["sha1"]:
+            cache = {}
+    if cache:
+        mapping = cache["mapping"]
+        log.info(f"✅ Excel-мапінг з кешу: {len(mapping)} записей за {time.time() - t0:.3f}s")
+        if sha1:
+            cache.update(mtime_ns=st.st_mtime_ns, size=st.st_size)
+            save_excel_cache(cache)
+        return mapping
+
+    mapping = compile_excel_mapping(EXCEL_PATH)
+    save_excel_cache({"version": EXCEL_CACHE_VERSION, "mtime_ns": st.st_mtime_ns, "size": st.st_size,
+                      "sha1": sha1 or file_sha1(EXCEL_PATH), "mapping": mapping})
+    log.info(f"✅ Excel-мапінг завантажено: {len(mapping)} записей за {time.time() - t0:.1f}s")
     return mapping
 
-EXCEL_MAP = load_excel_mapping()
 
-def shopify_request(client: httpx.Client, method: str, url: str, max_retries: int = 3, **kwargs):
+def save_excel_cache(cache):
+    tmp = EXCEL_CACHE_FILE + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, EXCEL_CACHE_FILE)
+    except OSError as e:
+        log.warning("⚠️ Не вдалося зберегти кеш Excel-мапінгу: %s", e)
+
+# ——— Excel-мапинг грузится в фоне и подменяется целиком при изменении файла ———
+_excel = {
+    "state": "loading",      # loading → ready | error (прежний мапинг при ошибке перезагрузки остаётся)
+    "map": None,
+    "error": None,
+    "mtime_ns": None,
+    "loaded_at": None,
+    "load_seconds": None,
+    "reloads": 0,
+}
+_excel_lock = threading.Lock()
+_excel_ready = threading.Event()     # выставляется после первой попытки загрузки
+_excel_loader = None
 
-    global _last_call
 
-    for attempt in range(1, max_retries + 1):
-        # 1) throttle по MIN_INTERVAL
-        now = time.time()
-        if now - _last_call < MIN_INTERVAL:
-            time.sleep(MIN_INTERVAL - (now - _last_call))
-
-        resp = client.request(method, url, **kwargs)
-        _last_call = time.time()
-
-        # 2) rate-limit
-        if resp.status_code == 429:
-            retry_after = int(resp.headers.get("Retry-After", "2"))
-            print(f"⚠️ 429 от Shopify, ждём {retry_after}s… (попытка {attempt}/{max_retries})", flush=True)
-            time.sleep(retry_after)
-            continue
+def excel_mtime():
+    try:
+        return os.stat(EXCEL_PATH).st_mtime_ns
+    except OSError:
+        return None
 
-        # 3) продукт занят
-        if resp.status_code == 409:
-            try:
-                errors = resp.json().get("errors", {}).get("product", [])
-            except ValueError:
-                errors = []
-            if errors and errors[0].startswith("This product is currently being modified"):
-                wait = 0.5 * attempt
-                print(f"⚠️ Продукт занят, retry #{attempt} через {wait}s", flush=True)
-                time.sleep(wait)
-                continue
 
-        # 4) всё остальное — возвращаем ответ
+def reload_excel_mapping():
+    mtime = excel_mtime()
+    t0 = time.time()
+    try:
+        mapping = load_excel_mapping()
+    except Exception as e:
+        log.error(f"❌ Excel-мапінг не завантажено: {type(e).__name__}: {e}")
+        with _excel_lock:
+            _excel.update(state="ready" if _excel["map"] is not None else "error",
+                          error=f"{type(e).__name__}: {e}", mtime_ns=mtime)
+        return False
+    with _excel_lock:
+        _excel["reloads"] += _excel["map"] is not None
+        _excel.update(state="ready", map=mapping, error=None, mtime_ns=mtime,
+                      loaded_at=time.time(), load_seconds=round(time.time() - t0, 3))
+    return True
+
+
+def _excel_loader_loop():
+    reload_excel_mapping()
+    _excel_ready.set()
+    while True:
+        time.sleep(EXCEL_WATCH_INTERVAL)
+        mtime = excel_mtime()
+        if mtime is not None and mtime != _excel["mtime_ns"]:
+            log.info("🔁 хорошоп.xlsx змінився — перезавантажуємо Excel-мапінг")
+            reload_excel_mapping()
+
+
+def start_excel_loader():
+    # идемпотентно: после fork воркера поток запускается заново при первом обращении
+    global _excel_loader
+    with _excel_lock:
+        if _excel_loader is None or not _excel_loader.is_alive():
+            _excel_loader = threading.Thread(target=_excel_loader_loop, name="excel-loader", daemon=True)
+            _excel_loader.start()
+
+
+def get_excel_map(timeout=EXCEL_WAIT_TIMEOUT):
+    # текущий мапинг (снимок — перезагрузка его не меняет) или None, если загрузить не удалось
+    start_excel_loader()
+    _excel_ready.wait(timeout)
+    return _excel["map"]
+
+
+def excel_status():
+    with _excel_lock:
+        return {k: v for k, v in _excel.items() if k != "map"} | {
+            "entries": len(_excel["map"]) if _excel["map"] is not None else 0}
+
+
+start_excel_loader()
+
+
+def load_sync_state():
+    try:
+        with open(SYNC_STATE_FILE, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {"fingerprints": {}}
+    except Exception as e:
+        log.warning("⚠️ Не вдалося прочитати sync_state.json: %s", e)
+        return {"fingerprints": {}}
+    state.setdefault("fingerprints", {})
+    return state
+
+
+def save_sync_state(state):
+    # пишем через временный файл, чтобы не оставить битый json при падении
+    tmp = SYNC_STATE_FILE + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, SYNC_STATE_FILE)
+
+
+def index_connect():
+    # соединение прогона переходит из потока задачи в общий event loop и обратно — по очереди, не одновременно
+    conn = sqlite3.connect(SHOPIFY_INDEX_DB, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS products (
+            product_id INTEGER PRIMARY KEY,
+            handle     TEXT UNIQUE,
+            articul    TEXT
+        );
+        CREATE INDEX IF NOT EXISTS products_articul ON products(articul);
+        CREATE TABLE IF NOT EXISTS variants (
+            variant_id        INTEGER PRIMARY KEY,
+            product_id        INTEGER NOT NULL,
+            inventory_item_id INTEGER,
+            option1           TEXT,
+            sku               TEXT,
+            barcode           TEXT
+        );
+        CREATE INDEX IF NOT EXISTS variants_product ON variants(product_id);
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """)
+    # v1: последнее известное состояние вариантов и метафилдов — для планировщика записей
+    if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(variants)")}
+        with conn:
+            for col, typ in (("price", "TEXT"), ("compare_at_price", "TEXT"), ("inventory_quantity", "INTEGER")):
+                if col not in cols:
+                    conn.execute(f"ALTER TABLE variants ADD COLUMN {col} {typ}")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS metafields (
+                    product_id INTEGER NOT NULL,
+                    key        TEXT NOT NULL,
+                    value      TEXT,
+                    PRIMARY KEY (product_id, key)
+                )
+            """)
+            conn.execute("PRAGMA user_version = 1")
+    # v2: журнал завершённых Articul-групп для продолжения прерванного прогона
+    if conn.execute("PRAGMA user_version").fetchone()[0] < 2:
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sync_journal (
+                    feed_key    TEXT NOT NULL,
+                    articul     TEXT NOT NULL,
+                    product_id  INTEGER,
+                    variant_ids TEXT,
+                    fingerprint TEXT,
+                    done_at     REAL NOT NULL,
+                    PRIMARY KEY (feed_key, articul)
+                )
+            """)
+            conn.execute("PRAGMA user_version = 2")
+    # v3: исходный URL картинки (из Excel) → image_id в Shopify, чтобы не слать images при каждом PUT
+    if conn.execute("PRAGMA user_version").fetchone()[0] < 3:
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS images (
+                    product_id INTEGER NOT NULL,
+                    src        TEXT NOT NULL,
+                    image_id   INTEGER NOT NULL,
+                    PRIMARY KEY (product_id, src)
+                )
+            """)
+            conn.execute("PRAGMA user_version = 3")
+    return conn
+
+
+def index_lookup(conn, handle=None, articul=None):
+    if handle is not None:
+        row = conn.execute("SELECT * FROM products WHERE handle = ?", (handle,)).fetchone()
+    else:
+        row = conn.execute("SELECT * FROM products WHERE articul = ?", (articul,)).fetchone()
+    if row is None:
+        return None
+    variants = conn.execute(
+        "SELECT * FROM variants WHERE product_id = ? ORDER BY rowid", (row["product_id"],)).fetchall()
+    return {
+        "id": row["product_id"],
+        "handle": row["handle"],
+        "articul": row["articul"],
+        "variants": [{"id": v["variant_id"], "inventory_item_id": v["inventory_item_id"],
+                      "option1": v["option1"], "sku": v["sku"], "barcode": v["barcode"],
+                      "price": v["price"], "compare_at_price": v["compare_at_price"],
+                      "inventory_quantity": v["inventory_quantity"]} for v in variants],
+    }
+
+
+def index_store_product(conn, prod, articul=None):
+    # prod — объект product из ответа Shopify (create/update/list)
+    pid = prod["id"]
+    variants = prod.get("variants") or []
+    if articul is None:
+        articul = next((v.get("sku") for v in variants if v.get("sku")), None)
+    with conn:
+        _index_write_product(conn, pid, prod.get("handle"), articul, variants)
+
+
+def _index_write_product(conn, pid, handle, articul, variants):
+    # без commit — вызывающий держит транзакцию
+    conn.execute("DELETE FROM products WHERE handle = ? AND product_id != ?", (handle, pid))
+    conn.execute("INSERT OR REPLACE INTO products (product_id, handle, articul) VALUES (?, ?, ?)",
+                 (pid, handle, articul))
+    if variants:
+        # остатков может не быть в ответе (GraphQL) — тогда сохраняем прежние
+        old_qty = dict(conn.execute("SELECT variant_id, inventory_quantity FROM variants WHERE product_id = ?",
+                                    (pid,)).fetchall())
+        conn.execute("DELETE FROM variants WHERE product_id = ?", (pid,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO variants (variant_id, product_id, inventory_item_id, option1, sku, barcode,"
+            " price, compare_at_price, inventory_quantity) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(v["id"], pid, v.get("inventory_item_id"), v.get("option1"), v.get("sku"), v.get("barcode"),
+              v.get("price"), v.get("compare_at_price"), v.get("inventory_quantity", old_qty.get(v["id"])))
+             for v in variants])
+
+
+def index_set_quantities(conn, items):
+    # items: [(inventory_item_id, quantity)] — то, что Shopify подтвердил
+    with conn:
+        conn.executemany("UPDATE variants SET inventory_quantity = ? WHERE inventory_item_id = ?",
+                         [(q, iid) for iid, q in items])
+
+
+def index_set_prices(conn, items):
+    # items: [{"id": variant_id, "price"?, "compare_at_price"?}] — только поля, которые Shopify принял
+    with conn:
+        for v in items:
+            for col in ("price", "compare_at_price"):
+                if col in v:
+                    conn.execute(f"UPDATE variants SET {col} = ? WHERE variant_id = ?", (v[col], v["id"]))
+
+
+def index_get_metafields(conn, pid):
+    return dict(conn.execute("SELECT key, value FROM metafields WHERE product_id = ?", (pid,)).fetchall())
+
+
+def index_set_metafields(conn, items):
+    # items: [(product_id, key, value)]
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO metafields (product_id, key, value) VALUES (?, ?, ?)", items)
+
+
+def index_get_images(conn, pid):
+    return dict(conn.execute("SELECT src, image_id FROM images WHERE product_id = ?", (pid,)).fetchall())
+
+
+def index_set_images(conn, pid, items, replace=False):
+    # items: [(src, image_id)]; replace — картинки товара целиком заменены
+    with conn:
+        if replace:
+            conn.execute("DELETE FROM images WHERE product_id = ?", (pid,))
+        conn.executemany("INSERT OR REPLACE INTO images (product_id, src, image_id) VALUES (?, ?, ?)",
+                         [(pid, src, image_id) for src, image_id in items])
+
+
+def index_drop_image(conn, pid, src):
+    with conn:
+        conn.execute("DELETE FROM images WHERE product_id = ? AND src = ?", (pid, src))
+
+
+def index_drop_product(conn, pid):
+    with conn:
+        conn.execute("DELETE FROM variants WHERE product_id = ?", (pid,))
+        conn.execute("DELETE FROM metafields WHERE product_id = ?", (pid,))
+        conn.execute("DELETE FROM images WHERE product_id = ?", (pid,))
+        conn.execute("DELETE FROM products WHERE product_id = ?", (pid,))
+
+
+def journal_key(export, config_sig):
+    # журнал привязан к выгрузке и настройкам. Ключ — всегда SIZE/MDTM, если MDTM известен: в потоковом
+    # режиме sha1 появляется, только когда spool докачан, и прерванный и продолжающий прогоны получили бы
+    # разные ключи (а journal_open стёр бы журнал). sha1 — только для FTP без MDTM
+    if not export:
+        return None
+    ident = f"{export.get('size')}:{export['mdtm']}" if export.get("mdtm") else export.get("sha1")
+    if not ident:
+        return None
+    return hashlib.sha1(f"{ident}\x1f{config_sig}".encode("utf-8")).hexdigest()
+
+
+def journal_open(conn, key):
+    # {Articul: отпечаток} уже завершённых групп этой выгрузки; журналы других выгрузок
+    # и полностью пройденный журнал этой же (повторный запуск вручную) начинаем заново
+    row = conn.execute("SELECT value FROM meta WHERE key = 'journal_complete'").fetchone()
+    with conn:
+        conn.execute("DELETE FROM sync_journal WHERE feed_key != ?", (key,))
+        if row is not None:
+            conn.execute("DELETE FROM sync_journal")
+            conn.execute("DELETE FROM meta WHERE key = 'journal_complete'")
+    return dict(conn.execute("SELECT articul, fingerprint FROM sync_journal WHERE feed_key = ?", (key,)).fetchall())
+
+
+def journal_record(conn, key, sku, fingerprint):
+    prod = index_lookup(conn, articul=sku)
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO sync_journal (feed_key, articul, product_id, variant_ids, fingerprint, done_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (key, sku, prod and prod["id"], prod and json.dumps([v["id"] for v in prod["variants"]]),
+             fingerprint, time.time()))
+
+
+def journal_forget(conn, key, sku):
+    with conn:
+        conn.execute("DELETE FROM sync_journal WHERE feed_key = ? AND articul = ?", (key, sku))
+
+
+def journal_finish(conn, key):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('journal_complete', ?)", (key,))
+
+
+def index_is_stale(conn):
+    row = conn.execute("SELECT value FROM meta WHERE key = 'rebuilt_at'").fetchone()
+    if row is None:
+        return True
+    return time.time() - float(row["value"]) > SHOPIFY_INDEX_MAX_AGE_HOURS * 3600
+
+
+def ensure_fresh_index(client, conn):
+    # прогон с несобранным индексом не продолжаем: каждая группа ушла бы в POST как новый товар
+    if not index_is_stale(conn):
+        return
+    with timed_phase("index_rebuild"):
+        if not rebuild_shopify_index(client, conn):
+            conn.close()
+            raise RuntimeError("не вдалося перебудувати індекс товарів Shopify — синхронізацію зупинено")
+
+
+def rebuild_shopify_index(client, conn):
+    # одна постраничная выгрузка всех товаров вместо GET по handle на каждый SKU
+    log.info("🗂️ Перебудовуємо локальний індекс товарів Shopify…")
+    url = f"{API_URL}/products.json"
+    params = {"limit": 250, "fields": "id,handle,variants"}
+    # сначала вся выгрузка, потом замена одной транзакцией: оборванная выгрузка оставляет прежний индекс,
+    # а не пустой, по которому каждый товар создавался бы заново
+    products = []
+    while url:
+        resp = shopify_request(client, "GET", url, params=params)
+        if resp.status_code >= 300:
+            log.error(f"❌ Помилка вивантаження товарів для індексу: {resp.text}")
+            return False
+        products.extend(resp.json().get("products", []))
+        # дальше идём по ссылке page_info из заголовка Link
+        url = resp.links.get("next", {}).get("url")
+        params = None
+    with conn:
+        conn.execute("DELETE FROM variants")
+        conn.execute("DELETE FROM products")
+        for prod in products:
+            variants = prod.get("variants") or []
+            articul = next((v.get("sku") for v in variants if v.get("sku")), None)
+            _index_write_product(conn, prod["id"], prod.get("handle"), articul, variants)
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rebuilt_at', ?)", (str(time.time()),))
+    log.info(f"✅ Індекс перебудовано: {len(products)} товарів")
+    return True
+
+
+def shopify_client_options():
+    # HTTP/2 (нужен пакет h2): запросы параллельных групп мультиплексируются в одном TLS-соединении
+    if SHOPIFY_HTTP2 and h2 is None:
+        log.warning("⚠️ SHOPIFY_HTTP2=1, але пакет h2 не встановлено — працюємо по HTTP/1.1")
+    return {
+        "http2": SHOPIFY_HTTP2 and h2 is not None,
+        "verify": False,
+        "timeout": Timeout(120, connect=10),
+        "limits": httpx.Limits(max_connections=SHOPIFY_MAX_CONNECTIONS,
+                               max_keepalive_connections=SHOPIFY_MAX_CONNECTIONS,
+                               keepalive_expiry=SHOPIFY_KEEPALIVE_EXPIRY),
+        "headers": {"X-Shopify-Access-Token": API_TOKEN, "Content-Type": "application/json"},
+    }
+
+
+def shopify_client():
+    # один клиент на процесс: соединения (TCP+TLS) переживают запуски, фоновые задачи и кнопки в UI
+    with _clients_lock:
+        if _clients["sync"] is None:
+            opts = shopify_client_options()
+            _clients["sync"] = httpx.Client(**opts, transport=shopify_transport(opts, False))
+        return _clients["sync"]
+
+
+def async_loop():
+    # AsyncClient привязан к event loop, поэтому loop тоже общий и живёт всё время процесса
+    with _clients_lock:
+        if _clients["loop"] is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="shopify-async", daemon=True).start()
+            _clients["loop"] = loop
+        return _clients["loop"]
+
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, async_loop()).result()
+
+
+def shopify_async_client():
+    # вызывается только из общего loop
+    if _clients["async"] is None:
+        opts = shopify_client_options()
+        _clients["async"] = httpx.AsyncClient(**opts, transport=shopify_transport(opts, True))
+    return _clients["async"]
+
+
+def count_connection_event(name, info):
+    # trace-события httpcore: новое TCP-соединение и TLS-рукопожатие; остальные запросы шли по уже открытым
+    if name == "connection.connect_tcp.complete":
+        SHOPIFY_CONNECTIONS.inc(event="connect")
+    elif name == "connection.start_tls.complete":
+        SHOPIFY_CONNECTIONS.inc(event="tls")
+
+
+async def count_connection_event_async(name, info):
+    count_connection_event(name, info)
+
+
+def connection_stats():
+    with SHOPIFY_CONNECTIONS.lock:
+        events = {key[0]: n for key, n in SHOPIFY_CONNECTIONS.values.items()}
+    with SHOPIFY_HTTP_VERSIONS.lock:
+        versions = {key[0]: n for key, n in SHOPIFY_HTTP_VERSIONS.values.items()}
+    return {"requests": sum(versions.values()), "connects": events.get("connect", 0),
+            "tls": events.get("tls", 0), "versions": versions}
+
+
+def connection_report(before):
+    # что изменилось за прогон: доля запросов, ушедших по уже открытым соединениям
+    now = connection_stats()
+    requests = now["requests"] - before["requests"]
+    connects = now["connects"] - before["connects"]
+    versions = {v: n - before["versions"].get(v, 0) for v, n in now["versions"].items()
+                if n - before["versions"].get(v, 0)}
+    reused = max(0, requests - connects)
+    return {"requests": requests, "connects": connects, "tls": now["tls"] - before["tls"],
+            "reused": reused, "reuse_ratio": round(reused / requests, 3) if requests else None,
+            "versions": versions}
+
+
+# ——— Запись и воспроизведение трафика Shopify: профилирование движка на последовательности реального запуска ———
+TAPE_HEADERS = ("content-type", "link", "retry-after", "x-shopify-shop-api-call-limit")
+TAPE_SECRET = re.compile(r"token|secret|password|signature|credential|policy|authorization", re.I)
+_tape = {"writer": None, "path": None, "recorded": 0, "started": None, "replay": None}
+_tape_lock = threading.Lock()
+
+
+def redact_url(url):
+    # подписи и токены в query (staged upload, ссылки на результаты bulk) вырезаем
+    u = httpx.URL(url)
+    if not u.query:
+        return url
+    return str(u.copy_with(params=[(k, "***" if TAPE_SECRET.search(k) else v) for k, v in u.params.multi_items()]))
+
+
+def redact(value):
+    if isinstance(value, dict):
+        if TAPE_SECRET.search(str(value.get("name", ""))) and "value" in value:
+            # пары {"name": "signature", "value": …} — параметры stagedUploadsCreate
+            return dict(value, value="***")
+        return {k: "***" if TAPE_SECRET.search(k) else redact(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(v) for v in value]
+    if isinstance(value, str) and value.startswith(("http://", "https://")):
+        return redact_url(value)
+    return value
+
+
+def tape_body(content):
+    # тело запроса/ответа: JSON — разобранным и без секретов, иначе текстом
+    if not content:
+        return None
+    try:
+        return redact(json.loads(content))
+    except ValueError:
+        return content.decode("utf-8", "replace")
+
+
+def tape_key(method, url, body):
+    # точное совпадение запроса; GraphQL различаем по операции, REST — по endpoint_label
+    u = httpx.URL(url)
+    path = u.raw_path.decode("ascii")
+    digest = hashlib.sha1(json.dumps(body, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+    endpoint = endpoint_label(url)
+    if isinstance(body, dict) and body.get("query"):
+        m = re.match(r"\s*(?:query|mutation)\s+(\w+)", body["query"])
+        endpoint += ":" + (m[1] if m else "anonymous")
+    return (method, path, digest), (method, endpoint)
+
+
+def tape_record(request, response, content, elapsed):
+    with _tape_lock:
+        if _tape["writer"] is None:
+            return
+        entry = {
+            "t": round(time.time() - _tape["started"], 4),
+            "elapsed": round(elapsed, 4),
+            "method": request.method,
+            "url": redact_url(str(request.url)),
+            "request": tape_body(request.content),
+            "status": response.status_code,
+            "http_version": response.http_version,
+            "headers": {k: v for k, v in response.headers.items() if k.lower() in TAPE_HEADERS},
+            "body": tape_body(content),
+        }
+        _tape["writer"].write(json.dumps(entry, ensure_ascii=False) + "\n")
+        _tape["recorded"] += 1
+
+
+def tape_response(request, status, headers, content, extensions):
+    # ответ с уже прочитанным телом; Content-Encoding снят — content распакован
+    headers = [(k, v) for k, v in headers if k.lower() not in ("content-encoding", "content-length",
+                                                                   "transfer-encoding")]
+    return httpx.Response(status, headers=headers, content=content, request=request, extensions=extensions)
+
+
+class RecordingTransport(httpx.BaseTransport):
+    # обычный пул соединений + копия каждого запроса и ответа в ленту текущего запуска
+    def __init__(self, inner):
+        self.inner = inner
+
+    def handle_request(self, request):
+        t0 = time.perf_counter()
+        resp = self.inner.handle_request(request)
+        try:
+            content = resp.read()
+        finally:
+            resp.close()
+        tape_record(request, resp, content, time.perf_counter() - t0)
+        return tape_response(request, resp.status_code, resp.headers.multi_items(), content, resp.extensions)
+
+    def close(self):
+        self.inner.close()
+
+
+class AsyncRecordingTransport(httpx.AsyncBaseTransport):
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def handle_async_request(self, request):
+        t0 = time.perf_counter()
+        resp = await self.inner.handle_async_request(request)
+        try:
+            content = await resp.aread()
+        finally:
+            await resp.aclose()
+        tape_record(request, resp, content, time.perf_counter() - t0)
+        return tape_response(request, resp.status_code, resp.headers.multi_items(), content, resp.extensions)
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+
+class ReplayTape:
+    # ответы из записанной ленты: сначала тот же запрос (метод, путь, тело), иначе следующий записанный
+    # ответ той же операции — когда прогон разошёлся с записью (другой индекс, изменённый движок)
+    def __init__(self, path):
+        self.exact, self.by_endpoint = {}, {}
+        self.served, self.fallback, self.missed = 0, 0, 0
+        self.lock = threading.Lock()
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            self.header = json.loads(next(f))
+            for line in f:
+                entry = json.loads(line)
+                exact, endpoint = tape_key(entry["method"], entry["url"], entry["request"])
+                self.exact.setdefault(exact, deque()).append(entry)
+                self.by_endpoint.setdefault(endpoint, deque()).append(entry)
+        log.info(f"📼 Відтворення: {sum(len(q) for q in self.exact.values())} відповідей з {path}")
+
+    def take(self, request):
+        exact, endpoint = tape_key(request.method, str(request.url), tape_body(request.content))
+        with self.lock:
+            for key, queue_ in ((exact, self.exact), (endpoint, self.by_endpoint)):
+                q = queue_.get(key)
+                while q and q[0].get("used"):
+                    q.popleft()
+                if q:
+                    entry = q.popleft()
+                    entry["used"] = True
+                    self.served += 1
+                    self.fallback += queue_ is self.by_endpoint
+                    return entry
+            self.missed += 1
+        return None
+
+    def respond(self, request):
+        entry = self.take(request)
+        if entry is None:
+            log.warning(f"⚠️ Відтворення: немає запису для {request.method} {endpoint_label(str(request.url))}")
+            return None, tape_response(request, 404, [("content-type", "application/json")],
+                                       b'{"errors": "replay: no recorded response"}', {})
+        body = entry["body"]
+        content = (json.dumps(body, ensure_ascii=False) if not isinstance(body, str) else body).encode("utf-8") \
+            if body is not None else b""
+        extensions = {"http_version": entry.get("http_version", "HTTP/1.1").encode("ascii")}
+        return entry["elapsed"] * SHOPIFY_REPLAY_LATENCY, tape_response(
+            request, entry["status"], list(entry["headers"].items()), content, extensions)
+
+
+def replay_tape():
+    with _tape_lock:
+        if _tape["replay"] is None:
+            _tape["replay"] = ReplayTape(SHOPIFY_REPLAY)
+        return _tape["replay"]
+
+
+class ReplayTransport(httpx.BaseTransport):
+    # без сети: записанный ответ через записанное время × SHOPIFY_REPLAY_LATENCY
+    def handle_request(self, request):
+        delay, resp = replay_tape().respond(request)
+        if delay:
+            time.sleep(delay)
+        return resp
+
+
+class AsyncReplayTransport(httpx.AsyncBaseTransport):
+    async def handle_async_request(self, request):
+        delay, resp = replay_tape().respond(request)
+        if delay:
+            await asyncio.sleep(delay)
         return resp
 
-    # если исчерпали все попытки, возвращаем последний ответ
+
+def shopify_transport(opts, is_async):
+    # запись и воспроизведение подменяют транспорт клиента; иначе — обычный пул соединений httpx
+    if SHOPIFY_REPLAY:
+        return AsyncReplayTransport() if is_async else ReplayTransport()
+    if not SHOPIFY_RECORD_DIR:
+        return None
+    inner = (httpx.AsyncHTTPTransport if is_async else httpx.HTTPTransport)(
+        http2=opts["http2"], verify=opts["verify"], limits=opts["limits"])
+    return AsyncRecordingTransport(inner) if is_async else RecordingTransport(inner)
+
+
+def tape_begin(job):
+    # лента на каждый запуск: запись — новый файл, воспроизведение — лента с начала
+    if SHOPIFY_REPLAY:
+        with _tape_lock:
+            _tape["replay"] = None
+        replay_tape()
+        return
+    if not SHOPIFY_RECORD_DIR:
+        return
+    os.makedirs(SHOPIFY_RECORD_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(SHOPIFY_RECORD_DIR, f"shopify-{stamp}-{job['kind']}-{job['id']}.jsonl.gz")
+    writer = gzip.open(path, "wt", encoding="utf-8")
+    writer.write(json.dumps({"tape": 1, "job_id": job["id"], "kind": job["kind"], "started_at": time.time(),
+                             "api_version": API_VERSION, "graphql_api_version": GRAPHQL_API_VERSION}) + "\n")
+    with _tape_lock:
+        _tape.update(writer=writer, path=path, recorded=0, started=time.time())
+
+
+def tape_end():
+    # итог ленты для summary задачи
+    if SHOPIFY_REPLAY:
+        tape = _tape["replay"]
+        if tape is None:
+            return None
+        log.info(f"📼 Відтворено відповідей: {tape.served} (з них не точний збіг — {tape.fallback}), "
+                 f"без запису: {tape.missed}")
+        return {"replay": SHOPIFY_REPLAY, "served": tape.served, "fallback": tape.fallback, "missed": tape.missed}
+    with _tape_lock:
+        writer = _tape["writer"]
+        if writer is None:
+            return None
+        _tape["writer"] = None
+        writer.close()
+    size = os.path.getsize(_tape["path"])
+    log.info(f"📼 Записано {_tape['recorded']} запитів Shopify у {_tape['path']} ({size} байт)")
+    return {"record": _tape["path"], "requests": _tape["recorded"], "bytes": size}
+
+
+def sync_config_sig(header, upd, upd_sale, upd_desc):
+    return json.dumps([header, upd, upd_sale, upd_desc, sorted(meta_columns)], ensure_ascii=False)
+
+
+def group_fingerprint(recs, xl, config_sig):
+    # отпечаток = настройки синхронизации + запись Excel + все строки группы
+    h = hashlib.sha1(config_sig.encode("utf-8"))
+    h.update(json.dumps(xl, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    for r in recs:
+        h.update("\x1f".join(r).encode("utf-8"))
+        h.update(b"\x1e")
+    return h.hexdigest()
+
+
+class CallBudget:
+    # Локальная копия ведра Shopify. reserve() списывает стоимость запроса и говорит, сколько ждать
+    # (0 — запас есть, идём сразу); баланс может уйти в минус — следующие ждут по очереди.
+    # observe() подставляет фактический остаток из ответа за вычетом ещё не учтённых Shopify резервов.
+    def __init__(self, api, size, rate):
+        self.api, self.size, self.rate = api, float(size), float(rate)
+        self.available = self.size
+        self.pending = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.waits = 0
+        self.throttled = 0
+
+    def _refill(self, now):
+        self.available = min(self.size, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, cost):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.available -= cost
+            self.pending += cost
+            if self.available >= 0:
+                return 0.0
+            self.waits += 1
+            return -self.available / self.rate
+
+    def observe(self, cost, available=None, size=None, rate=None, throttled=False):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.pending = max(0.0, self.pending - cost)
+            if size:
+                self.size = float(size)
+            if rate:
+                self.rate = float(rate)
+            if throttled:
+                self.throttled += 1
+            if available is not None:
+                self.available = min(self.size, float(available)) - self.pending
+            SHOPIFY_BUDGET.set(round(self.available, 2), api=self.api)
+
+    def state(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            return {"available": round(self.available, 2), "size": self.size, "rate": self.rate,
+                    "pending": round(self.pending, 2), "waits": self.waits, "throttled": self.throttled}
+
+
+REST_BUDGET = CallBudget("rest", SHOPIFY_REST_BUCKET, SHOPIFY_REST_RATE)
+GRAPHQL_BUDGET = CallBudget("graphql", 1000, 50)
+_graphql_costs = {}     # текст запроса → последняя фактическая стоимость
+
+
+def rate_limit_state():
+    return {"rest": REST_BUDGET.state(), "graphql": GRAPHQL_BUDGET.state()}
+
+
+def request_budget(url, kwargs):
+    # (ведро, оценка стоимости): REST-запрос стоит 1, GraphQL — как в прошлый раз для того же запроса
+    if url == GRAPHQL_URL:
+        query = (kwargs.get("json") or {}).get("query", "")
+        return GRAPHQL_BUDGET, _graphql_costs.get(query, GRAPHQL_DEFAULT_COST), query
+    return REST_BUDGET, 1, None
+
+
+def backoff_delay(attempt, retry_after=None):
+    # экспоненциальная пауза с полным джиттером, чтобы параллельные группы не повторяли залпом;
+    # Retry-After от Shopify — нижняя граница
+    delay = random.uniform(0, min(SHOPIFY_BACKOFF_MAX, SHOPIFY_BACKOFF_BASE * 2 ** (attempt - 1)))
+    return delay + (retry_after or 0)
+
+
+def settle_response(budget, cost, query, method, resp, attempt, max_retries):
+    # Обновляет ведро по ответу; возвращает (пауза, причина) перед повтором или None — ответ окончательный
+    if budget is GRAPHQL_BUDGET:
+        try:
+            body = resp.json()
+        except ValueError:
+            body = {}
+        if not isinstance(body, dict):
+            body = {}
+        ext = (body.get("extensions") or {}).get("cost") or {}
+        status = ext.get("throttleStatus") or {}
+        errors = body.get("errors") if isinstance(body.get("errors"), list) else []
+        throttled = any(isinstance(e, dict) and (e.get("extensions") or {}).get("code") == "THROTTLED"
+                        for e in errors)
+        if ext.get("actualQueryCost") is not None or ext.get("requestedQueryCost") is not None:
+            _graphql_costs[query] = ext.get("actualQueryCost") or ext.get("requestedQueryCost")
+        budget.observe(cost, status.get("currentlyAvailable"), status.get("maximumAvailable"),
+                       status.get("restoreRate"), throttled=throttled or resp.status_code == 429)
+        if throttled:
+            # запрос не выполнен: ждём, пока восстановится его стоимость
+            need = ext.get("requestedQueryCost") or cost
+            have = status.get("currentlyAvailable") or 0
+            wait = max(0.0, need - have) / (status.get("restoreRate") or budget.rate)
+            return None if attempt >= max_retries else (backoff_delay(attempt, wait), "throttled")
+    else:
+        used = resp.headers.get("X-Shopify-Shop-Api-Call-Limit")
+        if used and "/" in used:
+            # счётчик в заголовке целый и отстаёт от утечки — держим запас в один запрос
+            n, size = used.split("/", 1)
+            budget.observe(cost, float(size) - float(n) - 1, size, throttled=resp.status_code == 429)
+        else:
+            budget.observe(cost, 0 if resp.status_code == 429 else None, throttled=resp.status_code == 429)
+
+    if attempt >= max_retries:
+        return None
+
+    if resp.status_code == 429:
+        # ведро переполнено: Retry-After — сколько ждать, плюс джиттер
+        return backoff_delay(attempt, float(resp.headers.get("Retry-After", "2"))), "429"
+
+    # 5xx: повторяем с экспоненциальной паузой; 500 на POST мог уже создать товар — его не повторяем
+    if resp.status_code in (502, 503, 504) or (resp.status_code == 500 and method != "POST"):
+        return backoff_delay(attempt), "5xx"
+
+    # продукт занят
+    if resp.status_code == 409:
+        try:
+            errors = resp.json().get("errors", {}).get("product", [])
+        except (ValueError, AttributeError):
+            errors = []
+        if errors and errors[0].startswith("This product is currently being modified"):
+            return 0.5 * attempt, "409"
+    return None
+
+
+def retry_wait(reason, wait, attempt, max_retries):
+    log.warning(f"⚠️ Shopify {reason}, повтор через {wait:.1f}s (спроба {attempt}/{max_retries})")
+    SHOPIFY_RETRIES.inc(reason=reason)
+    SHOPIFY_THROTTLE_SLEEP.inc(wait, reason=reason)
+
+
+def shopify_request(client: httpx.Client, method: str, url: str, max_retries: int = SHOPIFY_MAX_RETRIES,
+                    **kwargs):
+    budget, cost, query = request_budget(url, kwargs)
+    for attempt in range(1, max_retries + 1):
+        # 1) ждём только если ведро пусто — запас расходуем без пауз
+        wait = budget.reserve(cost)
+        if wait > 0:
+            SHOPIFY_THROTTLE_SLEEP.inc(wait, reason="bucket")
+            time.sleep(wait)
+
+        t0 = time.perf_counter()
+        try:
+            resp = client.request(method, url, extensions={"trace": count_connection_event}, **kwargs)
+        except Exception:
+            budget.observe(cost)
+            raise
+        observe_shopify_call(method, url, resp, time.perf_counter() - t0)
+
+        # 2) лимиты, 5xx, занятый продукт — пауза и повтор; иначе возвращаем ответ
+        retry = settle_response(budget, cost, query, method, resp, attempt, max_retries)
+        if retry is None:
+            return resp
+        wait, reason = retry
+        retry_wait(reason, wait, attempt, max_retries)
+        time.sleep(wait)
+
+    return resp
+
+
+async def shopify_request_async(client: httpx.AsyncClient, method: str, url: str,
+                                max_retries: int = SHOPIFY_MAX_RETRIES, **kwargs):
+    budget, cost, query = request_budget(url, kwargs)
+    for attempt in range(1, max_retries + 1):
+        # 1) общее ведро для потоков и корутин: запросы идут внахлёст, пока есть запас
+        wait = budget.reserve(cost)
+        if wait > 0:
+            SHOPIFY_THROTTLE_SLEEP.inc(wait, reason="bucket")
+            await asyncio.sleep(wait)
+
+        t0 = time.perf_counter()
+        try:
+            resp = await client.request(method, url, extensions={"trace": count_connection_event_async}, **kwargs)
+        except Exception:
+            budget.observe(cost)
+            raise
+        observe_shopify_call(method, url, resp, time.perf_counter() - t0)
+
+        retry = settle_response(budget, cost, query, method, resp, attempt, max_retries)
+        if retry is None:
+            return resp
+        wait, reason = retry
+        retry_wait(reason, wait, attempt, max_retries)
+        await asyncio.sleep(wait)
+
     return resp
 
 meta_columns = set()
@@ -185,18 +1394,14 @@ SETTINGS_TEMPLATE = """
     input[type="text"] { padding:0.5em; border:1px solid #ccc; border-radius:4px; width:calc(100% - 1.2em); }
     button { padding:0.6em 1.2em; border:none; border-radius:4px; background:#3498db; color:#fff; cursor:pointer; transition:background .2s; }
     button:hover { background:#2980b9; }
-    #overlay {
-      display: none;
-      position: fixed; top: 0; left: 0;
-      width: 100%; height: 100%;
-      background: rgba(0,0,0,0.3);
-      align-items: center; justify-content: center;
-      z-index: 9999;
-    }
-    #overlay.active { display: flex; }
+    .bar { margin:.6em 0 .3em; height:8px; background:#e0e0e0; border-radius:4px; overflow:hidden; }
+    .bar div { height:100%; width:0; background:#3498db; transition:width .3s; }
+    #pgText, #pgSku { font-size:.9em; color:#555; }
+    .job { margin-top:1em; padding:1em; border:1px solid #e0e0e0; border-radius:6px; background:#fafafa;
+           display:flex; align-items:center; gap:0.7em; flex-wrap:wrap; }
     .spinner {
-      width:50px; height:50px;
-      border:5px solid #ddd; border-top:5px solid #3498db;
+      width:18px; height:18px;
+      border:3px solid #ddd; border-top:3px solid #3498db;
       border-radius:50%;
       animation: spin 1s linear infinite;
     }
@@ -336,10 +1541,67 @@ SETTINGS_TEMPLATE = """
         style="background:#3498db;color:#fff; margin-left:1em;">
   ⚙️ Запустити синхронізацію
 </button>
+
+  <!-- Повна синхронізація без урахування відбитків -->
+  <button id="importFullBtn" type="submit" name="action" value="import_full"
+        style="background:#8e44ad;color:#fff; margin-left:1em;"
+        title="Надіслати всі товари, навіть якщо вони не змінювались">
+  🔁 Повна синхронізація
+</button>
+
+  <!-- Нічна синхронізація всього каталогу через GraphQL bulk -->
+  <button id="importBulkBtn" type="submit" name="action" value="import_bulk"
+        style="background:#2c3e50;color:#fff; margin-left:1em;"
+        title="Один JSONL-файл і bulk-мутація замість тисяч REST-запитів">
+  📦 Bulk-синхронізація
+</button>
+
+  <!-- Швидке оновлення тільки залишків і цін (можна запускати кожні кілька хвилин) -->
+  <button id="importStockBtn" type="submit" name="action" value="import_stock"
+        style="background:#27ae60;color:#fff; margin-left:1em;"
+        title="Тільки залишки і ціни вже відомих варіантів — пакетними GraphQL-мутаціями">
+  📈 Залишки і ціни
+</button>
 </div>
 </form>
 </fieldset>
 
+<fieldset>
+  <legend>3. Індекс товарів Shopify</legend>
+  <form method="post" action="{{ url_for('settings') }}">
+    <button name="action" value="rebuild_index" style="background:#16a085;">
+      🗂️ Перебудувати індекс
+    </button>
+  </form>
+</fieldset>
+
+<fieldset>
+  <legend>4. Автозапуск</legend>
+  {% if scheduler.enabled %}
+    {% if scheduler.receiver %}
+      <p>📥 Вбудований FTP: {{ scheduler.receiver.address }}, після завантаження файлу —
+         «{{ scheduler.receiver.kind }}». Останній файл: {{ scheduler.receiver.received_at or '—' }}</p>
+    {% endif %}
+    {% if scheduler.watch %}
+      <p>📡 FTP: перевірка кожні {{ scheduler.watch.interval|int }} с, запуск «{{ scheduler.watch.kind }}»,
+         коли файл не змінюється {{ scheduler.watch.debounce|int }} с.
+         Остання перевірка: {{ scheduler.watch.last_poll_at or '—' }}{% if scheduler.watch.file %},
+         файл {{ scheduler.watch.file.size }} байт (MDTM {{ scheduler.watch.file.mdtm }}){% endif %}
+         {% if scheduler.watch.error %}<br>⚠️ {{ scheduler.watch.error }}{% endif %}</p>
+    {% endif %}
+    {% for e in scheduler.schedule %}
+      <p>⏰ {{ e.spec }} — наступний запуск {{ e.next_at or '—' }}</p>
+    {% endfor %}
+    <p>Наступний запуск за розкладом:
+       {% if scheduler.next_run %}{{ scheduler.next_run.at }} ({{ scheduler.next_run.kind }}){% else %}—{% endif %}</p>
+    <p>Останній автозапуск:
+       {% if scheduler.last_trigger %}{{ scheduler.last_trigger.at }} — {{ scheduler.last_trigger.kind }},
+         {{ scheduler.last_trigger.reason }} (job {{ scheduler.last_trigger.job_id }}){% else %}—{% endif %}</p>
+  {% else %}
+    <p>Вимкнено — задайте SYNC_WATCH_INTERVAL, SYNC_SCHEDULE або FTP_RECEIVER_PORT.</p>
+  {% endif %}
+</fieldset>
+
 
 
     {% with msgs = get_flashed_messages() %}
@@ -349,27 +1611,83 @@ SETTINGS_TEMPLATE = """
         </div>
       {% endif %}
     {% endwith %}
-  </div>
 
-  <div id="overlay">
-  <div class="spinner"></div>
-  <p style="color:#fff; margin-top:1em;">Проходить синхронізація… Зачекайте</p>
-</div>
+    {% if job %}
+      <div id="jobPanel" class="job" data-job="{{ job.id }}">
+        <div id="jobSpinner" class="spinner"></div>
+        <b>Job {{ job.id }}</b>
+        <span id="jobReason">({{ job.reason }})</span>
+        <span id="jobStatus">{{ job.status }}</span>
+        <span id="jobMessage">{{ job.message or '' }}</span>
+        <button id="jobCancel" type="button" style="background:#e74c3c;">⏹️ Скасувати</button>
+        <a id="jobReport" href="{{ url_for('report') }}" style="display:none">📊 Звіт</a>
+        <div id="jobProgress" style="display:none">
+          <div class="bar"><div id="pgBar"></div></div>
+          <div id="pgText"></div>
+          <div id="pgSku"></div>
+        </div>
+      </div>
+    {% endif %}
+  </div>
 
 
   <script>
+// Статус фонової синхронізації — опитуємо /jobs/<id>, сторінка не блокується
 document.addEventListener('DOMContentLoaded', () => {
-  const form    = document.getElementById('syncForm'),
-        btn     = document.getElementById('importBtn'),
-        overlay = document.getElementById('overlay');
-
-  form.addEventListener('submit', e => {
-    // e.submitter — та кнопка, которой был вызван submit
-    if (e.submitter === btn) {
-      overlay.classList.add('active');
-      // — не надо отменять отправку, пусть идёт дальше —
+  const panel = document.getElementById('jobPanel');
+  if (!panel) return;
+  const id = panel.dataset.job,
+        statusEl = document.getElementById('jobStatus'),
+        msgEl = document.getElementById('jobMessage'),
+        cancelBtn = document.getElementById('jobCancel'),
+        reportLink = document.getElementById('jobReport'),
+        spinner = document.getElementById('jobSpinner');
+
+  const finished = s => ['done', 'failed', 'cancelled'].includes(s);
+
+  function render(job) {
+    statusEl.textContent = job.status;
+    msgEl.textContent = job.message || '';
+    if (finished(job.status)) {
+      spinner.style.display = 'none';
+      cancelBtn.style.display = 'none';
+      reportLink.style.display = '';
+      return true;
     }
+    return false;
+  }
+
+  function poll() {
+    fetch('/jobs/' + id).then(r => r.json()).then(job => {
+      if (!render(job)) setTimeout(poll, 2000);
+    }).catch(() => setTimeout(poll, 5000));
+  }
+
+  cancelBtn.addEventListener('click', () => {
+    fetch('/jobs/' + id + '/cancel', {method: 'POST'}).then(r => r.json()).then(render);
   });
+  poll();
+
+  // Живий прогрес через Server-Sent Events
+  if (!window.EventSource) return;
+  const box = document.getElementById('jobProgress'),
+        bar = document.getElementById('pgBar'),
+        text = document.getElementById('pgText'),
+        skuEl = document.getElementById('pgSku');
+  const fmtEta = s => s == null ? '—' : (s >= 3600 ? Math.floor(s / 3600) + ' год ' : '') +
+                                       Math.floor(s % 3600 / 60) + ' хв ' + (s % 60) + ' с';
+  const es = new EventSource('/progress/stream?job=' + id);
+  es.onmessage = ev => {
+    const p = JSON.parse(ev.data);
+    if (p.job_id !== id) return;
+    box.style.display = '';
+    if (p.total) bar.style.width = Math.min(100, 100 * p.done / p.total).toFixed(1) + '%';
+    text.textContent = `етап: ${p.phase || '—'} · груп ${p.done}${p.total ? ' / ' + p.total : ''} · ` +
+      `створено ${p.created}, оновлено ${p.updated}, без змін ${p.unchanged}, помилок ${p.failed} · ` +
+      `${p.calls_per_sec ?? '—'} запит/с, ${p.groups_per_min ?? '—'} груп/хв · ETA ${fmtEta(p.eta)}`;
+    skuEl.textContent = p.current_sku ? 'поточний Articul: ' + p.current_sku : '';
+    if (p.finished) { es.close(); poll(); }
+  };
 });
 </script>
 <script>
@@ -400,6 +1718,10 @@ REPORT_TEMPLATE = """
     h1 { color:#333; margin-bottom:0.5em; }
     a.back { text-decoration:none; color:#555; margin-bottom:1em; display:inline-block; }
     pre { background:#fafafa; border:1px solid #eee; border-radius:6px; padding:1em; overflow:auto; max-height:70vh; }
+    .meta { color:#555; }
+    .lvl-WARNING { color:#b36b00; }
+    .lvl-ERROR { color:#c0392b; }
+    .lvl-DEBUG { color:#888; }
   </style>
 </head>
 <body>
@@ -407,12 +1729,28 @@ REPORT_TEMPLATE = """
     <h1>Звіт по останній синхронизації</h1>
     <a class="back" href="{{ url_for('home') }}">← На головну сторінку</a>
 
+    {% if not last_run %}
+    <p>(Логи ще не зібрані; спочатку натисніть «Запустити» на сторінці налаштувань або зачекайте, поки синхронізація завершиться.)</p>
+    {% else %}
+    <p class="meta">
+      Запуск {{ last_run.kind }} (job {{ last_run.job_id }}){% if not last_run.finished_at %} — ще виконується{% endif %}.
+      <a href="{{ url_for('report_raw') }}">Повний лог файлом</a>
+    </p>
+    <form method="get" class="meta">
+      Рівень:
+      <select name="level" onchange="this.form.submit()">
+        {% for l in levels %}<option value="{{ l }}" {% if l == level %}selected{% endif %}>{{ l }}</option>{% endfor %}
+      </select>
+      · рядків: {{ total }} · сторінка {{ page }} з {{ pages }}
+      {% if page > 1 %}<a href="{{ url_for('report', level=level, page=page - 1) }}">←</a>{% endif %}
+      {% if page < pages %}<a href="{{ url_for('report', level=level, page=page + 1) }}">→</a>{% endif %}
+    </form>
+    {% if truncated %}<p class="meta">⚠️ Початок запуску вже витіснено з буфера — дивіться повний лог.</p>{% endif %}
+
     <h2>Логи виконання:</h2>
-    <pre>
-{% for line in logs %}
-{{ line }}
-{% endfor %}
-    </pre>
+    <pre>{% for r in records %}<span class="lvl-{{ r.level }}">{{ r.msg }}</span>
+{% endfor %}</pre>
+    {% endif %}
   </div>
 </body>
 </html>
@@ -420,582 +1758,2606 @@ REPORT_TEMPLATE = """
 
 
 
+def build_product(sku, recs, idx, xl, upd, upd_sale, upd_desc, facts=None):
+    # собирает REST-payload товара из строк одной Articul-группы; facts — из preprocess_rows
+    facts = facts or group_facts(recs, idx)
+    check_facts(sku, facts, upd)
+    # title / description / images
+    title = xl["title"] if xl and xl["title"] else recs[0][idx["Description"]]
+    description = recs[0][idx["Description"]]
+    images = xl["images"] if xl else []
+
+    # базовые данные
+    vendor = recs[0][idx["ProducerCollectionFull"]].strip()
+    country_meta = recs[0][idx["Country"]].strip()
+    season = recs[0][idx["Season"]]
+    raw_title = xl["title"] if xl and xl["title"] else recs[0][idx["Description"]]
+    t = raw_title.lower()
+    slug_title = re.sub(r'[^\w\-]+', '-', t, flags=re.UNICODE).strip('-')
+    handle = f"{slug_title}-{sku.lower().replace(' ', '-')}"
+    status = "active" if recs[0][idx["visibility_on_site"]] == "1" else "draft"
+    tags = recs[0][idx["GoodTypeFull"]]
+
+    # --- собираем базовые metafields ---
+    mf = [
+        {"namespace": "custom", "key": "country", "value": country_meta, "type": "single_line_text_field"},
+        {"namespace": "custom", "key": "season", "value": season, "type": "single_line_text_field"},
+    ]
+    for c in meta_columns:
+        if c in idx:
+            v = recs[0][idx[c]].strip()
+            mf.append({"namespace": "custom", "key": c, "value": v, "type": "single_line_text_field"})
+    log.info(f"    ⇒ mf-ключі до last_size: {[m['key'] for m in mf]}")
+
+    # last_size
+    active_sizes = facts["active_sizes"]
+    log.info(f"    ℹ️ Активні розміри: {active_sizes}")
+    if len(active_sizes) == 1:
+        mf.append({
+            "namespace": "custom", "key": "last_size", "value": active_sizes[0],
+            "type": "single_line_text_field"
+        })
+        log.info(f"    ✨ Додаємо metafield last_size='{active_sizes[0]}'")
+
+    # --- options & variants ---
+    opt_cols = facts["opt_cols"]
+    options = [{"name": c, "values": sorted(set(facts[c]))} for c in opt_cols]
+    log.info(f"  • Опції: {opt_cols}")
+
+    variants = []
+    for n, r in enumerate(recs):
+        v = {"sku": sku, "barcode": r[idx["Barcode"]]}
+        for i, c in enumerate(opt_cols, 1):
+            v[f"option{i}"] = facts[c][n]
+        if upd:
+            price, compare_at = variant_prices(facts, n, upd_sale)
+            v["price"] = price
+            if compare_at:
+                v["compare_at_price"] = compare_at
+                log.info(f"    💲 Додаємо ціну зі зніжкою: price={price}, compare_at_price={compare_at}")
+            else:
+                log.info(f"    💲 Додаємо звичайну ціну: price={price}")
+            v["inventory_management"] = "shopify"
+        variants.append(v)
+    log.info(f"  • варіантів = {len(variants)}")
+
+    # --- payload ---
+    payload = {"product": {
+        "title": title,
+        **({"body_html": description} if upd_desc else {}),
+        "vendor": vendor,
+        "handle": handle,
+        "status": status,
+        "tags": tags,
+        "options": options,
+        "variants": variants,
+        "metafields": mf
+    }}
+    if images:
+        payload["product"]["images"] = [{"src": u} for u in images]
+        log.info(f"  • Додаємо {len(images)} image(s)")
+
+    return {
+        "handle": handle,
+        "title": title,
+        "description": description,
+        "vendor": vendor,
+        "status": status,
+        "tags": tags,
+        "images": images,
+        "mf": mf,
+        "opt_cols": opt_cols,
+        "options": options,
+        "variants": variants,
+        "payload": payload,
+        "facts": facts,
+    }
+
+
 @app.route("/", methods=["GET"])
 def home():
     # Домашняя страница
     return render_template_string(HOME_TEMPLATE)
 
 
+REPORT_PAGE_SIZE = 500
+REPORT_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+
 @app.route("/report", methods=["GET"])
 def report():
-    # получаем список строк лога (или заглушку, если его нет)
-    logs = app.config.get("LAST_LOGS",
-             ["(Логи ще не зібрані; спочатку натисніть «Запустити» на сторінці налаштувань або зачекайте, поки синхронізація завершиться.)"])
-    return render_template_string(REPORT_TEMPLATE, logs=logs)
-
-def fetch_file_from_ftp():
-    print("🔄 Завантажуємо CSV по FTP…", flush=True)
-    try:
-        ftp = FTP(FTP_HOST); ftp.login(FTP_USER, FTP_PASS)
-        buf = io.BytesIO()
-        ftp.retrbinary(f"RETR {FTP_FILE_PATH}", buf.write)
-        ftp.quit()
-        raw = buf.getvalue()
-        print(f"✅ Прочитано {len(raw)} байт", flush=True)
+    # постранично из кольцевого буфера: только строки последнего (или текущего) запуска
+    last_run = app.config.get("LAST_RUN")
+    level = request.args.get("level", "INFO").upper()
+    if level not in REPORT_LEVELS:
+        level = "INFO"
+    page = max(1, request.args.get("page", 1, type=int))
+    records = log_ring.since(last_run["first_seq"] - 1, logging.getLevelName(level)) if last_run else []
+    pages = max(1, -(-len(records) // REPORT_PAGE_SIZE))
+    page = min(page, pages)
+    chunk = records[(page - 1) * REPORT_PAGE_SIZE: page * REPORT_PAGE_SIZE]
+    truncated = bool(last_run and log_ring.records and log_ring.records[0]["seq"] > last_run["first_seq"])
+    return render_template_string(REPORT_TEMPLATE, last_run=last_run, records=chunk, page=page, pages=pages,
+                                  level=level, levels=REPORT_LEVELS, total=len(records), truncated=truncated)
+
+
+@app.route("/report/raw", methods=["GET"])
+def report_raw():
+    # полный лог запуска из файла — отдаём потоком, без загрузки в память
+    last_run = app.config.get("LAST_RUN")
+    if not last_run or not os.path.exists(last_run["log_file"]):
+        return "Лог ще не записаний", 404
+
+    def stream():
+        with open(last_run["log_file"], encoding="utf-8") as f:
+            for block in iter(lambda: f.read(65536), ""):
+                yield block
+
+    return Response(stream(), mimetype="text/plain; charset=utf-8")
+
+
+class FtpSession:
+    # одно FTP-соединение на весь запуск: проверка, загрузка, листинг и удаление;
+    # перед каждым этапом NOOP, при обрыве — переподключение
+    def __init__(self):
+        self.ftp = None
+        self.timings = {}
+
+    def get(self):
+        if self.ftp is not None:
+            try:
+                self.ftp.voidcmd("NOOP")
+                return self.ftp
+            except Exception as e:
+                log.warning(f"⚠️ FTP-сесія обірвалась ({e}) — перепідключаємось")
+                self.close()
+        with self.stage("connect"):
+            self.ftp = FTP(timeout=FTP_TIMEOUT)
+            self.ftp.connect(FTP_HOST, FTP_PORT)
+            self.ftp.login(FTP_USER, FTP_PASS)
+        return self.ftp
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.time()
         try:
-            return raw.decode("utf-8")
-        except UnicodeDecodeError:
-            return raw.decode("cp1251")
-    except Exception as e:
-        print("❌ Помилка FTP:", e, flush=True)
-        return None
-
-@app.route('/settings/save', methods=['POST'])
-def save_settings():
-    data = request.get_json()
-    # читаем текущее
-    try:
-        cfg = json.load(open(SETTINGS_FILE))
-    except FileNotFoundError:
-        cfg = {}
-    # обновляем
-    cfg[data['key']] = bool(data['value'])
-    # сохраняем
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump(cfg, f)
-    return '', 204
-
-@app.route("/settings", methods=["GET", "POST"])
-def settings():
-    view = request.args.get("view", "sync")
-    if request.method == "GET":
-        sync_settings = app.config.get("SYNC_SETTINGS", DEFAULT_SYNC_SETTINGS)
-        return render_template_string(
-            SETTINGS_TEMPLATE,
-            meta_columns=sorted(meta_columns),
-            sync_settings=sync_settings,  # <-- вот его и передаём
-            view=view
-        )
-
-
-    act = request.form["action"]
-    if act == "add_meta":
-        meta_columns.add(request.form["new_meta"].strip())
-        flash("Додан метафілд")
-        return redirect(url_for("settings"))
-    if act == "delete_meta":
-        to_del = request.form.get("meta_to_delete", "").strip()
-        if to_del in meta_columns:
-            meta_columns.remove(to_del)
-            flash(f"Метафілд «{to_del}» видалено")
-        return redirect(url_for("settings"))
-
-    if act == "save_settings":
-        # обновляем app.config и файл
-        cfg = json.load(open(SETTINGS_FILE, 'r'))
-        for key in ("update_price_qty", "update_sale_price", "update_description"):
-            cfg[key] = key in request.form
-        with open(SETTINGS_FILE, 'w') as f:
-            json.dump(cfg, f, indent=2)
-        app.config["SYNC_SETTINGS"].update(cfg)
-        flash("Налаштування збережені")
-        return redirect(url_for("settings"))
-
-
-    if act == "clear_meta":
-        meta_columns.clear()
-        flash("Метафілди видалені")
-        return redirect(url_for("settings"))
-
-
-    if act == "import":
-        # Сбрасываем буфер перед запуском
-        buf_stdout.truncate(0)
-        buf_stdout.seek(0)
-
-        ua_now = datetime.now(ZoneInfo("Europe/Kyiv"))
-        print(ua_now.strftime("%Y-%m-%d %H:%M:%S %Z"), "🔄 Старт синхронізації")
-
-        # сохраняем, как пользователь поставил чекбоксы
-        sync_settings = app.config["SYNC_SETTINGS"]
-        upd = sync_settings["update_price_qty"]
-        upd_sale = sync_settings["update_sale_price"]
-        upd_desc = sync_settings["update_description"]
-
-        txt = fetch_file_from_ftp()
-        if not txt:
-            flash("Немає файлу Торгсофт", "error")
-            app.config["LAST_LOGS"] = buf_stdout.getvalue().splitlines()
-            return redirect(url_for("settings"))
-
-        reader = csv.reader(io.StringIO(txt), delimiter=";")
-        header = next(reader)
-        idx    = {h:i for i,h in enumerate(header)}
-        rows   = list(reader)
-
-        # группируем по Articul
-        groups = {}
-        for r in rows:
-            sku = r[idx["Articul"]].strip()
-            groups.setdefault(sku, []).append(r)
-        print(f"🔑 Всього SKU-груп: {len(groups)}", flush=True)
-
-        created = updated = 0
-
-        sync_settings = {
-            "update_price_qty": True,
-            "update_sale_price": True,
-            "update_description": True,
-        }
-
-        with httpx.Client(verify=False, timeout=Timeout(120, connect=10)) as client:
-            client.headers.update({
-                "X-Shopify-Access-Token": API_TOKEN,
-                "Content-Type": "application/json"
-            })
-
-            seen_handles = set()
-
-            for sku, recs in groups.items():
-                print(f"\n▶ Articul={sku}, variants={len(recs)}", flush=True)
-                if not upd_desc:
-                    print("    ⚠️ Оновлення опису вимкнено — опис залишиться без змін", flush=True)
-                if not upd_sale:
-                    print("    ⚠️ Оновлення розпродажної ціни вимкнено — буде використана тільки стандартна ціна",
-                          flush=True)
-
-                goodid = recs[0][idx["GoodID"]]
-                key = f"{sku}-{goodid}"
-                xl = EXCEL_MAP.get(key)
-                print(f"  • Excel[{key}]:", "є" if xl else "немає", flush=True)
-
-                # title / description / images
-                title = xl["title"] if xl and xl["title"] else recs[0][idx["Description"]]
-                description = recs[0][idx["Description"]]
-                images = xl["images"] if xl else []
-
-                # базовые данные
-                vendor = recs[0][idx["ProducerCollectionFull"]].strip()
-                country_meta = recs[0][idx["Country"]].strip()
-                season = recs[0][idx["Season"]]
-                raw_title = xl["title"] if xl and xl["title"] else recs[0][idx["Description"]]
-                t = raw_title.lower()
-                slug_title = re.sub(r'[^\w\-]+', '-', t, flags=re.UNICODE).strip('-')
-                handle = f"{slug_title}-{sku.lower().replace(' ', '-')}"
-                status = "active" if recs[0][idx["visibility_on_site"]] == "1" else "draft"
-                tags = recs[0][idx["GoodTypeFull"]]
-
-                if handle in seen_handles:
-                    print(f"⚠️ Пропускаємо дублікат — handle={handle} вже оброблений", flush=True)
-                    continue
-                seen_handles.add(handle)
-
-                # --- собираем базовые metafields ---
-                mf = [
-                    {"namespace": "custom", "key": "country", "value": country_meta, "type": "single_line_text_field"},
-                    {"namespace": "custom", "key": "season", "value": season, "type": "single_line_text_field"},
-                ]
-                for c in meta_columns:
-                    if c in idx:
-                        v = recs[0][idx[c]].strip()
-                        mf.append({"namespace": "custom", "key": c, "value": v, "type": "single_line_text_field"})
-                print(f"    ⇒ mf-ключі до last_size: {[m['key'] for m in mf]}", flush=True)
-
-                # last_size
-                active_sizes = [r[idx["TheSize"]].strip() for r in recs if int(r[idx["WarehouseQuantity"]]) > 0]
-                print(f"    ℹ️ Активні розміри: {active_sizes}", flush=True)
-                if len(active_sizes) == 1:
-                    mf.append({
-                        "namespace": "custom", "key": "last_size", "value": active_sizes[0],
-                        "type": "single_line_text_field"
-                    })
-                    print(f"    ✨ Додаємо metafield last_size='{active_sizes[0]}'", flush=True)
-
-                # --- options & variants ---
-                opt_cols = [c for c in POSSIBLE_OPTIONS if c in idx and all(r[idx[c]].strip() for r in recs)]
-                options = [{"name": c, "values": sorted({r[idx[c]].strip() for r in recs})} for c in opt_cols]
-                print(f"  • Опції: {opt_cols}", flush=True)
-
-                variants = []
-                for r in recs:
-                    v = {"sku": sku, "barcode": r[idx["Barcode"]]}
-                    for i, c in enumerate(opt_cols, 1):
-                        v[f"option{i}"] = r[idx[c]].strip()
-                    if upd:
-                        retail = r[idx["RetailPrice"]].strip()
-                        disc = r[idx["RetailPriceWithDiscount"]].strip()
-                        try:
-                            rf = float(retail)
-                            df = float(disc) if disc else rf
-                        except:
-                            rf = df = rf
-
-                        v["price"] = str(rf)
-
-                        if upd_sale and disc and df < rf:
-                            v["price"] = str(df)
-                            v["compare_at_price"] = str(rf)
-                            print(f"    💲 Додаємо ціну зі зніжкою: price={disc}, compare_at_price={retail}",
-                                  flush=True)
-                        else:
-                            v["price"] = retail
-                            print(f"    💲 Додаємо звичайну ціну: price={retail}", flush=True)
-                        v["inventory_management"] = "shopify"
-                    variants.append(v)
-                print(f"  • варіантів = {len(variants)}", flush=True)
-
-                # --- payload ---
-                payload = {"product": {
-                    "title": title,
-                    **({"body_html": description} if upd_desc else {}),
-                    "vendor": vendor,
-                    "handle": handle,
-                    "status": status,
-                    "tags": tags,
-                    "options": options,
-                    "variants": variants,
-                    "metafields": mf
-                }}
-                if images:
-                    payload["product"]["images"] = [{"src": u} for u in images]
-                    print(f"  • Додаємо {len(images)} image(s)", flush=True)
-
-                # --- GET по handle ---
-                resp = shopify_request(client, "GET",
-                                       f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}/products.json",
-                                       params={"handle": handle})
-                prods = resp.json().get("products", [])
-                print(f"  • У Shopify: {len(prods)}", flush=True)
-
-                if prods:
-                    # UPDATE
-                    pid = prods[0]["id"]
-                    print(f"🛠️ Оновлюємо товар ID={pid}" + (" (цены/остатки)" if upd else ""), flush=True)
-                    r2 = shopify_request(client, "PUT",
-                                         f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}/products/{pid}.json",
-                                         json=payload)
-                    if r2.status_code in (200, 201):
-                        updated += 1
-                        print(f"    ✅ Товар ОНОВЛЕНО ({updated})", flush=True)
-
-                        # GET существующих metafields
-                        lst = shopify_request(client, "GET",
-                                              f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}/products/{pid}/metafields.json",
-                                              params={"namespace": "custom"})
-                        existing = lst.json().get("metafields", []) if lst.status_code < 300 else []
-                        print(f"    ℹ️ Існуючі MF та їхні значення: {[(m['key'], m['value']) for m in existing]}",
-                              flush=True)
-                        existing_map = {m["key"]: m for m in existing}
-
-                        # --- Article из CSV ---
-                        art = recs[0][idx["Articul"]].strip()
-                        if "Article" in existing_map:
-                            cur = existing_map["Article"]["value"]
-                            print(f"    ℹ️ Поточне значення Article = '{cur}'", flush=True)
-                            if not cur:
-                                mid = existing_map["Article"]["id"]
-                                res = shopify_request(client, "PUT",
-                                                      f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}/products/{pid}/metafields/{mid}.json",
-                                                      json={"metafield": {
-                                                          "namespace": "custom", "key": "Article",
-                                                          "value": art, "type": "single_line_text_field"
-                                                      }})
-                                if res.status_code < 300:
-                                    print(f"    🔄 Article оновлено → '{art}'", flush=True)
-                                else:
-                                    print(f"    ❌ Помилка оновлення Article: {res.text}", flush=True)
-                        else:
-                            res = shopify_request(client, "POST",
-                                                  f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}/products/{pid}/metafields.json",
-                                                  json={"metafield": {
-                                                      "namespace": "custom", "key": "Article",
-                                                      "value": art, "type": "single_line_text_field"
-                                                  }})
-                            if res.status_code < 300:
-                                print(f"    ✨ Створено Article → '{art}'", flush=True)
-                            else:
-                                print(f"    ❌ Помилка створення Article: {res.text}", flush=True)
-
-                        # === остальные metafields ===
-                        for mf_item in mf:
-                            k = mf_item["key"]
-                            if k in ("country", "season", "last_size", "Article"):
-                                continue
-                            if k in existing_map:
-                                mid = existing_map[k]["id"]
-                                res = shopify_request(client, "PUT",
-                                                      f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}/products/{pid}/metafields/{mid}.json",
-                                                      json={"metafield": mf_item})
-                                if res.status_code < 300:
-                                    print(f"    🔄 Metafield '{k}' оновлено", flush=True)
-                            else:
-                                res = shopify_request(client, "POST",
-                                                      f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}/products/{pid}/metafields.json",
-                                                      json={"metafield": mf_item})
-                                if res.status_code < 300:
-                                    print(f"    ✨ Metafield '{k}' створено", flush=True)
-
-
-                    # === обновление остатков ===
-                    if upd:
-                        prod = r2.json().get("product", {})
-                        variants = prod.get("variants") or prods[0].get("variants", [])
-
-                        print("    🔄 Оновлюємо ціни та залишки:", flush=True)
-                        for v in variants:
-                            var_id = v["id"]
-                            iid = v["inventory_item_id"]
-                            opt1 = v.get("option1")
-                            match = next((x for x in recs if opt_cols and x[idx[opt_cols[0]]] == opt1), recs[0])
-
-                            # — 1) Ціна —
-                            retail = match[idx["RetailPrice"]].strip()
-                            disc = match[idx["RetailPriceWithDiscount"]].strip()
-                            try:
-                                rf = float(retail)
-                                df = float(disc) if disc else rf
-                            except:
-                                rf = df = rf
-                            new_price = df if (disc and df < rf) else rf
-
-                            variant_payload = {"variant": {"id": var_id, "price": str(new_price)}}
-                            if upd_sale and disc and df < rf:
-                                variant_payload["variant"]["compare_at_price"] = str(rf)
-                                print(f"      💲 Додаємо ціну зі знижкою: price={new_price}, compare_at_price={rf}",
-                                      flush=True)
-                            else:
-                                print(f"      💲 Додаємо звичайну ціну: price={new_price}", flush=True)
-
-                            # PUT на endpoint /variants/{id}.json
-                            price_res = shopify_request(
-                                client, "PUT",
-                                f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}/variants/{var_id}.json",
-                                json=variant_payload
-                            )
-                            if price_res.status_code < 300:
-                                print(f"      ✅ Variant {var_id} price updated", flush=True)
-                            else:
-                                print(f"      ❌ Помилка оновлення ціни variant_id={var_id}: {price_res.text}",
-                                      flush=True)
-
-
-                            q = int(match[idx["WarehouseQuantity"]])
-                            inv_res = shopify_request(
-                                client, "POST",
-                                f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}/inventory_levels/set.json",
-                                json={"location_id": LOCATION_ID, "inventory_item_id": iid, "available": q}
-                            )
-                            if inv_res.status_code < 300:
-                                print(f"      • option={opt1!r} → доступно={q}", flush=True)
-                            else:
-                                print(f"      ❌ Помилка оновлення залишків для option={opt1!r}: {inv_res.text}",
-                                      flush=True)
-                    else:
-                        print("    ⚠️ Опція оновлення цін/залишків вимкнена", flush=True)
-
-
-
-
-                else:
-
-                    # CREATE новый товар
-
-                    print("🚀 Створюємо новий товар", flush=True)
-
-                    r2 = shopify_request(client, "POST",
-
-                                         f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}/products.json",
-
-                                         json=payload)
-
-                    if r2.status_code in (200, 201):
-
-                        created += 1
-
-                        data = r2.json()
-
-                        prod = data.get("product", {})
-
-                        pid = prod.get("id")
-
-                        variants = prod.get("variants", [])
-
-                        # 1) Оновлюємо ціни та залишки
-
-                        print("    🔄 Оновлюємо ціни та залишки для нових товарів:", flush=True)
-
-                        for v in variants:
-
-                            var_id = v["id"]
-
-                            iid = v["inventory_item_id"]
-
-                            opt1 = v.get("option1")
-
-                            match = next(
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.time() - t0
+            SYNC_PHASE_SECONDS.observe(time.time() - t0, phase=f"ftp_{name}")
+
+    def close(self):
+        if self.ftp is None:
+            return
+        try:
+            self.ftp.quit()
+        except Exception:
+            self.ftp.close()
+        self.ftp = None
 
-                                (x for x in recs if opt_cols and x[idx[opt_cols[0]]] == opt1),
+    def report(self):
+        if self.timings:
+            log.info("⏱️ FTP: " + ", ".join(f"{k} {v:.2f}s" for k, v in self.timings.items()))
 
-                                recs[0]
+    def __enter__(self):
+        return self
 
-                            )
+    def __exit__(self, *exc):
+        self.close()
+        self.report()
 
-                            # — 1.1) Цена —
 
-                            retail = match[idx["RetailPrice"]].strip()
+class InboxFTP:
+    # те команды ftplib, которые нужны конвейеру (SIZE/MDTM/RETR/NLST/DELE), поверх каталога встроенного
+    # FTP-сервера: загрузка, потоковое чтение, пропуск по SIZE/MDTM и удаление работают как с внешним FTP
+    def __init__(self, root):
+        self.root = root
+        self.seen = {}      # путь → (size, mtime_ns) на момент SIZE — чтобы не удалить новую выгрузку
 
-                            disc = match[idx["RetailPriceWithDiscount"]].strip()
+    def path(self, remote):
+        return os.path.join(self.root, remote.lstrip("/"))
 
-                            try:
+    def stat(self, remote):
+        try:
+            return os.stat(self.path(remote))
+        except FileNotFoundError:
+            raise error_perm(f"550 {remote}: No such file")
+
+    def voidcmd(self, cmd):
+        return "200 OK"
+
+    def size(self, remote):
+        st = self.stat(remote)
+        self.seen[remote] = (st.st_size, st.st_mtime_ns)
+        return st.st_size
+
+    def sendcmd(self, cmd):
+        verb, _, remote = cmd.partition(" ")
+        if verb != "MDTM":
+            raise error_perm(f"502 {verb} not implemented")
+        mtime = datetime.fromtimestamp(self.stat(remote).st_mtime, timezone.utc)
+        return "213 " + mtime.strftime("%Y%m%d%H%M%S.%f")[:-3]
+
+    def retrbinary(self, cmd, callback, blocksize=65536, rest=None):
+        with open(self.path(cmd.split(" ", 1)[1]), "rb") as f:
+            f.seek(rest or 0)
+            for block in iter(lambda: f.read(blocksize), b""):
+                callback(block)
+        return "226 Transfer complete"
+
+    def nlst(self, directory):
+        try:
+            return sorted(os.listdir(self.path(directory)))
+        except FileNotFoundError:
+            return []
 
-                                rf = float(retail)
+    def delete(self, remote):
+        st = self.stat(remote)
+        if remote in self.seen and self.seen[remote] != (st.st_size, st.st_mtime_ns):
+            # пока шла синхронизация, Торгсофт загрузил новый файл — его обработает следующая задача
+            raise error_perm(f"550 {remote}: replaced by a new upload, not deleted")
+        os.remove(self.path(remote))
 
-                                df = float(disc) if disc else rf
+    def quit(self):
+        pass
 
-                            except:
+    close = quit
 
-                                rf = df = rf
 
-                            new_price = df if (disc and df < rf) else rf
+class InboxSession(FtpSession):
+    # источник выгрузки — каталог встроенного FTP-сервера; этапы и тайминги те же, что у FtpSession
+    def get(self):
+        if self.ftp is None:
+            self.ftp = InboxFTP(FTP_RECEIVER_DIR)
+        return self.ftp
 
-                            variant_payload = {"variant": {"id": var_id, "price": str(new_price)}}
 
-                            if disc and df < rf:
+def feed_session():
+    return InboxSession() if FTP_RECEIVER_PORT else FtpSession()
 
-                                variant_payload["variant"]["compare_at_price"] = str(rf)
 
-                                print(f"      💲 Зі знижкою: price={new_price}, compare_at_price={rf}", flush=True)
+def ftp_file_stat(ftp, path):
+    # SIZE работает только в бинарном режиме; MDTM поддерживают не все серверы
+    ftp.voidcmd("TYPE I")
+    size = ftp.size(path)
+    try:
+        mdtm = ftp.sendcmd(f"MDTM {path}").split()[-1]
+    except error_perm:
+        mdtm = None
+    return {"size": size, "mdtm": mdtm}
 
-                            else:
 
-                                print(f"      💲 Без знижки: price={new_price}", flush=True)
+def same_export(remote, last_export):
+    return bool(last_export and remote["size"] is not None and remote["mdtm"]
+                and (remote["size"], remote["mdtm"]) == (last_export.get("size"), last_export.get("mdtm")))
 
-                            price_res = shopify_request(
 
-                                client, "PUT",
+def download_to_spool(ftp, remote, spool_path=FEED_SPOOL_FILE, on_block=None):
+    # Качаем в spool-файл; если там уже лежит начало того же файла (совпали SIZE и MDTM),
+    # докачиваем с места обрыва через REST. Возвращает sha1 всего содержимого.
+    meta_path = spool_path + ".json"
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        meta = {}
+    offset = 0
+    if os.path.exists(spool_path) and remote["mdtm"] and remote["size"] is not None \
+            and (meta.get("size"), meta.get("mdtm")) == (remote["size"], remote["mdtm"]):
+        offset = min(os.path.getsize(spool_path), remote["size"])
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(remote, f)
+
+    sha = hashlib.sha1()
+    if offset:
+        log.info(f"⏯️ У spool вже є {offset} з {remote['size']} байт — докачуємо решту")
+        with open(spool_path, "rb") as spool:
+            for block in iter(lambda: spool.read(65536), b""):
+                sha.update(block)
+                if on_block:
+                    on_block(block)
+    with open(spool_path, "r+b" if offset else "wb") as spool:
+        spool.seek(offset)
+        spool.truncate()
+
+        def write(block):
+            FTP_BYTES.inc(len(block))
+            spool.write(block)
+            sha.update(block)
+            if on_block:
+                on_block(block)
+
+        if remote["size"] is None or offset < remote["size"]:
+            ftp.retrbinary(f"RETR {FTP_FILE_PATH}", write, rest=offset or None)
+    return sha.hexdigest()
+
+
+def check_feed_unchanged(session, last_export, force):
+    # (remote, unchanged) — remote=None, если файла нет или FTP недоступен
+    try:
+        ftp = session.get()
+        with session.stage("stat"):
+            remote = ftp_file_stat(ftp, FTP_FILE_PATH)
+    except Exception as e:
+        log.error("❌ Помилка FTP: %s", e)
+        return None, False
+    log.info(f"📄 {FTP_FILE_PATH}: {remote['size']} байт, MDTM={remote['mdtm']}")
+    if not force and same_export(remote, last_export):
+        log.info("⏭️ Файл не змінився з останнього обробленого (SIZE/MDTM) — синхронізацію пропущено")
+        return dict(remote, sha1=last_export.get("sha1")), True
+    return remote, False
+
+
+def fetch_file_from_ftp(session, last_export=None, force=False):
+    # (текст, export): текст None и export None — ошибка; export["unchanged"] — файл уже обработан,
+    # export["reuploaded"] — тот же файл залит заново (новые SIZE/MDTM, тот же sha1)
+    log.info("🔄 Завантажуємо CSV по FTP…")
+    remote, unchanged = check_feed_unchanged(session, last_export, force)
+    if remote is None or unchanged:
+        return None, remote and dict(remote, unchanged=True)
+    try:
+        ftp = session.get()
+        with session.stage("download"):
+            remote["sha1"] = download_to_spool(ftp, remote)
+        if not force and last_export and remote["sha1"] == last_export.get("sha1"):
+            log.info("⏭️ Вміст файлу збігається з останнім обробленим (sha1) — синхронізацію пропущено")
+            return None, dict(remote, unchanged=True, reuploaded=True)
+        with open(FEED_SPOOL_FILE, "rb") as f:
+            raw = f.read()
+        log.info(f"✅ Прочитано {len(raw)} байт")
+        try:
+            return raw.decode("utf-8"), remote
+        except UnicodeDecodeError:
+            return raw.decode("cp1251"), remote
+    except Exception as e:
+        log.error("❌ Помилка FTP: %s", e)
+        return None, None
 
-                                f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}/variants/{var_id}.json",
 
-                                json=variant_payload
+def mark_export_processed(export, key="last_export"):
+    # запоминаем обработанную выгрузку — тот же файл повторно не синхронизируем;
+    # у быстрого режима «залишки і ціни» своя отметка (last_stock_export)
+    state = load_sync_state()
+    state[key] = {"size": export.get("size"), "mdtm": export.get("mdtm"),
+                            "sha1": export.get("sha1"), "processed_at": time.time()}
+    save_sync_state(state)
 
-                            )
 
-                            if price_res.status_code < 300:
+def delete_ftp_file(session):
+    directory, filename = os.path.split(FTP_FILE_PATH)
+    directory = directory or "/"
+    try:
+        ftp = session.get()
+        with session.stage("delete"):
+            # Список файлов в директории
+            files = ftp.nlst(directory)
+            log.info(f"📂 Вміст FTP-директорії «{directory}»: ")
+            for f in files:
+                log.info(f"    – {directory.rstrip('/')}/{f}")
+
+            # Удаляем наш файл
+            if filename in [os.path.basename(f) for f in files]:
+                ftp.delete(FTP_FILE_PATH)
+                log.info(f"🗑️ Файл {FTP_FILE_PATH} видалено з FTP")
+            else:
+                log.warning(f"⚠️ Файл {FTP_FILE_PATH} не знайдено — нічого не видаляємо")
 
-                                print(f"      ✅ Variant {var_id} price updated", flush=True)
+    except Exception as e:
+        log.error(f"❌ Не вдалося обробити FTP-директорію {directory}: {e}")
 
-                            else:
 
-                                print(f"      ❌ Error updating price variant_id={var_id}: {price_res.text}", flush=True)
+class FeedDecoder:
+    # инкрементальный декодер: utf-8, а при первой ошибке — cp1251 до конца файла
+    # (как прежний raw.decode("utf-8") → raw.decode("cp1251"), но без буфера на весь файл)
+    def __init__(self):
+        self.encoding = "utf-8"
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._ascii_only = True
 
-                            # — 1.2) Залишки —
+    def decode(self, chunk, final=False):
+        if self.encoding == "utf-8":
+            pending = self._utf8.getstate()[0]
+            try:
+                text = self._utf8.decode(chunk, final)
+                self._ascii_only = self._ascii_only and text.isascii()
+                return text
+            except UnicodeDecodeError:
+                if not self._ascii_only:
+                    log.warning("⚠️ Файл почався як UTF-8, але далі не UTF-8 — решту читаємо як cp1251")
+                self.encoding = "cp1251"
+                chunk = pending + chunk
+        return chunk.decode("cp1251")
+
+
+def stream_ftp_lines(stats, session, remote, spool_path=FEED_SPOOL_FILE):
+    # Продюсер качает файл в отдельном потоке (retrbinary блокирующий) через общую FTP-сессию
+    # и пишет копию в spool (с докачкой), генератор отдаёт строки по мере прихода блоков.
+    # Очередь ограничена — память не растёт.
+    chunks = queue.Queue(maxsize=64)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-                            q = int(match[idx["WarehouseQuantity"]])
+    def producer():
+        def on_chunk(block):
+            if not put(block):
+                raise EOFError("читач зупинився")
+        try:
+            ftp = session.get()
+            with session.stage("download"):
+                remote["sha1"] = download_to_spool(ftp, remote, spool_path, on_chunk)
+            put(None)
+        except Exception as e:
+            put(e)
+
+    threading.Thread(target=producer, name="ftp-stream", daemon=True).start()
+    decoder = FeedDecoder()
+    tail = ""
+    try:
+        while True:
+            item = chunks.get()
+            if isinstance(item, Exception):
+                raise item
+            if item is not None:
+                stats["bytes"] += len(item)
+            lines = (tail + decoder.decode(item or b"", final=item is None)).split("\n")
+            tail = lines.pop()
+            for line in lines:
+                yield line + "\n"
+            if item is None:
+                break
+        if tail:
+            yield tail
+        stats["encoding"] = decoder.encoding
+        log.info(f"✅ Прочитано {stats['bytes']} байт потоком ({decoder.encoding})")
+    finally:
+        stop.set()
+
+
+def group_looks_incomplete(conn, idx, sku, recs):
+    # в индексе у товара есть варианты, которых нет в этой части группы: PUT с неполным списком
+    # variants удалил бы их в Shopify (вместе с остатками и связями), поэтому такую группу откладываем
+    known = index_lookup(conn, articul=sku)
+    if not known:
+        return False
+    col = lambda name: {r[idx[name]].strip() for r in recs} if name in idx else set()
+    barcodes, sizes = col("Barcode") - {""}, col("TheSize") or {"Default Title"}
+    return any(not (v["barcode"] and v["barcode"] in barcodes) and v["option1"] not in sizes
+               for v in known["variants"])
+
+
+def iter_feed_groups(reader, idx, stats, spool_path=None, incomplete=None):
+    # Группа уходит дальше, как только сменился Articul. Файл может быть не отсортирован —
+    # тогда часть группы уже прочитана, а остальные строки придут позже. Известный товар,
+    # у которого в части нет вариантов из индекса (incomplete), не пишем, а откладываем;
+    # отложенные и встреченные повторно Articul собираем целиком из spool-файла в конце.
+    cur, recs, emitted = None, [], set()
+
+    def deferred(sku, recs):
+        if spool_path and incomplete is not None and incomplete(sku, recs):
+            stats["split"].add(sku)
+            return True
+        return False
+
+    for r in reader:
+        sku = r[idx["Articul"]].strip()
+        if sku in stats["split"]:
+            continue
+        if sku != cur:
+            if recs and not deferred(cur, recs):
+                emitted.add(cur)
+                stats["groups"] += 1
+                yield cur, recs
+            cur, recs = sku, []
+            if sku in emitted:
+                stats["split"].add(sku)
+                continue
+        recs.append(r)
+    # последняя группа файла заведомо полная
+    if recs and cur not in stats["split"]:
+        stats["groups"] += 1
+        yield cur, recs
+
+    if stats["split"] and spool_path:
+        log.warning(f"⚠️ {len(stats['split'])} Articul-груп розірвані у файлі або неповні — "
+                    f"синхронізуємо їх цілком після решти файлу")
+        with open(spool_path, encoding=stats.get("encoding", "utf-8"), newline="") as f:
+            full = {}
+            spool_reader = csv.reader(f, delimiter=";")
+            next(spool_reader)
+            for r in spool_reader:
+                sku = r[idx["Articul"]].strip()
+                if sku in stats["split"]:
+                    full.setdefault(sku, []).append(r)
+        yield from full.items()
+
+
+def open_feed_stream(session, last_export=None, force=False):
+    # ((header, idx, генератор групп, stats), export) — как fetch_file_from_ftp; в потоке
+    # пропуск возможен только по SIZE/MDTM, sha1 становится известен лишь в конце файла
+    log.info("🔄 Читаємо CSV по FTP потоком…")
+    remote, unchanged = check_feed_unchanged(session, last_export, force)
+    if remote is None or unchanged:
+        return None, remote and dict(remote, unchanged=True)
+    stats = {"bytes": 0, "groups": 0, "split": set(), "error": None}
+    lines = stream_ftp_lines(stats, session, remote)
+    try:
+        reader = csv.reader(lines, delimiter=";")
+        header = next(reader)
+    except Exception as e:
+        log.error("❌ Помилка FTP: %s", e)
+        lines.close()
+        return None, None
+    idx = {h: i for i, h in enumerate(header)}
 
-                            inv_res = shopify_request(
+    def groups():
+        idx_conn = index_connect()
+        try:
+            yield from iter_feed_groups(reader, idx, stats, FEED_SPOOL_FILE,
+                                        lambda sku, recs: group_looks_incomplete(idx_conn, idx, sku, recs))
+        except Exception as e:
+            # обрыв посреди файла: уже отправленное остаётся, файл на FTP не трогаем
+            stats["error"] = f"{type(e).__name__}: {e}"
+            log.error("❌ Помилка FTP під час потокового читання: %s", e)
+        finally:
+            lines.close()
+            idx_conn.close()
+        log.info(f"🔑 Всього SKU-груп: {stats['groups']}")
+
+    return (header, idx, groups(), stats), remote
+
+
+def preprocess_rows(rows, idx):
+    # Цены, скидки, остатки и значения опций сразу для всех строк — колонками pandas вместо
+    # float()/int() по строкам. Некорректные значения не роняют группу, а помечаются флагами.
+    def column(name, strip=True):
+        i = idx.get(name)
+        col = pd.Series([r[i] for r in rows] if i is not None else [""] * len(rows), dtype=object)
+        return col.str.strip() if strip else col
+
+    # to_numeric сам пропускает пробелы, а пустую строку даёт как NaN
+    retail, disc = column("RetailPrice"), column("RetailPriceWithDiscount")
+    retail_num = pd.to_numeric(retail, errors="coerce").astype(float)
+    disc_num = pd.to_numeric(disc, errors="coerce").astype(float)
+    qty_num = pd.to_numeric(column("WarehouseQuantity", strip=False), errors="coerce").astype(float)
+
+    price_ok = np.isfinite(retail_num)
+    qty_ok = np.isfinite(qty_num) & (qty_num == np.floor(qty_num))
+    quantity = qty_num.where(qty_ok, 0).astype(np.int64)
+    facts = pd.DataFrame({
+        "retail": retail,
+        "retail_num": retail_num,
+        "disc_num": disc_num,
+        "price_ok": price_ok,
+        # скидка, которую нельзя разобрать, игнорируется — как раньше в build_product
+        "disc_ok": (disc == "") | np.isfinite(disc_num),
+        "on_sale": price_ok & np.isfinite(disc_num) & (disc_num < retail_num),
+        "qty_ok": qty_ok,
+        "quantity": quantity,
+        "active": qty_ok & (quantity > 0),
+    })
+    for c in POSSIBLE_OPTIONS:
+        if c in idx:
+            facts[c] = column(c)
+    return facts
+
+
+def split_facts(facts, sizes):
+    # DataFrame на пачку групп → словарь колонок (списки Python) на каждую группу, в порядке строк
+    cols = {c: facts[c].tolist() for c in facts.columns}
+    out, start = [], 0
+    for n in sizes:
+        f = {c: v[start:start + n] for c, v in cols.items()}
+        # опция годится, если она заполнена у всех строк группы
+        f["opt_cols"] = [c for c in POSSIBLE_OPTIONS if c in f and all(f[c])]
+        f["active_sizes"] = [size for size, a in zip(f.get("TheSize", [""] * n), f["active"]) if a]
+        out.append(f)
+        start += n
+    return out
+
+
+def group_facts(recs, idx):
+    return split_facts(preprocess_rows(recs, idx), [len(recs)])[0]
+
+
+def prepare_groups(groups, idx, store):
+    # Обёртка над потоком групп: факты считаются пачками и кладутся в store[Articul] (очередь —
+    # разорванная группа может прийти дважды). Пачки растут 1, 2, 4 … PREPROCESS_CHUNK_GROUPS,
+    # чтобы в потоковом режиме первая группа не ждала всю пачку.
+    chunk, size = [], 1
+    for item in groups:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield from prepare_chunk(chunk, idx, store)
+            chunk, size = [], min(size * 2, PREPROCESS_CHUNK_GROUPS)
+    yield from prepare_chunk(chunk, idx, store)
+
+
+def prepare_chunk(chunk, idx, store):
+    if not chunk:
+        return
+    rows = [r for _, recs in chunk for r in recs]
+    for (sku, recs), f in zip(chunk, split_facts(preprocess_rows(rows, idx), [len(recs) for _, recs in chunk])):
+        store.setdefault(sku, deque()).append(f)
+    yield from chunk
+
+
+def take_facts(run, sku, recs):
+    # факты, посчитанные prepare_groups; если их нет (группу подали мимо обёртки) — считаем на месте
+    pending = run["facts"].get(sku)
+    if not pending:
+        return group_facts(recs, run["idx"])
+    f = pending.popleft()
+    if not pending:
+        del run["facts"][sku]
+    return f
+
+
+def check_facts(sku, facts, upd):
+    # строки, которые нельзя отправить: без остатка (нужен и для last_size), без цены — если цены пишем
+    bad = [i + 1 for i, ok in enumerate(facts["qty_ok"]) if not ok]
+    if bad:
+        raise ValueError(f"некоректний WarehouseQuantity у рядках групи {bad}")
+    if upd:
+        bad = [i + 1 for i, ok in enumerate(facts["price_ok"]) if not ok]
+        if bad:
+            raise ValueError(f"некоректна RetailPrice у рядках групи {bad}")
+        bad = [i + 1 for i, ok in enumerate(facts["disc_ok"]) if not ok]
+        if bad:
+            log.warning(f"    ⚠️ Articul={sku}: некоректна RetailPriceWithDiscount у рядках {bad} — без знижки")
+
+
+def variant_prices(facts, i, upd_sale):
+    # (price, compare_at_price) — одно правило для build_product, планировщика и bulk;
+    # compare_at_price None — скидки нет
+    if upd_sale and facts["on_sale"][i]:
+        return str(facts["disc_num"][i]), str(facts["retail_num"][i])
+    return facts["retail"][i], None
+
+
+def group_rows(reader, idx):
+    groups = {}
+    for r in reader:
+        sku = r[idx["Articul"]].strip()
+        groups.setdefault(sku, []).append(r)
+    return groups
+
+
+def parse_feed(txt):
+    with timed_phase("parse"):
+        reader = csv.reader(io.StringIO(txt), delimiter=";")
+        header = next(reader)
+        idx    = {h:i for i,h in enumerate(header)}
+        rows   = list(reader)
 
-                                client, "POST",
+    # группируем по Articul
+    with timed_phase("grouping"):
+        groups = group_rows(rows, idx)
+    log.info(f"🔑 Всього SKU-груп: {len(groups)}")
+    return header, idx, groups
+
+# ——— Синхронизация через REST: шаги одной группы + последовательный/асинхронный движок ———
+def sync_group_steps(run, sku, recs):
+    # Генератор шагов одной Articul-группы: отдаёт (method, url, kwargs) и получает ответ Shopify.
+    # Один и тот же код исполняют drive_steps (httpx.Client) и drive_steps_async (httpx.AsyncClient).
+    idx = run["idx"]
+    upd, upd_sale, upd_desc = run["upd"], run["upd_sale"], run["upd_desc"]
+    idx_conn = run["idx_conn"]
+    facts = take_facts(run, sku, recs)
+
+    run["groups_seen"].add(sku)
+    if sku in run["resume"]:
+        # группа уже завершена в прерванном прогоне этой же выгрузки
+        fp = run["resume"].pop(sku)
+        if fp:
+            run["fingerprints"][sku] = fp
+        run["resumed"] += 1
+        run["journaled"].add(sku)
+        log.debug(f"    ⏯️ Articul={sku}: вже оброблено в перерваному запуску — пропускаємо")
+        return
+    run["journaled"].discard(sku)
+
+    log.info(f"\n▶ Articul={sku}, variants={len(recs)}")
+    if not upd_desc:
+        log.warning("    ⚠️ Оновлення опису вимкнено — опис залишиться без змін")
+    if not upd_sale:
+        log.warning("    ⚠️ Оновлення розпродажної ціни вимкнено — буде використана тільки стандартна ціна")
+
+    goodid = recs[0][idx["GoodID"]]
+    key = f"{sku}-{goodid}"
+    xl = run["excel"].get(key)
+    log.info("%s %s", f"  • Excel[{key}]:", "є" if xl else "немає")
+
+    fp = group_fingerprint(recs, xl, run["config_sig"])
+    if not run["force_full"] and run["fingerprints"].get(sku) == fp:
+        run["unchanged"] += 1
+        log.info("    ⏭️ Без змін з минулої синхронізації — пропускаємо")
+        return
+    run["changed"] += 1
+    group_ok = True
+
+    spec = build_product(sku, recs, idx, xl, upd, upd_sale, upd_desc, facts)
+    handle, mf, payload = spec["handle"], spec["mf"], spec["payload"]
+
+    # handle → Articul: повторная синхронизация той же группы (склейка в потоковом режиме) — не дубликат
+    if run["seen_handles"].setdefault(handle, sku) != sku:
+        log.warning(f"⚠️ Пропускаємо дублікат — handle={handle} вже оброблений")
+        return
+
+    # --- поиск в локальном индексе вместо GET по handle ---
+    known = index_lookup(idx_conn, handle=handle)
+    log.info(f"  • В індексі: {'ID=' + str(known['id']) if known else 'немає'}")
+
+    if known:
+        # UPDATE
+        pid = known["id"]
+        log.info(f"🛠️ Оновлюємо товар ID={pid}" + (" (цены/остатки)" if upd else ""))
+        attach_variant_ids(payload, known)
+        # картинки в основной PUT не кладём — иначе Shopify заново скачивает их на каждом обновлении
+        put = {"product": {k: v for k, v in payload["product"].items() if k != "images"}}
+        r2 = yield ("PUT", f"{API_URL}/products/{pid}.json", {"json": put})
+        if r2.status_code == 404:
+            # товар удалили в Shopify — индекс устарел, создаём заново
+            log.warning(f"    ⚠️ Товар ID={pid} відсутній у Shopify — прибираємо з індексу")
+            index_drop_product(idx_conn, pid)
+            known = None
+
+    if known:
+        if r2.status_code in (200, 201):
+            run["updated"] += 1
+            index_store_product(idx_conn, r2.json().get("product", {"id": pid, "handle": handle}), sku)
+            log.info(f"    ✅ Товар ОНОВЛЕНО ({run['updated']})")
+            if not (yield from image_sync_steps(run, pid, spec["images"])):
+                group_ok = False
+
+            # --- Article из CSV и остальные metafields — пакетом через metafieldsSet, без чтения;
+            #     значения, совпадающие с последними записанными (индекс), пропускаем ---
+            written = {} if run["force_full"] else index_get_metafields(idx_conn, pid)
+            art = recs[0][idx["Articul"]].strip()
+            plan_metafield(run, sku, pid, {"namespace": "custom", "key": "Article",
+                                           "value": art, "type": "single_line_text_field"}, written)
+            for mf_item in mf:
+                if mf_item["key"] in ("country", "season", "last_size", "Article"):
+                    continue
+                plan_metafield(run, sku, pid, mf_item, written)
+        else:
+            group_ok = False
+            log.error(f"    ❌ Помилка оновлення товару: {r2.text}")
+
+        # === цены и остатки: пишем только то, что отличается от состояния в Shopify ===
+        if upd:
+            prod = r2.json().get("product", {})
+            variants = prod.get("variants") or known.get("variants", [])
+            cached = {} if run["force_full"] else {v["id"]: v for v in known.get("variants", [])}
+            if not (yield from variant_write_steps(run, sku, facts, variants, cached)):
+                group_ok = False
+        else:
+            log.warning("    ⚠️ Опція оновлення цін/залишків вимкнена")
+
+    else:
+        # CREATE новый товар
+        log.info("🚀 Створюємо новий товар")
+        r2 = yield ("POST", f"{API_URL}/products.json", {"json": payload})
+
+        if r2.status_code in (200, 201):
+            run["created"] += 1
+            data = r2.json()
+            prod = data.get("product", {})
+            pid = prod.get("id")
+            variants = prod.get("variants", [])
+
+            index_store_product(idx_conn, prod, sku)
+            remember_images(idx_conn, pid, spec["images"], prod.get("images") or [], replace=True)
+            if prod.get("handle") and prod["handle"] != handle:
+                log.warning(f"    ⚠️ Shopify змінив handle на '{prod['handle']}' — "
+                            f"ймовірно, локальний індекс застарів, перебудуйте його")
+
+            # 1) Цены уже ушли в payload — дописываем только расхождения и остатки
+            if not (yield from variant_write_steps(run, sku, facts, variants, {})):
+                group_ok = False
+
+            # 2) Article и остальные metafields — пакетом через metafieldsSet;
+            #    то, что создано вместе с товаром из payload, повторно не пишем
+            log.info(f"    ✅ СТВОРЕНО ({run['created']}), ID={pid}")
+            sent = {m["key"]: m["value"] for m in mf}
+            index_set_metafields(idx_conn, [(pid, k, v) for k, v in sent.items()])
+            art = recs[0][idx["Articul"]].strip()
+            plan_metafield(run, sku, pid, {"namespace": "custom", "key": "Article",
+                                           "value": art, "type": "single_line_text_field"}, sent)
+            for mf_item in mf:
+                if mf_item["key"] == "Article":
+                    continue
+                plan_metafield(run, sku, pid, mf_item, sent)
+        else:
+            log.error(f"    ❌ Помилка створення товару: {r2.text}")
+            group_ok = False
+
+    # запоминаем отпечаток только для полностью успешных групп
+    # (ошибка пакета остатков могла уже пометить группу как неудачную)
+    if group_ok and sku not in run["failed_skus"]:
+        run["fingerprints"][sku] = fp
+    else:
+        run["failed_skus"].add(sku)
+        run["fingerprints"].pop(sku, None)
+
+
+def remember_images(conn, pid, images, created, replace=False):
+    # created — images из ответа Shopify в порядке position; сопоставляем с исходными URL по порядку.
+    # Если Shopify принял не все картинки, соответствие неизвестно — кэш не заполняем
+    if len(created) != len(images):
+        if images:
+            log.warning(f"    ⚠️ Shopify повернув {len(created)} картинок з {len(images)} — кеш картинок не оновлено")
+        index_set_images(conn, pid, [], replace=replace)
+        return
+    index_set_images(conn, pid, [(src, im["id"]) for src, im in zip(images, created)], replace=replace)
+
+
+def image_sync_steps(run, pid, images):
+    # Картинки отдельно от основного PUT: добавляем только новые URL и удаляем пропавшие.
+    # Без кэша (товар синхронизируется так впервые или полная синхронизация) —
+    # один раз заменяем список целиком и запоминаем image_id каждой картинки.
+    if not images:
+        # как и раньше: нет картинок в Excel — существующие в Shopify не трогаем
+        return True
+    idx_conn = run["idx_conn"]
+    cached = {} if run["force_full"] else index_get_images(idx_conn, pid)
+    if not cached:
+        plan_count(run, "image", True)
+        r = yield ("PUT", f"{API_URL}/products/{pid}.json",
+                   {"json": {"product": {"id": pid, "images": [{"src": u} for u in images]}}})
+        if r.status_code not in (200, 201):
+            log.error(f"    ❌ Помилка запису картинок: {r.text}")
+            return False
+        remember_images(idx_conn, pid, images, r.json().get("product", {}).get("images") or [], replace=True)
+        log.info(f"    🖼️ Картинки: записано {len(images)} (повна заміна)")
+        return True
+
+    ok, added, removed = True, 0, 0
+    for src, image_id in cached.items():
+        if src in images:
+            plan_count(run, "image", False)
+            continue
+        plan_count(run, "image", True)
+        r = yield ("DELETE", f"{API_URL}/products/{pid}/images/{image_id}.json", {})
+        if r.status_code in (200, 204, 404):
+            index_drop_image(idx_conn, pid, src)
+            removed += 1
+        else:
+            log.error(f"    ❌ Не вдалося видалити картинку {src}: {r.text}")
+            ok = False
+    for pos, src in enumerate(images, 1):
+        if src in cached:
+            continue
+        plan_count(run, "image", True)
+        r = yield ("POST", f"{API_URL}/products/{pid}/images.json", {"json": {"image": {"src": src, "position": pos}}})
+        if r.status_code in (200, 201):
+            index_set_images(idx_conn, pid, [(src, r.json()["image"]["id"])])
+            added += 1
+        else:
+            log.error(f"    ❌ Не вдалося додати картинку {src}: {r.text}")
+            ok = False
+    if added or removed:
+        log.info(f"    🖼️ Картинки: додано {added}, видалено {removed}")
+    else:
+        log.debug("    🖼️ Картинки без змін")
+    return ok
+
+
+def attach_variant_ids(payload, known):
+    # варианты с id Shopify обновляет на месте (без пересоздания и обнуления остатков)
+    by_opt = {}
+    for v in known.get("variants", []):
+        by_opt.setdefault(v.get("option1"), []).append(v["id"])
+    for v in payload["product"]["variants"]:
+        ids = by_opt.get(v.get("option1", "Default Title"))
+        if ids and len(ids) == 1:
+            v["id"] = ids[0]
+
+
+def money_equal(a, b):
+    if a in (None, "") or b in (None, ""):
+        return a in (None, "") and b in (None, "")
+    try:
+        return round(float(a), 2) == round(float(b), 2)
+    except ValueError:
+        return False
+
+
+def desired_variant(run, facts, i):
+    # то же правило цены, что и в build_product
+    price, compare_at = variant_prices(facts, i, run["upd_sale"])
+    want = {"quantity": facts["quantity"][i], "price": price}
+    if compare_at or run["upd_sale"]:
+        # с учётом скидок None снимает старую цену, когда акция закончилась
+        want["compare_at_price"] = compare_at
+    return want
+
+
+def price_changes(v, want):
+    # поля цены, которые отличаются от известного состояния варианта
+    body = {}
+    if not money_equal(v.get("price"), want["price"]):
+        body["price"] = want["price"]
+    if "compare_at_price" in want and not money_equal(v.get("compare_at_price"), want["compare_at_price"]):
+        body["compare_at_price"] = want["compare_at_price"]
+    return body
+
+
+def plan_count(run, kind, write):
+    run["plan"][kind]["write" if write else "elided"] += 1
+
+
+def variant_write_steps(run, sku, facts, variants, cached):
+    # Планировщик: желаемое состояние из фида против того, что Shopify вернул в ответе
+    # на PUT/POST (или последнего известного из индекса) — в Shopify уходят только расхождения.
+    opt_cols = facts["opt_cols"]
+    ok = True
+    for v in variants:
+        var_id = v["id"]
+        iid = v["inventory_item_id"]
+        opt1 = v.get("option1")
+        match = next((i for i, x in enumerate(facts[opt_cols[0]]) if x == opt1), 0) if opt_cols else 0
+        want = desired_variant(run, facts, match)
+
+        # — 1) Ціна —
+        body = price_changes(v, want)
+        plan_count(run, "price", bool(body))
+        if body:
+            log.debug(f"      💲 option={opt1!r}: {body}")
+            price_res = yield ("PUT", f"{API_URL}/variants/{var_id}.json", {"json": {"variant": {"id": var_id, **body}}})
+            if price_res.status_code < 300:
+                log.debug(f"      ✅ Variant {var_id} price updated")
+            else:
+                log.error(f"      ❌ Помилка оновлення ціни variant_id={var_id}: {price_res.text}")
+                ok = False
+
+        # — 2) Залишки — уходят пакетом через inventorySetQuantities
+        have = v.get("inventory_quantity")
+        if have is None:
+            have = cached.get(var_id, {}).get("inventory_quantity")
+        write = have is None or int(have) != want["quantity"]
+        plan_count(run, "inventory", write)
+        if write:
+            queue_inventory(run, sku, opt1, iid, want["quantity"])
+            log.debug(f"      • option={opt1!r} → доступно={want['quantity']} (у черзі)")
+    return ok
+
+
+def plan_metafield(run, sku, pid, mf_item, known_values):
+    if known_values.get(mf_item["key"]) == mf_item["value"]:
+        plan_count(run, "metafield", False)
+        return
+    if queue_metafield(run, sku, pid, mf_item):
+        plan_count(run, "metafield", True)
+
+
+INVENTORY_SET_MUTATION = """
+mutation inventorySet($input: InventorySetQuantitiesInput!) {
+  inventorySetQuantities(input: $input) {
+    inventoryAdjustmentGroup { reason }
+    userErrors { field message code }
+  }
+}
+"""
 
-                                f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}/inventory_levels/set.json",
 
-                                json={"location_id": LOCATION_ID, "inventory_item_id": iid, "available": q}
+METAFIELDS_SET_MUTATION = """
+mutation metafieldsSet($metafields: [MetafieldsSetInput!]!) {
+  metafieldsSet(metafields: $metafields) {
+    metafields { id key }
+    userErrors { field message code }
+  }
+}
+"""
+# лимит Shopify на один metafieldsSet
+METAFIELDS_BATCH_SIZE = 25
 
-                            )
 
-                            if inv_res.status_code < 300:
+def queue_inventory(run, sku, size, inventory_item_id, quantity):
+    run["queued"][sku] = run["queued"].get(sku, 0) + 1
+    run["inventory"].append({"sku": sku, "size": size, "inventory_item_id": inventory_item_id, "quantity": quantity})
 
-                                print(f"      • option={opt1!r} → available={q}", flush=True)
 
-                            else:
+def queue_metafield(run, sku, pid, mf_item):
+    # пустое значение Shopify не принимает — оставляем то, что уже есть в магазине
+    if not str(mf_item["value"]).strip():
+        log.warning(f"    ⚠️ Metafield '{mf_item['key']}' порожній — пропускаємо")
+        return False
+    run["queued"][sku] = run["queued"].get(sku, 0) + 1
+    run["metafields"].append({"sku": sku, "product_id": pid, "metafield": mf_item})
+    return True
 
-                                print(f"      ❌ Error updating inventory for option={opt1!r}: {inv_res.text}",
-                                      flush=True)
 
-                        # 2) Создание Article metafield
+def take_batches(pending, size, final=False):
+    # забираем готовые пакеты из общей очереди; в конце прогона — и неполный остаток
+    batches = []
+    while len(pending) >= size or (final and pending):
+        batches.append(pending[:size])
+        del pending[:size]
+    return batches
 
-                        print(f"    ✅ СТВОРЕНО ({created}), ID={pid}", flush=True)
 
-                        art = recs[0][idx["Articul"]].strip()
+def pending_write_steps(run, final=False):
+    # шаги отправки накопленных пакетов остатков и метафилдов
+    for batch in take_batches(run["inventory"], INVENTORY_BATCH_SIZE, final):
+        yield from inventory_flush_steps(run, batch)
+        journal_release(run, batch)
+    for batch in take_batches(run["metafields"], METAFIELDS_BATCH_SIZE, final):
+        yield from metafields_flush_steps(run, batch)
+        journal_release(run, batch)
 
-                        res = shopify_request(client, "POST",
 
-                                              f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}/products/{pid}/metafields.json",
+def batch_item_failed(run, item, label, message):
+    log.error(f"    ❌ {label}: Articul={item['sku']}: {message}")
+    run["write_errors"].append({"sku": item["sku"], "what": label, "message": message})
+    run["failed_skus"].add(item["sku"])
+    run["fingerprints"].pop(item["sku"], None)
 
-                                              json={"metafield": {
 
-                                                  "namespace": "custom", "key": "Article",
+def graphql_batch_steps(run, batch, query, variables, result_key, label):
+    # одна мутация на пакет; позиции с userErrors отбрасываем и повторяем остальные
+    # (inventorySetQuantities и metafieldsSet атомарны — при ошибке не пишется ничего)
+    while batch:
+        try:
+            res = yield ("POST", GRAPHQL_URL, {"json": {"query": query, "variables": variables(batch)}})
+        except Exception as e:
+            for item in batch:
+                batch_item_failed(run, item, label(item), f"{type(e).__name__}: {e}")
+            return []
+        try:
+            body = res.json()
+        except ValueError:
+            body = {}
+        if res.status_code >= 300 or body.get("errors"):
+            for item in batch:
+                batch_item_failed(run, item, label(item), body.get("errors") or res.text)
+            return []
+
+        errors = ((body.get("data") or {}).get(result_key) or {}).get("userErrors") or []
+        if not errors:
+            return batch
+
+        # field вида ["input", "quantities", "3", "quantity"] / ["metafields", "3", "value"]
+        bad = set()
+        for e in errors:
+            pos = next((int(f) for f in (e.get("field") or []) if str(f).isdigit()), None)
+            if pos is None or pos >= len(batch):
+                for item in batch:
+                    batch_item_failed(run, item, label(item), e.get("message"))
+                return []
+            bad.add(pos)
+            batch_item_failed(run, batch[pos], label(batch[pos]), e.get("message"))
+        batch = [item for i, item in enumerate(batch) if i not in bad]
+    return []
+
+
+def inventory_flush_steps(run, batch):
+    written = yield from graphql_batch_steps(
+        run, batch, INVENTORY_SET_MUTATION,
+        lambda b: {"input": {
+            "name": "available",
+            "reason": "correction",
+            "ignoreCompareQuantity": True,
+            "quantities": [{
+                "inventoryItemId": f"gid://shopify/InventoryItem/{item['inventory_item_id']}",
+                "locationId": f"gid://shopify/Location/{LOCATION_ID}",
+                "quantity": item["quantity"],
+            } for item in b],
+        }},
+        "inventorySetQuantities",
+        lambda item: f"Залишки, розмір={item['size']!r}",
+    )
+    if written:
+        run["inventory_written"] += len(written)
+        index_set_quantities(run["idx_conn"], [(item["inventory_item_id"], item["quantity"]) for item in written])
+        log.info(f"📦 Залишки: записано {len(written)} позицій одним запитом")
+
+
+def metafields_flush_steps(run, batch):
+    written = yield from graphql_batch_steps(
+        run, batch, METAFIELDS_SET_MUTATION,
+        lambda b: {"metafields": [{
+            "ownerId": f"gid://shopify/Product/{item['product_id']}",
+            "namespace": item["metafield"]["namespace"],
+            "key": item["metafield"]["key"],
+            "type": item["metafield"]["type"],
+            "value": item["metafield"]["value"],
+        } for item in b]},
+        "metafieldsSet",
+        lambda item: f"Metafield '{item['metafield']['key']}'",
+    )
+    if written:
+        run["metafields_written"] += len(written)
+        index_set_metafields(run["idx_conn"], [(item["product_id"], item["metafield"]["key"],
+                                                item["metafield"]["value"]) for item in written])
+        log.info(f"🏷️ Метафілди: записано {len(written)} значень одним запитом")
+
+
+def drive_steps(client, run, steps):
+    # сбой транспорта отдаём шагам: пакетная запись отбросит свой пакет, шаги группы пробросят его дальше
+    try:
+        req = next(steps)
+        while True:
+            method, url, kwargs = req
+            run["calls"] += 1
+            run.setdefault("first_call_at", time.time())
+            try:
+                res = shopify_request(client, method, url, **kwargs)
+            except Exception as e:
+                req = steps.throw(e)
+            else:
+                req = steps.send(res)
+    except StopIteration:
+        pass
 
-                                                  "value": art, "type": "single_line_text_field"
 
-                                              }})
+async def drive_steps_async(client, run, steps):
+    try:
+        req = next(steps)
+        while True:
+            method, url, kwargs = req
+            run["calls"] += 1
+            run.setdefault("first_call_at", time.time())
+            try:
+                res = await shopify_request_async(client, method, url, **kwargs)
+            except Exception as e:
+                req = steps.throw(e)
+            else:
+                req = steps.send(res)
+    except StopIteration:
+        pass
+
+
+def group_failed(run, sku, e):
+    # исключение в одной группе не должно останавливать весь прогон
+    log.error(f"    ❌ Articul={sku}: {type(e).__name__}: {e}")
+    run["failed_skus"].add(sku)
+    run["fingerprints"].pop(sku, None)
+
+
+def journal_group_done(run, sku):
+    # группа попадает в журнал, только когда дописаны и её пакеты остатков/метафилдов
+    if run["journal"] is None or sku in run["journaled"]:
+        return
+    if sku in run["failed_skus"]:
+        journal_forget(run["idx_conn"], run["journal"], sku)
+    elif run["queued"].get(sku):
+        run["journal_ready"].add(sku)
+    else:
+        journal_record(run["idx_conn"], run["journal"], sku, run["fingerprints"].get(sku))
+        run["journaled"].add(sku)
+
+
+def journal_release(run, batch):
+    for item in batch:
+        sku = item["sku"]
+        run["queued"][sku] -= 1
+        if not run["queued"][sku]:
+            del run["queued"][sku]
+            if sku in run["journal_ready"]:
+                run["journal_ready"].discard(sku)
+                journal_group_done(run, sku)
+
+
+def run_groups_serial(run, groups):
+    client = shopify_client()
+    for sku, recs in groups:
+        if run["cancel"].is_set():
+            break
+        progress_tick(run, sku)
+        t0 = time.perf_counter()
+        try:
+            drive_steps(client, run, sync_group_steps(run, sku, recs))
+        except Exception as e:
+            group_failed(run, sku, e)
+        journal_group_done(run, sku)
+        SYNC_PRODUCT_SECONDS.observe(time.perf_counter() - t0)
+        drive_steps(client, run, pending_write_steps(run))
+        progress_tick(run, done=True)
+    # пакеты уже записанных товаров отправляем даже при отмене
+    drive_steps(client, run, pending_write_steps(run, final=True))
+
+
+async def run_groups_async(run, groups, concurrency):
+    # несколько групп одновременно; общий лимитер в shopify_request_async,
+    # а запросы одного товара идут строго по очереди внутри своей корутины
+    pending = asyncio.Queue(maxsize=concurrency * 2)
+    sku_locks = {}
+
+    client = shopify_async_client()
+
+    async def worker():
+        while True:
+            item = await pending.get()
+            if item is None:
+                return
+            if run["cancel"].is_set():
+                continue
+            sku, recs = item
+            lock = sku_locks.setdefault(sku, asyncio.Lock())
+            progress_tick(run, sku)
+            async with lock:
+                t0 = time.perf_counter()
+                try:
+                    await drive_steps_async(client, run, sync_group_steps(run, sku, recs))
+                except Exception as e:
+                    group_failed(run, sku, e)
+                journal_group_done(run, sku)
+                SYNC_PRODUCT_SECONDS.observe(time.perf_counter() - t0)
+            await drive_steps_async(client, run, pending_write_steps(run))
+            progress_tick(run, done=True)
+
+    async def feeder():
+        # группы могут приходить из потока FTP — читаем их вне event loop
+        source = iter(groups)
+        while not run["cancel"].is_set():
+            item = await asyncio.to_thread(next, source, None)
+            if item is None:
+                break
+            await pending.put(item)
+        for _ in workers:
+            await pending.put(None)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    feed = asyncio.create_task(feeder())
+    try:
+        await asyncio.gather(feed, *workers)
+    except Exception:
+        # упавший worker не должен оставить feeder висеть на полной очереди: очередь сбрасываем,
+        # остальные worker'ы дописывают начатые группы (ответы POST не теряются) и выходят
+        feed.cancel()
+        while not pending.empty():
+            pending.get_nowait()
+        for _ in workers:
+            pending.put_nowait(None)
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    await drive_steps_async(client, run, pending_write_steps(run, final=True))
+
+
+def run_rest_sync(header, idx, groups, upd, upd_sale, upd_desc, force_full=False, concurrency=None, cancel=None,
+                  export=None):
+    # groups — пары (Articul, строки): dict.items() или генератор потокового чтения;
+    # export — выгрузка с FTP, по ней ведётся журнал для продолжения после обрыва
+    concurrency = SYNC_CONCURRENCY if concurrency is None else concurrency
+    sync_state = load_sync_state()
+    run = {
+        "idx": idx, "upd": upd, "upd_sale": upd_sale, "upd_desc": upd_desc, "force_full": force_full,
+        "cancel": cancel or threading.Event(),
+        "fingerprints": sync_state["fingerprints"],
+        "config_sig": sync_config_sig(header, upd, upd_sale, upd_desc),
+        "seen_handles": {},
+        "excel": get_excel_map() or {},
+        "created": 0, "updated": 0, "changed": 0, "unchanged": 0, "calls": 0,
+        "failed_skus": set(),
+        "inventory": [], "inventory_written": 0,
+        "metafields": [], "metafields_written": 0,
+        "write_errors": [],
+        "plan": {k: {"write": 0, "elided": 0} for k in ("price", "inventory", "metafield", "image")},
+        "queued": {}, "groups_seen": set(), "journaled": set(), "journal_ready": set(), "resumed": 0,
+    }
+    if force_full:
+        log.info("🔁 Повна синхронізація — відбитки попереднього запуску ігноруються")
+
+    # dict.items() знает размер; в потоковом режиме общее число групп заранее неизвестно
+    run["total"] = len(groups) if hasattr(groups, "__len__") else None
+    run["done"] = 0
+    run["facts"] = {}
+    groups = prepare_groups(groups, idx, run["facts"])
+    run["idx_conn"] = index_connect()
+    run["journal"] = journal_key(export, run["config_sig"])
+    run["resume"] = journal_open(run["idx_conn"], run["journal"]) if run["journal"] else {}
+    if run["resume"]:
+        log.info(f"⏯️ Продовжуємо перерваний запуск цієї ж вивантаження: {len(run['resume'])} груп вже оброблено")
+    ensure_fresh_index(shopify_client(), run["idx_conn"])
+
+    t0 = time.time()
+    progress_update(phase="sync", total=run["total"], started_at=t0)
+    try:
+        if concurrency > 1:
+            engine = f"async×{concurrency}"
+            run_async(run_groups_async(run, groups, concurrency))
+        else:
+            engine = "serial"
+            run_groups_serial(run, groups)
+    except Exception:
+        # отпечатки уже записанных групп сохраняем и при аварийной остановке движка
+        run["idx_conn"].close()
+        save_sync_state(sync_state)
+        raise
+    elapsed = time.time() - t0
+    SYNC_PHASE_SECONDS.observe(elapsed, phase="sync")
+
+    # журнал полный, когда каждая встреченная группа в нём; отмену и обрыв файла проверяет вызывающий
+    run["journal_complete"] = run["journal"] is not None and run["groups_seen"] <= run["journaled"]
+    run["idx_conn"].close()
+    save_sync_state(sync_state)
+    run["failed"] = len(run["failed_skus"])
+    log.info(f"🔁 Змінених груп: {run['changed']}, без змін: {run['unchanged']}, з помилками: {run['failed']}"
+             + (f", продовжено з журналу: {run['resumed']}" if run["resumed"] else ""))
+    log.info(f"📦 Пакетні записи: залишків {run['inventory_written']}, метафілдів {run['metafields_written']}, "
+             f"помилок {len(run['write_errors'])}")
+    log.info("🧮 Планувальник (записати / пропущено як вже актуальні): " + ", ".join(
+           f"{k} {v['write']}/{v['elided']}" for k, v in run["plan"].items()))
+    done = run["created"] + run["updated"]
+    for result in ("created", "updated", "unchanged", "failed"):
+        SYNC_PRODUCTS.inc(run[result], result=result)
+    SYNC_PRODUCTS_PER_MINUTE.set(round(done / elapsed * 60, 2) if elapsed else 0, engine=engine.split("×")[0])
+    if "first_call_at" in run:
+        log.info(f"⏱️ Перший запит до Shopify через {run['first_call_at'] - t0:.1f}s після старту")
+    log.info(f"⏱️ Рушій {engine}: {done} товарів за {elapsed:.1f}s "
+             f"({done / elapsed if elapsed else 0:.2f} товар/с, {run['calls']} запитів)")
+    run["rate_limit"] = rate_limit_state()
+    log.info("🪣 Ліміти Shopify: " + ", ".join(
+        f"{api} {st['available']:g}/{st['size']:g} (очікувань {st['waits']}, відмов {st['throttled']})"
+        for api, st in run["rate_limit"].items()))
+    return {k: run[k] for k in ("created", "updated", "failed", "changed", "unchanged", "calls",
+                                "inventory_written", "metafields_written", "write_errors", "plan",
+                                "resumed", "journal", "journal_complete", "rate_limit")}
+
+
+# ——— Быстрый режим: только остатки и цены уже известных вариантов ———
+VARIANTS_BULK_UPDATE_FIELD = """
+  p{n}: productVariantsBulkUpdate(productId: $p{n}, variants: $v{n}) {{
+    userErrors {{ field message code }}
+  }}"""
+
+
+def variants_bulk_mutation(n):
+    # productVariantsBulkUpdate принимает один productId — n товаров в одном запросе через алиасы
+    args = ", ".join(f"$p{i}: ID!, $v{i}: [ProductVariantsBulkInput!]!" for i in range(n))
+    fields = "".join(VARIANTS_BULK_UPDATE_FIELD.format(n=i) for i in range(n))
+    return f"mutation variantPrices({args}) {{{fields}\n}}"
+
+
+INVENTORY_LEVELS_QUERY = """
+query stockLevels($ids: [ID!]!, $location: ID!) {
+  nodes(ids: $ids) {
+    ... on InventoryItem {
+      id
+      inventoryLevel(locationId: $location) { quantities(names: ["available"]) { name quantity } }
+    }
+  }
+}
+"""
 
-                        if res.status_code < 300:
 
-                            print(f"    ✨ Створено Article → '{art}'", flush=True)
+def stock_refresh_steps(run, groups):
+    # текущие остатки вариантов этих групп из Shopify → в индекс; без ответа сравниваем с индексом, как раньше
+    ids = []
+    for sku, _ in groups:
+        known = index_lookup(run["idx_conn"], articul=sku)
+        ids += [v["inventory_item_id"] for v in (known or {}).get("variants", []) if v.get("inventory_item_id")]
+    for start in range(0, len(ids), STOCK_REFRESH_BATCH):
+        chunk = ids[start:start + STOCK_REFRESH_BATCH]
+        variables = {"ids": [f"gid://shopify/InventoryItem/{iid}" for iid in chunk],
+                     "location": f"gid://shopify/Location/{LOCATION_ID}"}
+        try:
+            res = yield ("POST", GRAPHQL_URL, {"json": {"query": INVENTORY_LEVELS_QUERY, "variables": variables}})
+            body = res.json()
+        except Exception as e:
+            log.warning(f"⚠️ Не вдалося прочитати залишки з Shopify ({type(e).__name__}: {e}) — порівнюємо з індексом")
+            continue
+        if res.status_code >= 300 or body.get("errors"):
+            log.warning(f"⚠️ Не вдалося прочитати залишки з Shopify: {body.get('errors') or res.text} — "
+                        f"порівнюємо з індексом")
+            continue
+        items = []
+        for node in (body.get("data") or {}).get("nodes") or []:
+            if not node:
+                continue
+            # товар не заведён на этой локации — остаток неизвестен, запись пойдёт
+            level = node.get("inventoryLevel") or {}
+            qty = next((q["quantity"] for q in level.get("quantities") or [] if q.get("name") == "available"), None)
+            items.append((gid_to_id(node["id"]), qty))
+        index_set_quantities(run["idx_conn"], items)
+        run["refreshed"] += len(items)
+
+
+def stock_rows(recs, idx):
+    # из строки фида оставляем только колонки быстрого режима (порядок STOCK_COLUMNS)
+    cols = [idx.get(c) for c in STOCK_COLUMNS]
+    return [[r[i] if i is not None else "" for i in cols] for r in recs]
+
+
+def match_stock_variants(facts, barcodes, known):
+    # строка фида → вариант из индекса: по штрихкоду, иначе по размеру (option1), у товара без опций —
+    # Default Title; None — такого варианта в Shopify ещё нет (новый размер создаст полная синхронизация)
+    by_barcode, by_option = {}, {}
+    for v in known["variants"]:
+        if v.get("barcode"):
+            by_barcode.setdefault(v["barcode"], []).append(v)
+        by_option.setdefault(v.get("option1"), []).append(v)
+    matched = []
+    for i, barcode in enumerate(barcodes):
+        option = facts["TheSize"][i] if "TheSize" in facts["opt_cols"] else "Default Title"
+        cands = by_barcode.get(barcode, []) if barcode else []
+        if len(cands) != 1:
+            cands = by_option.get(option, [])
+        matched.append(cands[0] if len(cands) == 1 else None)
+    return matched
+
+
+def stock_group_plan(run, sku, recs):
+    # сравнивает строки группы с последним известным состоянием вариантов и ставит в очередь только
+    # расхождения: цены — в run["prices"], остатки — в общую очередь inventorySetQuantities
+    facts = take_facts(run, sku, recs)
+    check_facts(sku, facts, True)
+    known = index_lookup(run["idx_conn"], articul=sku)
+    if known is None:
+        run["unknown"] += 1
+        log.debug(f"    ❔ Articul={sku}: товару немає в індексі — його створить повна синхронізація")
+        return
+    barcodes = [r[STOCK_IDX["Barcode"]].strip() for r in recs]
+    prices, changed = [], False
+    for i, v in enumerate(match_stock_variants(facts, barcodes, known)):
+        size = facts["TheSize"][i]
+        if v is None:
+            run["unmatched"] += 1
+            log.warning(f"    ⚠️ Articul={sku}, розмір={size!r}: варіанта немає в індексі — чекає повної синхронізації")
+            continue
+        want = desired_variant(run, facts, i)
+        body = price_changes(v, want)
+        plan_count(run, "price", bool(body))
+        if body:
+            prices.append({"id": v["id"], **body})
+
+        have = v.get("inventory_quantity")
+        write = have is None or int(have) != want["quantity"]
+        plan_count(run, "inventory", write)
+        if write and v.get("inventory_item_id"):
+            queue_inventory(run, sku, size, v["inventory_item_id"], want["quantity"])
+        elif write:
+            log.warning(f"    ⚠️ Articul={sku}, розмір={size!r}: немає inventory_item_id в індексі — залишок пропущено")
+        changed = changed or write or bool(body)
+    if prices:
+        run["prices"].append({"sku": sku, "product_id": known["id"], "variants": prices})
+    run["updated" if changed else "unchanged"] += 1
+
+
+def price_flush_steps(run, batch):
+    # один запрос на пакет товаров; productVariantsBulkUpdate атомарен в пределах товара —
+    # товар с userErrors не записан, остальные записаны
+    variables = {}
+    for n, item in enumerate(batch):
+        variables[f"p{n}"] = f"gid://shopify/Product/{item['product_id']}"
+        variables[f"v{n}"] = [{"id": f"gid://shopify/ProductVariant/{v['id']}",
+                               **({"price": v["price"]} if "price" in v else {}),
+                               **({"compareAtPrice": v["compare_at_price"]} if "compare_at_price" in v else {})}
+                              for v in item["variants"]]
+    try:
+        res = yield ("POST", GRAPHQL_URL,
+                     {"json": {"query": variants_bulk_mutation(len(batch)), "variables": variables}})
+    except Exception as e:
+        for item in batch:
+            batch_item_failed(run, item, "Ціни", f"{type(e).__name__}: {e}")
+        return
+    try:
+        body = res.json()
+    except ValueError:
+        body = {}
+    if res.status_code >= 300 or body.get("errors"):
+        for item in batch:
+            batch_item_failed(run, item, "Ціни", body.get("errors") or res.text)
+        return
+    data = body.get("data") or {}
+    written = []
+    for n, item in enumerate(batch):
+        errors = (data.get(f"p{n}") or {}).get("userErrors") or []
+        if errors:
+            batch_item_failed(run, item, "Ціни", "; ".join(e.get("message", "") for e in errors))
+        else:
+            written.append(item)
+    if written:
+        items = [v for item in written for v in item["variants"]]
+        run["prices_written"] += len(items)
+        index_set_prices(run["idx_conn"], items)
+        log.info(f"💲 Ціни: записано {len(items)} варіантів {len(written)} товарів одним запитом")
+
+
+def stock_write_steps(run, final=False):
+    for batch in take_batches(run["prices"], PRICE_BATCH_SIZE, final):
+        yield from price_flush_steps(run, batch)
+    yield from pending_write_steps(run, final)
+
+
+def run_stock_sync(idx, groups, upd_sale, cancel=None):
+    # Быстрый режим для запуска каждые несколько минут: без PUT товаров, картинок и метафилдов,
+    # варианты и inventory_item_id — из локального индекса, все записи — пакетами GraphQL
+    run = {
+        "idx": STOCK_IDX, "upd": True, "upd_sale": upd_sale, "force_full": False,
+        "cancel": cancel or threading.Event(),
+        "fingerprints": {}, "facts": {},
+        "created": 0, "updated": 0, "unchanged": 0, "unknown": 0, "unmatched": 0, "calls": 0, "refreshed": 0,
+        "failed_skus": set(),
+        "prices": [], "prices_written": 0,
+        "inventory": [], "inventory_written": 0,
+        "metafields": [], "metafields_written": 0,
+        "write_errors": [],
+        "plan": {k: {"write": 0, "elided": 0} for k in ("price", "inventory")},
+        "queued": {}, "journal": None, "journal_ready": set(),
+        "total": len(groups) if hasattr(groups, "__len__") else None, "done": 0,
+    }
+    groups = prepare_groups(((sku, stock_rows(recs, idx)) for sku, recs in groups), STOCK_IDX, run["facts"])
+    run["idx_conn"] = index_connect()
+    ensure_fresh_index(shopify_client(), run["idx_conn"])
+
+    client = shopify_client()
+    t0 = time.time()
+    progress_update(phase="stock", total=run["total"], started_at=t0)
+
+    def plan(batch):
+        if STOCK_REFRESH:
+            drive_steps(client, run, stock_refresh_steps(run, batch))
+        for sku, recs in batch:
+            progress_tick(run, sku)
+            try:
+                stock_group_plan(run, sku, recs)
+            except Exception as e:
+                group_failed(run, sku, e)
+            progress_tick(run, done=True)
+        batch.clear()
+        drive_steps(client, run, stock_write_steps(run))
+
+    # группы копятся, пока строк не наберётся на один запрос перечитывания остатков
+    batch, rows = [], 0
+    for sku, recs in groups:
+        if run["cancel"].is_set():
+            break
+        batch.append((sku, recs))
+        rows += len(recs)
+        if rows >= STOCK_REFRESH_BATCH:
+            plan(batch)
+            rows = 0
+    if batch and not run["cancel"].is_set():
+        plan(batch)
+    # уже поставленные в очередь записи отправляем даже при отмене
+    drive_steps(client, run, stock_write_steps(run, final=True))
+    elapsed = time.time() - t0
+    SYNC_PHASE_SECONDS.observe(elapsed, phase="stock")
+
+    run["idx_conn"].close()
+    run["failed"] = len(run["failed_skus"])
+    log.info(f"🔁 Товарів зі змінами: {run['updated']}, без змін: {run['unchanged']}, "
+             f"немає в індексі: {run['unknown']}, варіантів без відповідника: {run['unmatched']}, "
+             f"з помилками: {run['failed']}")
+    log.info(f"📦 Пакетні записи: цін {run['prices_written']}, залишків {run['inventory_written']}, "
+             f"помилок {len(run['write_errors'])}; залишків перечитано з Shopify: {run['refreshed']}")
+    log.info("🧮 Планувальник (записати / пропущено як вже актуальні): " + ", ".join(
+           f"{k} {v['write']}/{v['elided']}" for k, v in run["plan"].items()))
+    log.info(f"⏱️ Залишки і ціни: {run['done']} груп за {elapsed:.1f}s, {run['calls']} запитів")
+    run["rate_limit"] = rate_limit_state()
+    return {k: run[k] for k in ("updated", "unchanged", "unknown", "unmatched", "failed", "calls",
+                                "prices_written", "inventory_written", "write_errors", "plan", "refreshed",
+                                "rate_limit")}
+
+
+# ——— Bulk-режим: productSet через staged upload + bulkOperationRunMutation ———
+PRODUCT_SET_MUTATION = """
+mutation productSet($input: ProductSetInput!, $synchronous: Boolean!) {
+  productSet(input: $input, synchronous: $synchronous) {
+    product {
+      id
+      handle
+      variants(first: 250) {
+        nodes { id sku selectedOptions { name value } inventoryItem { id } }
+      }
+    }
+    userErrors { field message code }
+  }
+}
+"""
 
-                        else:
+STAGED_UPLOAD_MUTATION = """
+mutation {
+  stagedUploadsCreate(input: [{
+    resource: BULK_MUTATION_VARIABLES,
+    filename: "bulk_op_vars.jsonl",
+    mimeType: "text/jsonl",
+    httpMethod: POST
+  }]) {
+    stagedTargets { url resourceUrl parameters { name value } }
+    userErrors { field message }
+  }
+}
+"""
 
-                            print(f"    ❌ Помилка створення Article: {res.text}", flush=True)
+BULK_RUN_MUTATION = """
+mutation bulkRun($mutation: String!, $path: String!) {
+  bulkOperationRunMutation(mutation: $mutation, stagedUploadPath: $path) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
 
-                        # 3) Остальные metafields
+BULK_CANCEL_MUTATION = """
+mutation bulkCancel($id: ID!) {
+  bulkOperationCancel(id: $id) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
 
-                        for mf_item in mf:
+BULK_STATUS_QUERY = """
+query bulkStatus($id: ID!) {
+  node(id: $id) {
+    ... on BulkOperation { id status errorCode objectCount url partialDataUrl }
+  }
+}
+"""
 
-                            if mf_item["key"] == "Article":
-                                continue
 
-                            res = shopify_request(client, "POST",
+def gid_to_id(gid):
+    return int(str(gid).rsplit("/", 1)[-1])
 
-                                                  f"https://{SHOP_NAME}.myshopify.com/admin/api/{API_VERSION}/products/{pid}/metafields.json",
 
-                                                  json={"metafield": mf_item})
+def shopify_graphql(client, query, variables=None):
+    resp = shopify_request(client, "POST", GRAPHQL_URL, json={"query": query, "variables": variables or {}})
+    try:
+        body = resp.json()
+    except ValueError:
+        body = {}
+    if resp.status_code >= 300 or body.get("errors"):
+        log.error(f"❌ Помилка GraphQL ({resp.status_code}): {body.get('errors') or resp.text}")
+        return None
+    return body.get("data") or {}
+
+
+def product_set_input(sku, spec, known, upd):
+    # REST-payload из build_product → ProductSetInput
+    p = spec["payload"]["product"]
+    opt_cols = spec["opt_cols"]
+    inp = {
+        "handle": spec["handle"],
+        "title": spec["title"],
+        "vendor": spec["vendor"],
+        "status": spec["status"].upper(),
+        "tags": [t.strip() for t in spec["tags"].split(",") if t.strip()],
+    }
+    if known:
+        inp["id"] = f"gid://shopify/Product/{known['id']}"
+    if "body_html" in p:
+        inp["descriptionHtml"] = p["body_html"]
+
+    if opt_cols:
+        inp["productOptions"] = [{"name": o["name"], "values": [{"name": v} for v in o["values"]]}
+                                 for o in spec["options"]]
+    else:
+        inp["productOptions"] = [{"name": "Title", "values": [{"name": "Default Title"}]}]
+
+    variants = []
+    for v, quantity in zip(spec["variants"], spec["facts"]["quantity"]):
+        if opt_cols:
+            option_values = [{"optionName": c, "name": v[f"option{i}"]} for i, c in enumerate(opt_cols, 1)]
+        else:
+            option_values = [{"optionName": "Title", "name": "Default Title"}]
+        sv = {"optionValues": option_values, "inventoryItem": {"sku": sku, "tracked": True}}
+        if v.get("barcode"):
+            sv["barcode"] = v["barcode"]
+        if "price" in v:
+            sv["price"] = v["price"]
+        if v.get("compare_at_price"):
+            sv["compareAtPrice"] = v["compare_at_price"]
+        if upd:
+            sv["inventoryQuantities"] = [{
+                "locationId": f"gid://shopify/Location/{LOCATION_ID}",
+                "name": "available",
+                "quantity": quantity,
+            }]
+        variants.append(sv)
+    inp["variants"] = variants
+
+    # пустые значения GraphQL не принимает
+    inp["metafields"] = [{k: m[k] for k in ("namespace", "key", "type", "value")}
+                         for m in spec["mf"] if m["value"]]
+    inp["metafields"].append({"namespace": "custom", "key": "Article", "type": "single_line_text_field",
+                              "value": sku})
+    if spec["images"]:
+        inp["files"] = [{"originalSource": u, "contentType": "IMAGE"} for u in spec["images"]]
+    return inp
+
+
+def product_from_graphql(node):
+    # приводим ответ productSet к форме REST, чтобы сохранить в индекс
+    variants = []
+    for v in node.get("variants", {}).get("nodes", []):
+        opts = v.get("selectedOptions") or [{}]
+        variants.append({
+            "id": gid_to_id(v["id"]),
+            "inventory_item_id": gid_to_id(v["inventoryItem"]["id"]) if v.get("inventoryItem") else None,
+            "option1": opts[0].get("value"),
+            "sku": v.get("sku"),
+        })
+    return {"id": gid_to_id(node["id"]), "handle": node.get("handle"), "variants": variants}
+
+
+def staged_upload_jsonl(client, path):
+    data = shopify_graphql(client, STAGED_UPLOAD_MUTATION)
+    if data is None:
+        return None
+    res = data["stagedUploadsCreate"]
+    if res["userErrors"]:
+        log.error(f"❌ stagedUploadsCreate: {res['userErrors']}")
+        return None
+    target = res["stagedTargets"][0]
+    params = {p["name"]: p["value"] for p in target["parameters"]}
+    # файл уходит напрямую в хранилище — без токена Shopify в заголовках
+    with open(path, "rb") as f:
+        up = httpx.post(target["url"], data=params, files={"file": ("bulk_op_vars.jsonl", f, "text/jsonl")},
+                        timeout=Timeout(300, connect=10))
+    if up.status_code >= 300:
+        log.error(f"❌ Помилка завантаження JSONL ({up.status_code}): {up.text}")
+        return None
+    log.info(f"📤 JSONL завантажено ({os.path.getsize(path)} байт)")
+    return params.get("key")
+
+
+def wait_bulk_operation(client, op_id, cancel=None):
+    # итоговый статус операции; при тайм-ауте, отмене задачи или недоступном Shopify — отменяем операцию
+    # (иначе она заняла бы слот bulk-мутации магазина) и отдаём status=UNKNOWN
+    cancel = cancel or threading.Event()
+    deadline = time.monotonic() + BULK_POLL_TIMEOUT
+    failures = 0
+    while True:
+        if cancel.wait(BULK_POLL_INTERVAL):
+            reason = "синхронізацію скасовано"
+            break
+        data = shopify_graphql(client, BULK_STATUS_QUERY, {"id": op_id})
+        if data is None:
+            failures += 1
+            if failures >= BULK_POLL_RETRIES:
+                reason = f"{failures} невдалих опитувань поспіль"
+                break
+            log.warning(f"⚠️ Не вдалося опитати bulk-операцію ({failures}/{BULK_POLL_RETRIES}) — повторимо")
+        else:
+            failures = 0
+            op = data.get("node") or {}
+            log.info(f"    ⏳ Bulk-операція: {op.get('status')}, оброблено {op.get('objectCount')}")
+            if op.get("status") in ("COMPLETED", "FAILED", "CANCELED", "EXPIRED"):
+                return op
+        if time.monotonic() > deadline:
+            reason = f"не завершилась за {BULK_POLL_TIMEOUT:g}s"
+            break
+    log.warning(f"⚠️ Bulk-операція {op_id}: {reason} — скасовуємо, результат товарів невідомий")
+    data = shopify_graphql(client, BULK_CANCEL_MUTATION, {"id": op_id})
+    errors = ((data or {}).get("bulkOperationCancel") or {}).get("userErrors")
+    if errors:
+        log.warning(f"⚠️ bulkOperationCancel: {errors}")
+    return {"id": op_id, "status": "UNKNOWN", "reason": reason}
+
+
+def parse_bulk_results(text, line_skus):
+    # каждая строка результата несёт __lineNumber строки входного JSONL
+    outcomes = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        rec = json.loads(line)
+        n = rec.get("__lineNumber")
+        if n is None or n >= len(line_skus):
+            continue
+        res = (rec.get("data") or {}).get("productSet") or {}
+        outcomes[line_skus[n]] = {
+            "product": res.get("product"),
+            "errors": res.get("userErrors") or rec.get("errors") or [],
+        }
+    return outcomes
+
+
+def run_bulk_sync(client, header, idx, groups, upd, upd_sale, upd_desc, force_full=False, cancel=None):
+    sync_state = load_sync_state()
+    fingerprints = sync_state["fingerprints"]
+    config_sig = sync_config_sig(header, upd, upd_sale, upd_desc)
+    summary = {"created": 0, "updated": 0, "failed": 0, "unchanged": 0, "unknown": 0}
+    excel = get_excel_map() or {}
+
+    idx_conn = index_connect()
+    ensure_fresh_index(client, idx_conn)
+
+    # 1) компилируем все изменённые группы в один JSONL; цены и остатки — одним проходом pandas
+    with timed_phase("preprocess"):
+        facts = dict(zip(groups, split_facts(preprocess_rows([r for recs in groups.values() for r in recs], idx),
+                                             [len(recs) for recs in groups.values()])))
+    line_skus, line_fps, line_known = [], [], []
+    seen_handles = set()
+    with open(BULK_JSONL_FILE, "w", encoding="utf-8") as out:
+        for sku, recs in groups.items():
+            xl = excel.get(f"{sku}-{recs[0][idx['GoodID']]}")
+            fp = group_fingerprint(recs, xl, config_sig)
+            if not force_full and fingerprints.get(sku) == fp:
+                summary["unchanged"] += 1
+                continue
+            try:
+                spec = build_product(sku, recs, idx, xl, upd, upd_sale, upd_desc, facts.get(sku))
+            except ValueError as e:
+                log.error(f"    ❌ Articul={sku}: {e}")
+                summary["failed"] += 1
+                fingerprints.pop(sku, None)
+                continue
+            if spec["handle"] in seen_handles:
+                log.warning(f"⚠️ Пропускаємо дублікат — handle={spec['handle']} вже оброблений")
+                continue
+            seen_handles.add(spec["handle"])
+            known = index_lookup(idx_conn, handle=spec["handle"])
+            inp = product_set_input(sku, spec, known, upd)
+            out.write(json.dumps({"input": inp, "synchronous": True}, ensure_ascii=False) + "\n")
+            line_skus.append(sku)
+            line_fps.append(fp)
+            line_known.append(bool(known))
+    log.info(f"📦 Bulk JSONL: {len(line_skus)} товарів, без змін: {summary['unchanged']}")
+
+    if not line_skus or (cancel and cancel.is_set()):
+        idx_conn.close()
+        return summary
+
+    # 2) staged upload → bulkOperationRunMutation → ожидание
+    op = None
+    path = staged_upload_jsonl(client, BULK_JSONL_FILE)
+    if path:
+        data = shopify_graphql(client, BULK_RUN_MUTATION, {"mutation": PRODUCT_SET_MUTATION, "path": path})
+        res = (data or {}).get("bulkOperationRunMutation") or {}
+        if res.get("userErrors"):
+            log.error(f"❌ bulkOperationRunMutation: {res['userErrors']}")
+        elif res.get("bulkOperation"):
+            log.info(f"🚀 Bulk-операцію запущено: {res['bulkOperation']['id']}")
+            op = wait_bulk_operation(client, res["bulkOperation"]["id"], cancel)
+
+    # 3) разбираем результат по SKU
+    outcomes = {}
+    if op:
+        result_url = op.get("url") or op.get("partialDataUrl")
+        if op.get("status") not in ("COMPLETED", "UNKNOWN"):
+            log.error(f"❌ Bulk-операція завершилась зі статусом {op.get('status')} ({op.get('errorCode')})")
+        if result_url:
+            outcomes = parse_bulk_results(httpx.get(result_url, timeout=Timeout(300, connect=10)).text, line_skus)
+
+    unknown = op is not None and op.get("status") == "UNKNOWN"
+    for sku, fp, was_known in zip(line_skus, line_fps, line_known):
+        o = outcomes.get(sku)
+        if o and o["product"] and not o["errors"]:
+            summary["updated" if was_known else "created"] += 1
+            fingerprints[sku] = fp
+            index_store_product(idx_conn, product_from_graphql(o["product"]), sku)
+        elif unknown:
+            # Shopify мог дописать товар уже после отмены — это не ошибка товара; отправим его ещё раз
+            summary["unknown"] += 1
+            fingerprints.pop(sku, None)
+        else:
+            summary["failed"] += 1
+            fingerprints.pop(sku, None)
+            log.error(f"    ❌ Articul={sku}: {o['errors'] if o else 'немає результату'}")
+
+    if summary["unknown"]:
+        # часть товаров могла появиться в Shopify без записи в индексе — следующий запуск перестроит его
+        with idx_conn:
+            idx_conn.execute("DELETE FROM meta WHERE key = 'rebuilt_at'")
+    idx_conn.close()
+    save_sync_state(sync_state)
+    return summary
+
+
+# ——— Прогресс текущего запуска: общий снимок для /progress и Server-Sent Events ———
+PROGRESS_RATE_WINDOW = 60        # секунд для скользящей скорости и ETA
+PROGRESS_MIN_INTERVAL = 0.5      # не чаще одного события SSE за столько секунд
+
+_progress = {"version": 0, "job_id": None, "status": "idle", "finished": True}
+_progress_cond = threading.Condition()
+
+
+def progress_update(**fields):
+    with _progress_cond:
+        _progress.update(fields)
+        _progress["version"] += 1
+        _progress["updated_at"] = time.time()
+        _progress_cond.notify_all()
+
+
+def progress_reset(job):
+    with _progress_cond:
+        _progress.clear()
+        _progress.update(version=0, job_id=job["id"], kind=job["kind"], status="running", finished=False,
+                         phase="ftp", started_at=time.time(), total=None, done=0, created=0, updated=0,
+                         unchanged=0, failed=0, calls=0, current_sku=None, calls_per_sec=None,
+                         groups_per_min=None, eta=None, message=None)
+    progress_update()
+
+
+def progress_tick(run, sku=None, done=False):
+    # вызывается движком до и после каждой группы; скорость — по окну последних PROGRESS_RATE_WINDOW секунд
+    now = time.time()
+    if done:
+        run["done"] += 1
+    samples = run.setdefault("progress_samples", deque())
+    samples.append((now, run["done"], run["calls"]))
+    while len(samples) > 2 and now - samples[0][0] > PROGRESS_RATE_WINDOW:
+        samples.popleft()
+    t_old, done_old, calls_old = samples[0]
+    span = now - t_old
+    groups_rate = (run["done"] - done_old) / span if span > 0 else None
+    fields = {
+        "done": run["done"], "created": run["created"], "updated": run["updated"],
+        "unchanged": run["unchanged"], "failed": len(run["failed_skus"]), "calls": run["calls"],
+        "calls_per_sec": round((run["calls"] - calls_old) / span, 2) if span > 0 else None,
+        "groups_per_min": round(groups_rate * 60, 1) if groups_rate else None,
+        "eta": round((run["total"] - run["done"]) / groups_rate) if groups_rate and run["total"] else None,
+    }
+    if sku is not None:
+        fields["current_sku"] = sku
+    progress_update(**fields)
 
-                            if res.status_code < 300:
 
-                                print(f"    ✅ MF '{mf_item['key']}' створено", flush=True)
+def progress_snapshot():
+    with _progress_cond:
+        return dict(_progress)
 
-                            else:
 
-                                print(f"    ❌ Помилка створення MF '{mf_item['key']}': {res.text}", flush=True)
+@app.route("/progress", methods=["GET"])
+def progress():
+    # состояние лимитера Shopify — здесь, а не в SSE: оно меняется на каждом запросе
+    return jsonify(dict(progress_snapshot(), rate_limit=rate_limit_state()))
 
 
-                    else:
+@app.route("/progress/stream", methods=["GET"])
+def progress_stream():
+    # SSE: событие на каждое изменение (не чаще PROGRESS_MIN_INTERVAL), keepalive раз в 15 с;
+    # поток закрывается, когда закончился запуск из ?job=
+    job_id = request.args.get("job")
 
+    def events():
+        seen = None
+        while True:
+            with _progress_cond:
+                if _progress["version"] == seen:
+                    _progress_cond.wait(15)
+                snap = dict(_progress) if _progress["version"] != seen else None
+            if snap is None:
+                yield ": keepalive\n\n"
+                continue
+            seen = snap["version"]
+            yield f"data: {json.dumps(snap, ensure_ascii=False)}\n\n"
+            if snap.get("finished") and (job_id is None or snap.get("job_id") == job_id):
+                return
+            time.sleep(PROGRESS_MIN_INTERVAL)
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# ——— Фоновые задачи синхронизации: одна очередь, один исполнитель ———
+SYNC_JOB_KINDS = {
+    "import": "дельта-синхронізація",
+    "import_full": "повна синхронізація",
+    "import_bulk": "bulk-синхронізація",
+    "import_stock": "залишки і ціни",
+    "rebuild_index": "перебудова індексу товарів",
+}
+JOB_HISTORY_SIZE = 20
+
+_jobs = {}                   # job_id → описание задачи (последние JOB_HISTORY_SIZE)
+_job_queue = []              # id задач в статусе queued
+_jobs_lock = threading.Condition()
+_job_worker = None
+
+
+def _job_public(job):
+    return {k: v for k, v in job.items() if k != "cancel"}
+
+
+def submit_sync_job(kind, reason="manual"):
+    global _job_worker
+    with _jobs_lock:
+        # повторный запуск того же вида сливается только с ещё не начатым: идущий прогон мог уже прочитать
+        # файл, и новая выгрузка (загрузка на встроенный FTP, кнопка) иначе осталась бы необработанной
+        for job in _jobs.values():
+            if job["kind"] == kind and job["status"] == "queued":
+                log.info(f"ℹ️ {SYNC_JOB_KINDS[kind]} вже в черзі (job {job['id']}) — новий запуск об'єднано")
+                return _job_public(job)
+
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "kind": kind,
+            "reason": reason,
+            "status": "queued",
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "summary": None,
+            "message": None,
+            "cancel": threading.Event(),
+        }
+        _jobs[job["id"]] = job
+        _job_queue.append(job["id"])
+        while len(_jobs) > JOB_HISTORY_SIZE:
+            oldest = next((j for j in _jobs.values() if j["status"] not in ("queued", "running")), None)
+            if oldest is None:
+                break
+            del _jobs[oldest["id"]]
+
+        if _job_worker is None or not _job_worker.is_alive():
+            _job_worker = threading.Thread(target=_job_worker_loop, name="sync-worker", daemon=True)
+            _job_worker.start()
+        _jobs_lock.notify_all()
+        return _job_public(job)
+
+
+def cancel_sync_job(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        if job["status"] == "queued":
+            _job_queue.remove(job_id)
+            job["status"] = "cancelled"
+            job["finished_at"] = time.time()
+        elif job["status"] == "running":
+            # исполнитель проверяет флаг между группами
+            job["cancel"].set()
+        return _job_public(job)
+
+
+def get_sync_job(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return _job_public(job) if job else None
+
+
+def active_sync_job():
+    with _jobs_lock:
+        for job in _jobs.values():
+            if job["status"] in ("queued", "running"):
+                return _job_public(job)
+    return None
+
+
+def _job_worker_loop():
+    while True:
+        with _jobs_lock:
+            while not _job_queue:
+                _jobs_lock.wait()
+            job = _jobs[_job_queue.pop(0)]
+            job["status"] = "running"
+            job["started_at"] = time.time()
+
+        run_log = begin_run_log(job)
+        progress_reset(job)
+        try:
+            tape_begin(job)
+            summary = execute_sync(job["kind"], job["cancel"])
+            status = "cancelled" if job["cancel"].is_set() else ("done" if summary.get("ok", True) else "failed")
+        except Exception as e:
+            log.error(f"❌ Синхронізація впала: {type(e).__name__}: {e}")
+            summary = {"ok": False, "message": f"{type(e).__name__}: {e}"}
+            status = "failed"
+        finally:
+            tape = tape_end()
+            end_run_log(run_log)
+        if tape:
+            summary["tape"] = tape
+        SYNC_RUNS.inc(kind=job["kind"], status=status)
+        progress_update(status=status, finished=True, message=summary.get("message"), current_sku=None, eta=None)
+
+        with _jobs_lock:
+            job["status"] = status
+            job["summary"] = summary
+            job["message"] = summary.get("message")
+            job["finished_at"] = time.time()
+
+
+def execute_sync(kind, cancel):
+    ua_now = datetime.now(SCHEDULER_TZ)
+    log.info("%s %s", ua_now.strftime("%Y-%m-%d %H:%M:%S %Z"), f"🔄 Старт: {SYNC_JOB_KINDS[kind]}")
+
+    # сохраняем, как пользователь поставил чекбоксы
+    sync_settings = app.config["SYNC_SETTINGS"]
+    upd = sync_settings["update_price_qty"]
+    upd_sale = sync_settings["update_sale_price"]
+    upd_desc = sync_settings["update_description"]
+
+    if kind == "rebuild_index":
+        # через очередь, а не в запросе: индекс не очищается под идущей синхронизацией
+        progress_update(phase="index_rebuild")
+        idx_conn = index_connect()
+        try:
+            ok = rebuild_shopify_index(shopify_client(), idx_conn)
+        finally:
+            idx_conn.close()
+        return {"ok": ok, "message": "Індекс товарів перебудовано" if ok else "Не вдалося перебудувати індекс"}
+
+    # без Excel-мапинга товары ушли бы без названий и картинок — такой прогон не запускаем
+    # (быстрому режиму он не нужен: названия и картинки он не пишет)
+    if kind == "import_stock" and not upd:
+        log.warning("⚠️ Оновлення цін/залишків вимкнено в налаштуваннях")
+        return {"ok": False, "message": "Оновлення цін/залишків вимкнено — синхронізацію не запущено"}
+    if kind != "import_stock" and get_excel_map() is None:
+        log.error(f"❌ Excel-мапінг недоступний ({excel_status()['error'] or 'ще завантажується'})")
+        return {"ok": False, "message": "Excel-мапінг недоступний — синхронізацію не запущено"}
+
+    state = load_sync_state()
+    last_export = state.get("last_export")
+    # полная синхронизация не смотрит на то, обрабатывался ли уже этот файл
+    force = kind == "import_full"
+    conn_before = connection_stats()
+    with feed_session() as session:
+        if kind == "import_stock":
+            summary = _execute_stock_feed(cancel, session, state.get("last_stock_export"), upd_sale)
+        else:
+            summary = _execute_sync_feed(kind, cancel, session, last_export, force, upd, upd_sale, upd_desc)
+    summary["connections"] = c = connection_report(conn_before)
+    if c["requests"]:
+        log.info(f"🔌 З'єднання з Shopify: {c['requests']} запитів, нових з'єднань {c['connects']} (TLS {c['tls']}), "
+                 f"повторно використано {c['reuse_ratio']:.0%}; "
+                 + ", ".join(f"{v} — {n}" for v, n in sorted(c["versions"].items())))
+    return summary
+
+
+def _execute_sync_feed(kind, cancel, session, last_export, force, upd, upd_sale, upd_desc):
+    progress_update(phase="ftp")
+    feed_stats = None
+    if FEED_STREAMING and kind != "import_bulk":
+        # bulk-режим собирает один JSONL на весь файл — ему поток не нужен
+        feed, export = open_feed_stream(session, last_export, force)
+        if feed:
+            header, idx, groups, feed_stats = feed
+    else:
+        txt, export = fetch_file_from_ftp(session, last_export, force)
+        if txt:
+            header, idx, groups = parse_feed(txt)
+            groups = groups.items()
+        elif export and not export.get("unchanged"):
+            log.warning("⚠️ Файл Торгсофт порожній")
+            return {"ok": False, "message": "Порожній файл Торгсофт"}
+    if export and export.get("unchanged"):
+        if export.get("reuploaded"):
+            # новые SIZE/MDTM запоминаем, а файл убираем как обработанный — иначе его качали бы каждый запуск
+            mark_export_processed(export)
+            delete_ftp_file(session)
+        return {"ok": True, "skipped": True, "message": "Файл Торгсофт не змінився — синхронізацію пропущено"}
+    if not export:
+        return {"ok": False, "message": "Немає файлу Торгсофт"}
+
+    if kind == "import_bulk":
+        groups = dict(groups)
+        progress_update(phase="bulk", total=len(groups))
+        with timed_phase("bulk"):
+            summary = run_bulk_sync(shopify_client(), header, idx, groups, upd, upd_sale, upd_desc, cancel=cancel)
+        for result in ("created", "updated", "unchanged", "failed"):
+            SYNC_PRODUCTS.inc(summary[result], result=result)
+        summary["message"] = (f"Bulk-синхронізація завершена: створено={summary['created']}, "
+                              f"оновлено={summary['updated']}, помилок={summary['failed']}, "
+                              f"без змін={summary['unchanged']}")
+        if summary["unknown"]:
+            summary["ok"] = False
+            summary["message"] += f", результат невідомий={summary['unknown']} (bulk-операцію скасовано)"
+        # файл удаляем только если все товары приняты — иначе повторим ночью
+        delete_file = summary["failed"] == 0 and summary["unknown"] == 0
+    else:
+        try:
+            summary = run_rest_sync(header, idx, groups, upd, upd_sale, upd_desc,
+                                    force_full=force, cancel=cancel, export=export)
+        finally:
+            if feed_stats is not None:
+                groups.close()
+        summary["message"] = (f"Синхронізація завершена: створено={summary['created']}, "
+                              f"оновлено={summary['updated']}, змінено={summary['changed']}, "
+                              f"без змін={summary['unchanged']}")
+        if summary["resumed"]:
+            summary["message"] += f", продовжено з журналу={summary['resumed']}"
+        # файл удаляем, только когда журнал полный; иначе следующий запуск продолжит с первой незавершённой группы
+        delete_file = summary["journal_complete"] if summary["journal"] else summary["failed"] == 0
+        if feed_stats and feed_stats["error"]:
+            # файл прочитан не до конца — оставляем его на FTP для следующего запуска
+            summary["ok"] = False
+            summary["message"] = f"Файл прочитано не повністю ({feed_stats['error']}) — " + summary["message"]
+            delete_file = False
+        elif not delete_file and not cancel.is_set():
+            log.warning(f"⚠️ Не всі групи завершено ({summary['failed']} з помилками) — файл на FTP залишається, "
+                        f"наступний запуск продовжить з журналу")
+
+    if cancel.is_set():
+        summary["message"] = "Синхронізацію скасовано — " + summary["message"]
+        log.info("⏹️ Синхронізацію скасовано, файл на FTP залишається")
+    log.info(f"\n🏁 {summary['message']}\n")
+
+    if delete_file and not cancel.is_set():
+        if kind != "import_bulk" and summary["journal"]:
+            conn = index_connect()
+            journal_finish(conn, summary["journal"])
+            conn.close()
+        mark_export_processed(export)
+        delete_ftp_file(session)
+    return summary
+
+
+def _execute_stock_feed(cancel, session, last_export, upd_sale):
+    # файл на FTP не удаляем и не отмечаем обработанным для полной синхронизации —
+    # его всё ещё ждёт ночной прогон
+    progress_update(phase="ftp")
+    feed_stats = None
+    if FEED_STREAMING:
+        feed, export = open_feed_stream(session, last_export)
+        if feed:
+            header, idx, groups, feed_stats = feed
+    else:
+        txt, export = fetch_file_from_ftp(session, last_export)
+        if txt:
+            header, idx, groups = parse_feed(txt)
+            groups = groups.items()
+        elif export and not export.get("unchanged"):
+            log.warning("⚠️ Файл Торгсофт порожній")
+            return {"ok": False, "message": "Порожній файл Торгсофт"}
+    if export and export.get("unchanged"):
+        if export.get("reuploaded"):
+            # файл на FTP оставляем полной синхронизации — запоминаем только новые SIZE/MDTM
+            mark_export_processed(export, "last_stock_export")
+        return {"ok": True, "skipped": True, "message": "Файл Торгсофт не змінився — залишки і ціни вже актуальні"}
+    if not export:
+        return {"ok": False, "message": "Немає файлу Торгсофт"}
 
-                        print(f"    ❌ Помилка створення товару: {r2.text}", flush=True)
+    try:
+        summary = run_stock_sync(idx, groups, upd_sale, cancel=cancel)
+    finally:
+        if feed_stats is not None:
+            groups.close()
+    summary["message"] = (f"Залишки і ціни: оновлено товарів={summary['updated']}, без змін={summary['unchanged']}, "
+                          f"немає в індексі={summary['unknown']}, помилок={summary['failed']}")
+    if feed_stats and feed_stats["error"]:
+        summary["ok"] = False
+        summary["message"] = f"Файл прочитано не повністю ({feed_stats['error']}) — " + summary["message"]
+    elif cancel.is_set():
+        summary["message"] = "Синхронізацію скасовано — " + summary["message"]
+    elif summary["failed"] == 0:
+        # с ошибками тот же файл пройдём ещё раз при следующем запуске
+        mark_export_processed(export, "last_stock_export")
+    log.info(f"\n🏁 {summary['message']}\n")
+    return summary
+
+
+# ——— Автозапуск: наблюдение за файлом на FTP и расписание ———
+_scheduler = {"entries": [], "watch": None, "receiver": None, "last_trigger": None, "triggered": None, "error": None}
+_scheduler_lock = threading.Lock()
+_scheduler_thread = None
+_ftp_receiver = None
+
+
+def parse_sync_schedule(spec):
+    # "03:00=import_full, */15=import_stock" → [{"spec", "kind", "at"|"every"}]; ошибки — в лог, запись пропускаем
+    entries = []
+    for part in re.split(r"[,;]", spec):
+        part = part.strip()
+        if not part:
+            continue
+        when, _, kind = part.partition("=")
+        when, kind = when.strip(), kind.strip() or "import"
+        m = re.fullmatch(r"(\d{1,2}):(\d{2})", when)
+        every = re.fullmatch(r"\*/(\d+)", when)
+        if kind not in SYNC_JOB_KINDS:
+            log.warning(f"⚠️ SYNC_SCHEDULE: невідомий вид синхронізації «{kind}» у «{part}» — пропускаємо")
+        elif m and int(m[1]) < 24 and int(m[2]) < 60:
+            entries.append({"spec": part, "kind": kind, "at": (int(m[1]), int(m[2]))})
+        elif every and 0 < int(every[1]) <= 1440:
+            entries.append({"spec": part, "kind": kind, "every": int(every[1])})
+        else:
+            log.warning(f"⚠️ SYNC_SCHEDULE: не розібрано «{part}» (очікується HH:MM=вид або */N=вид)")
+    return entries
+
+
+def next_fire(entry, after):
+    # следующий момент срабатывания строго после after (aware datetime в SCHEDULER_TZ)
+    midnight = after.replace(hour=0, minute=0, second=0, microsecond=0)
+    if "at" in entry:
+        t = midnight.replace(hour=entry["at"][0], minute=entry["at"][1])
+        return t if t > after else (midnight + timedelta(days=1)).replace(hour=entry["at"][0], minute=entry["at"][1])
+    # */N — кратные N минутам от полуночи, как в cron
+    minutes = (after.hour * 60 + after.minute) // entry["every"] * entry["every"] + entry["every"]
+    if minutes >= 24 * 60:
+        return midnight + timedelta(days=1)
+    return midnight.replace(hour=minutes // 60, minute=minutes % 60)
+
+
+def scheduler_trigger(kind, reason):
+    job = submit_sync_job(kind, reason=reason)
+    log.info(f"⏰ Автозапуск: {SYNC_JOB_KINDS[kind]} — {reason} (job {job['id']})")
+    with _scheduler_lock:
+        _scheduler["last_trigger"] = {"at": time.time(), "kind": kind, "reason": reason, "job_id": job["id"]}
+
+
+def watch_poll(session):
+    # Один дешёвый опрос FTP: SIZE/MDTM без загрузки. Новый файл запускает синхронизацию, только когда
+    # SIZE и MDTM не менялись SYNC_WATCH_DEBOUNCE секунд — Торгсофт мог ещё не дописать его
+    watch = _scheduler["watch"]
+    watch["last_poll_at"] = time.time()
+    try:
+        remote = ftp_file_stat(session.get(), FTP_FILE_PATH)
+    except error_perm:
+        # 550: файла нет — прошлый уже обработан и удалён
+        remote = None
+    if remote is None:
+        watch.update(file=None, changed_at=None)
+        return
+    sig = (remote["size"], remote["mdtm"])
+    if watch["file"] != sig:
+        if watch["file"] is not None:
+            log.debug(f"📝 {FTP_FILE_PATH} змінюється: {remote['size']} байт, MDTM={remote['mdtm']}")
+        watch.update(file=sig, changed_at=time.time())
+        return
+    if time.time() - watch["changed_at"] < SYNC_WATCH_DEBOUNCE or _scheduler["triggered"] == sig:
+        return
+    last = load_sync_state().get("last_stock_export" if SYNC_WATCH_KIND == "import_stock" else "last_export")
+    if same_export(remote, last):
+        _scheduler["triggered"] = sig
+        return
+    if active_sync_job():
+        # запуски не перекрываются: новый файл подхватим после текущего
+        return
+    _scheduler["triggered"] = sig
+    scheduler_trigger(SYNC_WATCH_KIND, f"новий файл на FTP ({remote['size']} байт, MDTM={remote['mdtm']})")
+
+
+def _scheduler_loop():
+    session = feed_session()
+    now = datetime.now(SCHEDULER_TZ)
+    for entry in _scheduler["entries"]:
+        entry["next_at"] = next_fire(entry, now)
+    next_poll = time.time()
+    while True:
+        now = datetime.now(SCHEDULER_TZ)
+        for entry in _scheduler["entries"]:
+            if now >= entry["next_at"]:
+                scheduler_trigger(entry["kind"], f"за розкладом {entry['spec']}")
+                entry["next_at"] = next_fire(entry, now)
+        # пока идёт синхронизация, FTP не опрашиваем — файл как раз читается или удаляется
+        if _scheduler["watch"] and time.time() >= next_poll and not active_sync_job():
+            next_poll = time.time() + SYNC_WATCH_INTERVAL
+            try:
+                watch_poll(session)
+                _scheduler["error"] = None
+            except Exception as e:
+                if _scheduler["error"] is None:
+                    log.warning(f"⚠️ Автозапуск: FTP недоступний ({type(e).__name__}: {e})")
+                _scheduler["error"] = f"{type(e).__name__}: {e}"
+                session.close()
+        time.sleep(SCHEDULER_TICK)
+
+
+def start_scheduler():
+    global _scheduler_thread
+    _scheduler["entries"] = parse_sync_schedule(SYNC_SCHEDULE)
+    if SYNC_WATCH_INTERVAL > 0:
+        if SYNC_WATCH_KIND not in SYNC_JOB_KINDS:
+            log.warning(f"⚠️ SYNC_WATCH_KIND: невідомий вид синхронізації «{SYNC_WATCH_KIND}» — FTP не відстежуємо")
+        else:
+            _scheduler["watch"] = {"kind": SYNC_WATCH_KIND, "last_poll_at": None, "file": None, "changed_at": None}
+    if not _scheduler["entries"] and not _scheduler["watch"]:
+        return
+    if _scheduler_thread is None or not _scheduler_thread.is_alive():
+        _scheduler_thread = threading.Thread(target=_scheduler_loop, name="sync-scheduler", daemon=True)
+        _scheduler_thread.start()
+    log.info("⏰ Автозапуск: " + ", ".join(
+        [f"FTP кожні {SYNC_WATCH_INTERVAL:g}s → {SYNC_WATCH_KIND}"] * bool(_scheduler["watch"])
+        + [e["spec"] for e in _scheduler["entries"]]))
+
+
+def ftp_file_received(path):
+    # Торгсофт дозагрузил файл на встроенный FTP — синхронизация сразу в очередь, без опроса
+    target = os.path.join(FTP_RECEIVER_DIR, FTP_FILE_PATH.lstrip("/"))
+    os.replace(path, target)
+    size = os.path.getsize(target)
+    log.info(f"📥 Вбудований FTP: отримано {FTP_FILE_PATH} ({size} байт)")
+    _scheduler["receiver"]["received_at"] = time.time()
+    scheduler_trigger(FTP_RECEIVER_KIND, f"завантажено на вбудований FTP ({size} байт)")
+
+
+def passive_port_range(spec):
+    # «60000-60010» → [60000 … 60010]; пусто — порты выбирает ОС
+    if not spec.strip():
+        return None
+    lo, _, hi = spec.partition("-")
+    return list(range(int(lo), int(hi or lo) + 1))
+
+
+def start_ftp_receiver():
+    global _ftp_receiver
+    if not FTP_RECEIVER_PORT or _ftp_receiver is not None:
+        return
+    if FTPHandler is None:
+        log.warning("⚠️ FTP_RECEIVER_PORT задано, але pyftpdlib не встановлено — вбудований FTP вимкнено")
+        return
+    target = os.path.join(FTP_RECEIVER_DIR, FTP_FILE_PATH.lstrip("/"))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    auth = DummyAuthorizer()
+    auth.add_user(FTP_RECEIVER_USER, FTP_RECEIVER_PASS, FTP_RECEIVER_DIR, perm="elradfmwMT")
+
+    class ReceiverHandler(FTPHandler):
+        authorizer = auth
+        masquerade_address = FTP_RECEIVER_MASQUERADE
+        passive_ports = passive_port_range(FTP_RECEIVER_PASSIVE_PORTS)
+
+        def ftp_STOR(self, file, mode="w"):
+            # пишем во временный файл: конвейер никогда не видит недогруженную выгрузку
+            return super().ftp_STOR(file + ".part", mode)
+
+        def on_file_received(self, file):
+            if os.path.abspath(file) == os.path.abspath(target + ".part"):
+                ftp_file_received(file)
+            else:
+                os.replace(file, file[:-len(".part")])
+
+        def ftp_RNTO(self, path):
+            # загрузка во временное имя и RNFR/RNTO в TSGoods.trs: on_file_received для переименования не вызывается
+            renamed = super().ftp_RNTO(path)
+            if renamed and os.path.abspath(path) == os.path.abspath(target):
+                ftp_file_received(path)
+            return renamed
+
+        def on_incomplete_file_received(self, file):
+            log.warning(f"⚠️ Вбудований FTP: завантаження {os.path.basename(file)} обірвалось — чекаємо повтору")
+
+    server = ThreadedFTPServer((FTP_RECEIVER_HOST, FTP_RECEIVER_PORT), ReceiverHandler)
+    # журнал pyftpdlib — только предупреждения, в те же /report и stdout (иначе он настроит свой вывод в stderr)
+    ftp_log = logging.getLogger("pyftpdlib")
+    ftp_log.setLevel(logging.WARNING)
+    ftp_log.propagate = False
+    ftp_log.addHandler(log_ring)
+    ftp_log.addHandler(log_stdout)
+    _ftp_receiver = threading.Thread(target=server.serve_forever, kwargs={"handle_exit": False},
+                                     name="ftp-receiver", daemon=True)
+    _ftp_receiver.start()
+    _scheduler["receiver"] = {"address": f"{FTP_RECEIVER_HOST}:{server.socket.getsockname()[1]}",
+                              "kind": FTP_RECEIVER_KIND, "received_at": None}
+    log.info(f"📥 Вбудований FTP слухає {_scheduler['receiver']['address']}, файл → {FTP_RECEIVER_KIND}")
+
+
+def scheduler_status():
+    # для страницы настроек и /healthz: ближайший запуск и причина последнего
+    def fmt(ts):
+        return ts and datetime.fromtimestamp(ts, SCHEDULER_TZ).strftime("%Y-%m-%d %H:%M:%S")
+
+    entries = [{"spec": e["spec"], "kind": e["kind"], "next_at": e.get("next_at") and
+                e["next_at"].strftime("%Y-%m-%d %H:%M")} for e in _scheduler["entries"]]
+    upcoming = min((e for e in _scheduler["entries"] if e.get("next_at")), key=lambda e: e["next_at"], default=None)
+    watch, receiver = _scheduler["watch"], _scheduler["receiver"]
+    with _scheduler_lock:
+        last = _scheduler["last_trigger"] and dict(_scheduler["last_trigger"])
+    if last:
+        last["at"] = fmt(last["at"])
+    return {
+        "enabled": bool(entries or watch or receiver),
+        "receiver": receiver and dict(receiver, received_at=fmt(receiver["received_at"])),
+        "schedule": entries,
+        "next_run": upcoming and {"at": upcoming["next_at"].strftime("%Y-%m-%d %H:%M"), "kind": upcoming["kind"]},
+        "watch": watch and {"kind": watch["kind"], "interval": SYNC_WATCH_INTERVAL, "debounce": SYNC_WATCH_DEBOUNCE,
+                            "last_poll_at": fmt(watch["last_poll_at"]),
+                            "file": watch["file"] and {"size": watch["file"][0], "mdtm": watch["file"][1]},
+                            "error": _scheduler["error"]},
+        "last_trigger": last,
+    }
 
-            print(f"\n🏁 Синхронізація завершена: створено={created}, оновлено={updated}\n", flush=True)
-            flash(f": Синхронізація завершена: створено={created}, оновлено={updated}")
 
-            try:
-                ftp = FTP(FTP_HOST)
-                ftp.login(FTP_USER, FTP_PASS)
+@app.route('/settings/save', methods=['POST'])
+def save_settings():
+    data = request.get_json()
+    # читаем текущее
+    try:
+        cfg = json.load(open(SETTINGS_FILE))
+    except FileNotFoundError:
+        cfg = {}
+    # обновляем
+    cfg[data['key']] = bool(data['value'])
+    # сохраняем
+    with open(SETTINGS_FILE, 'w') as f:
+        json.dump(cfg, f)
+    return '', 204
 
-                # Определяем директорию и имя файла
-                directory, filename = os.path.split(FTP_FILE_PATH)
-                directory = directory or "/"
+@app.route("/settings", methods=["GET", "POST"])
+def settings():
+    view = request.args.get("view", "sync")
+    if request.method == "GET":
+        sync_settings = app.config.get("SYNC_SETTINGS", DEFAULT_SYNC_SETTINGS)
+        job_id = request.args.get("job")
+        job = get_sync_job(job_id) if job_id else active_sync_job()
+        return render_template_string(
+            SETTINGS_TEMPLATE,
+            meta_columns=sorted(meta_columns),
+            sync_settings=sync_settings,  # <-- вот его и передаём
+            view=view,
+            job=job,
+            scheduler=scheduler_status()
+        )
 
-                # Список файлов в директории
-                files = ftp.nlst(directory)
-                print(f"📂 Вміст FTP-директорії «{directory}»: ", flush=True)
-                for f in files:
-                    print(f"    – {directory.rstrip('/')}/{f}", flush=True)
 
-                # Удаляем наш файл
-                if filename in [os.path.basename(f) for f in files]:
-                    ftp.delete(FTP_FILE_PATH)
-                    print(f"🗑️ Файл {FTP_FILE_PATH} видалено з FTP", flush=True)
-                else:
-                    print(f"⚠️ Файл {FTP_FILE_PATH} не знайдено — нічого не видаляємо", flush=True)
+    act = request.form["action"]
+    if act == "add_meta":
+        meta_columns.add(request.form["new_meta"].strip())
+        flash("Додан метафілд")
+        return redirect(url_for("settings"))
+    if act == "delete_meta":
+        to_del = request.form.get("meta_to_delete", "").strip()
+        if to_del in meta_columns:
+            meta_columns.remove(to_del)
+            flash(f"Метафілд «{to_del}» видалено")
+        return redirect(url_for("settings"))
 
-                ftp.quit()
+    if act == "save_settings":
+        # обновляем app.config и файл
+        cfg = json.load(open(SETTINGS_FILE, 'r'))
+        for key in ("update_price_qty", "update_sale_price", "update_description"):
+            cfg[key] = key in request.form
+        with open(SETTINGS_FILE, 'w') as f:
+            json.dump(cfg, f, indent=2)
+        app.config["SYNC_SETTINGS"].update(cfg)
+        flash("Налаштування збережені")
+        return redirect(url_for("settings"))
 
-            except Exception as e:
-                print(f"❌ Не вдалося обробити FTP-директорію {directory}: {e}", flush=True)
 
-            app.config["LAST_LOGS"] = buf_stdout.getvalue().splitlines()
+    if act == "clear_meta":
+        meta_columns.clear()
+        flash("Метафілди видалені")
+        return redirect(url_for("settings"))
 
-            return redirect(url_for("report"))
+    if act in SYNC_JOB_KINDS:
+        job = submit_sync_job(act, reason="кнопка на сторінці налаштувань")
+        flash(f"Синхронізацію поставлено в чергу: {SYNC_JOB_KINDS[act]} (job {job['id']})")
+        return redirect(url_for("settings", job=job["id"]))
+
+
+@app.route("/jobs", methods=["GET"])
+def jobs_list():
+    with _jobs_lock:
+        items = [_job_public(j) for j in _jobs.values()]
+    return jsonify({"jobs": items[::-1]})
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = get_sync_job(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job)
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def job_cancel(job_id):
+    job = cancel_sync_job(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    # готовность: 200, когда Excel-мапинг загружен; плюс время старта для мониторинга
+    excel = excel_status()
+    ready = excel["state"] == "ready"
+    return jsonify({
+        "ready": ready,
+        "excel": excel,
+        "startup": {"import_seconds": STARTUP_SECONDS, "uptime_seconds": round(time.time() - _import_t0, 1)},
+        "job": active_sync_job(),
+        "scheduler": scheduler_status(),
+    }), 200 if ready else 503
+
+
+# под reloader'ом Werkzeug (debug=True) модуль исполняется дважды: родительский процесс только следит
+# за файлами — автозапуск и порт встроенного FTP нужны одному процессу, который обслуживает запросы
+if __name__ != '__main__' or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+    start_scheduler()
+    start_ftp_receiver()
+STARTUP_SECONDS = round(time.time() - _import_t0, 3)
+log.info(f"🚀 Застосунок готовий за {STARTUP_SECONDS}s (Excel-мапінг вантажиться у фоні)")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,490 @@
+# Локальный стенд Shopify Admin API для проверки синхронизации без настоящего магазина.
+#
+#   python mock_shopify.py --port 8081 --latency 0.05 --rest-rate 2
+#   SHOPIFY_API_BASE=http://127.0.0.1:8081 SHOPIFY_STORE_URL=mock python index.py
+#
+# REST: products (GET по handle/постранично, POST, PUT), variants PUT, metafields товара,
+# inventory_levels/set. GraphQL: inventorySetQuantities, metafieldsSet, productVariantsBulkUpdate
+# (в том числе несколько товаров под алиасами), остатки через nodes → InventoryItem.inventoryLevel и bulk-поток
+# stagedUploadsCreate → загрузка JSONL → bulkOperationRunMutation (productSet) → node(id) → bulkOperationCancel.
+# Задержка ответа и лимиты как у Shopify: leaky bucket для REST (429 + Retry-After,
+# X-Shopify-Shop-Api-Call-Limit) и бюджет стоимости для GraphQL (THROTTLED + throttleStatus).
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+
+from flask import Flask, request, jsonify, Response
+
+
+class LeakyBucket:
+    # REST: ведро на `size` запросов, утекает `rate` в секунду
+    def __init__(self, size, rate):
+        self.size, self.rate = size, rate
+        self.level = 0.0
+        self.at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        # (принят ли запрос, заполненность после него)
+        with self.lock:
+            now = time.monotonic()
+            self.level = max(0.0, self.level - (now - self.at) * self.rate)
+            self.at = now
+            if self.level + 1 > self.size:
+                return False, self.level
+            self.level += 1
+            return True, self.level
+
+
+class CostBucket:
+    # GraphQL: бюджет `size` очков, восстанавливается `rate` очков в секунду
+    def __init__(self, size, rate):
+        self.size, self.rate = size, rate
+        self.available = float(size)
+        self.at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, cost):
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.size, self.available + (now - self.at) * self.rate)
+            self.at = now
+            ok = self.available >= cost
+            if ok:
+                self.available -= cost
+            return ok, {"maximumAvailable": float(self.size), "currentlyAvailable": int(self.available),
+                        "restoreRate": float(self.rate)}
+
+
+class MockStore:
+    def __init__(self, latency=0.0, jitter=0.0, rest_bucket=40, rest_rate=2.0,
+                 graphql_bucket=1000, graphql_rate=50.0, mutation_cost=10):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1000)
+        self.products = {}          # product_id → product (в форме REST)
+        self.metafields = {}        # product_id → {key: value}
+        self.uploads = {}           # staged key → содержимое JSONL
+        self.bulk_ops = {}          # op_id → dict статуса
+        self.bulk_results = {}      # op_id → JSONL с результатами
+        self.bulk_hold = False      # True — bulk-операции «зависают» в RUNNING до bulkOperationCancel
+        self.latency, self.jitter = latency, jitter
+        self.rest_limit = LeakyBucket(rest_bucket, rest_rate) if rest_rate else None
+        self.graphql_limit = CostBucket(graphql_bucket, graphql_rate) if graphql_rate else None
+        self.mutation_cost = mutation_cost
+        self.calls = Counter()      # (method, endpoint) → число запросов
+        self.throttled = Counter()  # "rest" / "graphql" → число отказов по лимиту
+        self.image_downloads = 0    # сколько раз «Shopify» скачал картинку по src
+
+    def handle_taken(self, handle, pid=None):
+        return any(p["handle"] == handle and p["id"] != pid for p in self.products.values())
+
+    def variant_by_id(self, vid):
+        for prod in self.products.values():
+            for v in prod["variants"]:
+                if v["id"] == vid:
+                    return v
+        return None
+
+    def variant_by_inventory_item(self, iid):
+        for prod in self.products.values():
+            for v in prod["variants"]:
+                if v["inventory_item_id"] == iid:
+                    return v
+        return None
+
+    def new_variant(self, v):
+        return dict(v, id=next(self.ids), inventory_item_id=next(self.ids), inventory_quantity=0,
+                    option1=v.get("option1", "Default Title"))
+
+    def new_image(self, pid, src):
+        return {"id": next(self.ids), "product_id": pid, "src": f"https://cdn.mock/{next(self.ids)}.jpg",
+                "original_src": src}
+
+    def rest_upsert(self, body, pid=None):
+        # как REST products: варианты с id обновляются на месте, без id — создаются, остальные удаляются
+        prod = self.products.get(pid) or {"id": next(self.ids), "variants": []}
+        old_by_id = {v["id"]: v for v in prod["variants"]}
+        variants = []
+        for v in body.get("variants", prod["variants"]):
+            if v.get("id") in old_by_id:
+                variants.append(dict(old_by_id[v["id"]], **v))
+            else:
+                variants.append(self.new_variant(v))
+        prod.update({k: v for k, v in body.items() if k not in ("variants", "metafields", "images")})
+        prod["variants"] = variants
+        if "images" in body:
+            # список images в PUT заменяет все картинки товара — Shopify скачивает их заново
+            prod["images"] = [self.new_image(prod["id"], im["src"]) for im in body["images"]]
+            self.image_downloads += len(body["images"])
+        prod.setdefault("images", [])
+        for pos, im in enumerate(prod["images"], 1):
+            im["position"] = pos
+        prod.setdefault("handle", body.get("handle"))
+        self.products[prod["id"]] = prod
+        for mf in body.get("metafields") or []:
+            self.metafields.setdefault(prod["id"], {})[mf["key"]] = mf["value"]
+        return prod
+
+    def product_set(self, inp):
+        # упрощённый productSet: создаёт или обновляет товар с вариантами
+        pid = int(inp["id"].rsplit("/", 1)[-1]) if inp.get("id") else None
+        if pid is not None and pid not in self.products:
+            return None, [{"field": ["input", "id"], "message": "Product does not exist", "code": "NOT_FOUND"}]
+        if self.handle_taken(inp.get("handle"), pid):
+            return None, [{"field": ["input", "handle"], "message": "Handle has already been taken",
+                           "code": "TAKEN"}]
+        prod = self.products.get(pid) or {"id": next(self.ids), "variants": []}
+        old_by_opt = {v["option1"]: v for v in prod["variants"]}
+        variants = []
+        for v in inp.get("variants", []):
+            opt1 = v["optionValues"][0]["name"] if v.get("optionValues") else "Default Title"
+            old = old_by_opt.get(opt1) or {"id": next(self.ids), "inventory_item_id": next(self.ids)}
+            qty = sum(q["quantity"] for q in v.get("inventoryQuantities", []))
+            variants.append(dict(old, option1=opt1, sku=(v.get("inventoryItem") or {}).get("sku"),
+                                 barcode=v.get("barcode"), price=v.get("price"),
+                                 compare_at_price=v.get("compareAtPrice"), inventory_quantity=qty))
+        prod.update(handle=inp.get("handle"), title=inp.get("title"), variants=variants)
+        self.products[prod["id"]] = prod
+        return prod, []
+
+
+def product_node(prod):
+    return {
+        "id": f"gid://shopify/Product/{prod['id']}",
+        "handle": prod["handle"],
+        "variants": {"nodes": [{
+            "id": f"gid://shopify/ProductVariant/{v['id']}",
+            "sku": v.get("sku"),
+            "selectedOptions": [{"name": "option1", "value": v.get("option1")}],
+            "inventoryItem": {"id": f"gid://shopify/InventoryItem/{v['inventory_item_id']}"},
+        } for v in prod["variants"]]},
+    }
+
+
+def gid_id(gid):
+    return int(str(gid).rsplit("/", 1)[-1])
+
+
+def endpoint_of(path):
+    return re.sub(r"\d+", ":id", re.sub(r"^/admin/api/[^/]+/", "", path))
+
+
+def create_app(store=None):
+    store = store or MockStore()
+    app = Flask(__name__)
+    app.config["STORE"] = store
+
+    @app.before_request
+    def simulate_network():
+        if not request.path.startswith("/admin/api/"):
+            return None
+        store.calls[(request.method, endpoint_of(request.path))] += 1
+        if store.latency or store.jitter:
+            time.sleep(store.latency + random.uniform(0, store.jitter))
+        if store.rest_limit and not request.path.endswith("/graphql.json"):
+            ok, level = store.rest_limit.take()
+            request.environ["mock.call_limit"] = f"{int(level)}/{store.rest_limit.size}"
+            if not ok:
+                store.throttled["rest"] += 1
+                resp = jsonify({"errors": "Exceeded 2 calls per second for api client. Reduce request rates."})
+                resp.status_code = 429
+                resp.headers["Retry-After"] = "1.0"
+                return resp
+        return None
+
+    @app.after_request
+    def call_limit_header(resp):
+        if "mock.call_limit" in request.environ:
+            resp.headers["X-Shopify-Shop-Api-Call-Limit"] = request.environ["mock.call_limit"]
+        return resp
+
+    def graphql_reply(data, throttle, cost):
+        return jsonify({"data": data, "extensions": {"cost": {
+            "requestedQueryCost": cost, "actualQueryCost": cost, "throttleStatus": throttle}}})
+
+    @app.post("/admin/api/<version>/graphql.json")
+    def graphql(version):
+        body = request.get_json()
+        query = body.get("query", "")
+        variables = body.get("variables") or {}
+
+        # productVariantsBulkUpdate приходит пачкой под алиасами: стоимость — за каждое поле мутации
+        aliases = re.findall(r"(\w+): productVariantsBulkUpdate\(productId: \$(\w+), variants: \$(\w+)\)", query)
+        cost = store.mutation_cost * max(1, len(aliases)) if "mutation" in query else 1
+        throttle = None
+        if store.graphql_limit:
+            ok, throttle = store.graphql_limit.take(cost)
+            if not ok:
+                store.throttled["graphql"] += 1
+                return jsonify({"errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}],
+                                "extensions": {"cost": {"requestedQueryCost": cost, "actualQueryCost": None,
+                                                        "throttleStatus": throttle}}})
+
+        if "inventorySetQuantities" in query:
+            inp = variables.get("input") or {}
+            errors = []
+            with store.lock:
+                targets = [store.variant_by_inventory_item(gid_id(q["inventoryItemId"]))
+                           for q in inp.get("quantities", [])]
+                for i, v in enumerate(targets):
+                    if v is None:
+                        errors.append({"field": ["input", "quantities", str(i), "inventoryItemId"],
+                                       "message": "The specified inventory item could not be found.",
+                                       "code": "INVALID_INVENTORY_ITEM"})
+                if not errors:
+                    for q, v in zip(inp["quantities"], targets):
+                        v["inventory_quantity"] = q["quantity"]
+            return graphql_reply({"inventorySetQuantities": {
+                "inventoryAdjustmentGroup": None if errors else {"reason": inp.get("reason")},
+                "userErrors": errors,
+            }}, throttle, cost)
+
+        if "inventoryLevel(" in query and "nodes(" in query:
+            # текущие остатки по inventory item (у стенда одна локация)
+            with store.lock:
+                nodes = []
+                for gid in variables.get("ids") or []:
+                    v = store.variant_by_inventory_item(gid_id(gid))
+                    nodes.append(v and {"id": gid, "inventoryLevel": {"quantities": [
+                        {"name": "available", "quantity": v["inventory_quantity"]}]}})
+            return graphql_reply({"nodes": nodes}, throttle, cost)
+
+        if "metafieldsSet" in query:
+            mfs = variables.get("metafields") or []
+            errors = []
+            with store.lock:
+                for i, mf in enumerate(mfs):
+                    if gid_id(mf["ownerId"]) not in store.products:
+                        errors.append({"field": ["metafields", str(i), "ownerId"],
+                                       "message": "Owner does not exist", "code": "INVALID"})
+                if not errors:
+                    for mf in mfs:
+                        store.metafields.setdefault(gid_id(mf["ownerId"]), {})[mf["key"]] = mf["value"]
+            return graphql_reply({"metafieldsSet": {
+                "metafields": [] if errors else [{"id": f"gid://shopify/Metafield/{next(store.ids)}",
+                                                  "key": mf["key"]} for mf in mfs],
+                "userErrors": errors,
+            }}, throttle, cost)
+
+        if aliases:
+            data = {}
+            with store.lock:
+                for alias, pid_var, variants_var in aliases:
+                    prod = store.products.get(gid_id(variables.get(pid_var, "0")))
+                    if prod is None:
+                        data[alias] = {"userErrors": [{"field": ["productId"], "message": "Product does not exist",
+                                                       "code": "PRODUCT_DOES_NOT_EXIST"}]}
+                        continue
+                    by_id = {v["id"]: v for v in prod["variants"]}
+                    inp = variables.get(variants_var) or []
+                    errors = [{"field": ["variants", str(i), "id"], "message": "Product variant does not exist",
+                               "code": "PRODUCT_VARIANT_DOES_NOT_EXIST"}
+                              for i, v in enumerate(inp) if gid_id(v.get("id", "0")) not in by_id]
+                    if not errors:
+                        for v in inp:
+                            target = by_id[gid_id(v["id"])]
+                            if "price" in v:
+                                target["price"] = v["price"]
+                            if "compareAtPrice" in v:
+                                target["compare_at_price"] = v["compareAtPrice"]
+                    data[alias] = {"userErrors": errors}
+            return graphql_reply(data, throttle, cost)
+
+        if "stagedUploadsCreate" in query:
+            key = f"tmp/bulk/{uuid.uuid4().hex}/bulk_op_vars.jsonl"
+            return graphql_reply({"stagedUploadsCreate": {
+                "stagedTargets": [{
+                    "url": request.host_url + "staged-uploads",
+                    "resourceUrl": None,
+                    "parameters": [{"name": "key", "value": key},
+                                   {"name": "Content-Type", "value": "text/jsonl"}],
+                }],
+                "userErrors": [],
+            }}, throttle, cost)
+
+        if "bulkOperationRunMutation" in query:
+            with store.lock:
+                lines = store.uploads.get(variables.get("path"))
+                if lines is None:
+                    return graphql_reply({"bulkOperationRunMutation": {
+                        "bulkOperation": None,
+                        "userErrors": [{"field": ["stagedUploadPath"], "message": "Upload not found"}],
+                    }}, throttle, cost)
+                op_id = f"gid://shopify/BulkOperation/{next(store.ids)}"
+                out = []
+                for n, line in enumerate(l for l in lines.splitlines() if l.strip()):
+                    prod, errors = store.product_set(json.loads(line)["input"])
+                    out.append(json.dumps({"data": {"productSet": {
+                        "product": product_node(prod) if prod else None,
+                        "userErrors": errors,
+                    }}, "__lineNumber": n}))
+                store.bulk_results[op_id] = "\n".join(out) + "\n"
+                store.bulk_ops[op_id] = {
+                    "id": op_id, "status": "COMPLETED", "errorCode": None, "objectCount": str(len(out)),
+                    "url": request.host_url + "bulk-results/" + op_id.rsplit("/", 1)[-1] + ".jsonl",
+                    "partialDataUrl": None,
+                }
+                if store.bulk_hold:
+                    store.bulk_ops[op_id].update(status="RUNNING", url=None)
+            return graphql_reply({"bulkOperationRunMutation": {
+                "bulkOperation": {"id": op_id, "status": "CREATED"}, "userErrors": [],
+            }}, throttle, cost)
+
+        if "bulkOperationCancel" in query:
+            with store.lock:
+                op = store.bulk_ops.get(variables.get("id"))
+                if op is None or op["status"] != "RUNNING":
+                    return graphql_reply({"bulkOperationCancel": {"bulkOperation": op, "userErrors": [
+                        {"field": ["id"], "message": "Bulk operation is not running"}]}}, throttle, cost)
+                op["status"] = "CANCELED"
+            return graphql_reply({"bulkOperationCancel": {"bulkOperation": {"id": op["id"], "status": "CANCELING"},
+                                                          "userErrors": []}}, throttle, cost)
+
+        if "BulkOperation" in query and "node(" in query:
+            return graphql_reply({"node": store.bulk_ops.get(variables.get("id"))}, throttle, cost)
+
+        return jsonify({"errors": [{"message": "mock: unsupported query"}]}), 400
+
+    @app.get("/admin/api/<version>/products.json")
+    def list_products(version):
+        # постраничная выгрузка (page_info = смещение) для перестройки индекса
+        limit = int(request.args.get("limit", 50))
+        offset = int(request.args.get("page_info", 0))
+        handle = request.args.get("handle")
+        prods = sorted(store.products.values(), key=lambda p: p["id"])
+        if handle is not None:
+            prods = [p for p in prods if p["handle"] == handle]
+        page = prods[offset:offset + limit]
+        resp = jsonify({"products": page})
+        if offset + limit < len(prods):
+            nxt = f"{request.base_url}?limit={limit}&page_info={offset + limit}"
+            resp.headers["Link"] = f'<{nxt}>; rel="next"'
+        return resp
+
+    @app.post("/admin/api/<version>/products.json")
+    def create_product(version):
+        body = (request.get_json() or {}).get("product") or {}
+        with store.lock:
+            if store.handle_taken(body.get("handle")):
+                # как Shopify: занятый handle получает суффикс
+                body["handle"] = f"{body['handle']}-{next(store.ids)}"
+            prod = store.rest_upsert(body)
+        return jsonify({"product": prod}), 201
+
+    @app.put("/admin/api/<version>/products/<int:pid>.json")
+    def update_product(version, pid):
+        body = (request.get_json() or {}).get("product") or {}
+        with store.lock:
+            if pid not in store.products:
+                return jsonify({"errors": "Not Found"}), 404
+            prod = store.rest_upsert(body, pid)
+        return jsonify({"product": prod})
+
+    @app.post("/admin/api/<version>/products/<int:pid>/images.json")
+    def create_image(version, pid):
+        body = (request.get_json() or {}).get("image") or {}
+        with store.lock:
+            prod = store.products.get(pid)
+            if prod is None:
+                return jsonify({"errors": "Not Found"}), 404
+            prod.setdefault("images", [])
+            image = store.new_image(pid, body.get("src"))
+            store.image_downloads += 1
+            pos = min(int(body.get("position") or len(prod["images"]) + 1), len(prod["images"]) + 1)
+            prod["images"].insert(pos - 1, image)
+            for i, im in enumerate(prod["images"], 1):
+                im["position"] = i
+        return jsonify({"image": image})
+
+    @app.delete("/admin/api/<version>/products/<int:pid>/images/<int:image_id>.json")
+    def delete_image(version, pid, image_id):
+        with store.lock:
+            prod = store.products.get(pid)
+            if prod is None or not any(im["id"] == image_id for im in prod.get("images", [])):
+                return jsonify({"errors": "Not Found"}), 404
+            prod["images"] = [im for im in prod["images"] if im["id"] != image_id]
+        return jsonify({})
+
+    @app.put("/admin/api/<version>/variants/<int:vid>.json")
+    def update_variant(version, vid):
+        body = (request.get_json() or {}).get("variant") or {}
+        with store.lock:
+            v = store.variant_by_id(vid)
+            if v is None:
+                return jsonify({"errors": "Not Found"}), 404
+            v.update({k: val for k, val in body.items() if k != "id"})
+        return jsonify({"variant": v})
+
+    @app.get("/admin/api/<version>/products/<int:pid>/metafields.json")
+    def list_metafields(version, pid):
+        mfs = store.metafields.get(pid, {})
+        return jsonify({"metafields": [{"id": i, "namespace": "custom", "key": k, "value": v}
+                                       for i, (k, v) in enumerate(mfs.items(), 1)]})
+
+    @app.post("/admin/api/<version>/products/<int:pid>/metafields.json")
+    def create_metafield(version, pid):
+        mf = (request.get_json() or {}).get("metafield") or {}
+        with store.lock:
+            store.metafields.setdefault(pid, {})[mf.get("key")] = mf.get("value")
+        return jsonify({"metafield": dict(mf, id=next(store.ids))}), 201
+
+    @app.post("/admin/api/<version>/inventory_levels/set.json")
+    def inventory_set(version):
+        body = request.get_json() or {}
+        with store.lock:
+            v = store.variant_by_inventory_item(int(body.get("inventory_item_id", 0)))
+            if v is None:
+                return jsonify({"errors": "Not Found"}), 404
+            v["inventory_quantity"] = int(body.get("available", 0))
+        return jsonify({"inventory_level": body})
+
+    @app.post("/staged-uploads")
+    def staged_upload():
+        key = request.form.get("key")
+        f = request.files.get("file")
+        if not key or f is None:
+            return "missing key or file", 400
+        with store.lock:
+            store.uploads[key] = f.read().decode("utf-8")
+        return "", 201
+
+    @app.get("/bulk-results/<op>.jsonl")
+    def bulk_results(op):
+        text = store.bulk_results.get(f"gid://shopify/BulkOperation/{op}")
+        if text is None:
+            return "not found", 404
+        return Response(text, mimetype="text/jsonl")
+
+    @app.get("/_mock/stats")
+    def stats():
+        # для бенчмарка: сколько запросов и отказов по лимиту получил стенд
+        return jsonify({
+            "calls": {f"{m} {e}": n for (m, e), n in sorted(store.calls.items())},
+            "total_calls": sum(store.calls.values()),
+            "throttled": dict(store.throttled),
+            "products": len(store.products),
+            "image_downloads": store.image_downloads,
+        })
+
+    return app
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Локальный стенд Shopify Admin API")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency", type=float, default=0.0, help="задержка ответа, с")
+    ap.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, с")
+    ap.add_argument("--rest-rate", type=float, default=2.0, help="REST-запросов в секунду (0 — без лимита)")
+    ap.add_argument("--rest-bucket", type=int, default=40)
+    ap.add_argument("--graphql-rate", type=float, default=50.0, help="очков GraphQL в секунду (0 — без лимита)")
+    args = ap.parse_args()
+    store = MockStore(latency=args.latency, jitter=args.jitter, rest_bucket=args.rest_bucket,
+                      rest_rate=args.rest_rate, graphql_rate=args.graphql_rate)
+    create_app(store).run(host=args.host, port=args.port, threaded=True)